@@ -0,0 +1,111 @@
+'''
+This script is to compare the server modes of GhostAgent command server,
+see :const:`globalvar.g_server_mode`.
+
+A lot of short connections are sent to a local server in each mode,
+and connections per second and p99 reply latency are reported.
+The server runs the real :class:`util.handle.EchoRequestHandler`, so the
+command should be one which doesn't change anything, such as `GetInfo`
+(handled inline in select mode) or `GetCmdStats` (handled in workers).
+
+Example:
+    python BenchHandleServer.py --clients 50 --requests 20 --command GetInfo
+
+'''
+import sys
+import time
+import socket
+import argparse
+import threading
+sys.path.append('..')
+import util
+from util.handle import EchoRequestHandler
+
+
+args = None
+
+
+def parse_args():
+    '''
+    process the parameters in the command line.
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients",
+                        metavar="Clients",
+                        type=int,
+                        default=50,
+                        help="Number of concurrent clients.")
+    parser.add_argument("--requests",
+                        metavar="Requests",
+                        type=int,
+                        default=20,
+                        help="Number of connections per client.")
+    parser.add_argument("--command",
+                        metavar="Command",
+                        type=str,
+                        default="GetInfo",
+                        help="Command to send, which decides whether it is "
+                             "handled inline or in worker pool.")
+    parser.add_argument("--workers",
+                        metavar="Workers",
+                        type=int,
+                        default=16,
+                        help="Max count of workers in select mode.")
+    return parser.parse_args()
+
+
+def run_client(address, command, count, latencies, errors):
+    '''
+    Send `count` commands, each with a new connection.
+    '''
+    for i in range(count):
+        start = time.time()
+        try:
+            sock = socket.create_connection(address)
+            try:
+                sock.send(command)
+                sock.recv(512)
+            finally:
+                sock.close()
+            latencies.append(time.time() - start)
+        except socket.error:
+            errors.append(1)
+
+
+def bench(mode, server):
+    '''
+    Run all clients against `server`, and print the result.
+    '''
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.setDaemon(1)
+    server_thread.start()
+
+    latencies = []
+    errors = []
+    clients = [threading.Thread(target=run_client,
+                                args=(server.server_address, args.command,
+                                      args.requests, latencies, errors))
+               for i in range(args.clients)]
+    start = time.time()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.time() - start
+    server.shutdown()
+    server.server_close()
+
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1] if latencies else 0
+    print('%-10s %8d conns %6d errors %10.1f conn/s %10.2f ms p99'
+          % (mode, len(latencies), len(errors),
+             len(latencies) / elapsed, p99 * 1000))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    bench('threading',
+          util.ThreadedTCPServer(('127.0.0.1', 0), EchoRequestHandler))
+    bench('select',
+          util.SelectTCPServer(('127.0.0.1', 0), EchoRequestHandler,
+                               max_workers=args.workers))
@@ -0,0 +1,140 @@
+'''
+This script is to measure the handle loop of :class:`nicu.notify.NotifyServer`.
+
+A local notify server is started with status kept in memory instead of
+database. CPU time of the idle server is reported first, then clients send
+notifications and status queries, each with a new connection or through
+a long-lived session, and notifications per second are reported.
+
+Example:
+    python BenchNotifyServer.py --clients 20 --requests 200 --idle 10
+
+'''
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+sys.path.append('..')
+import nicu.wire as wire
+from nicu.notify import NotifyServer, NotifyClient
+
+
+args = None
+
+
+def parse_args():
+    '''
+    process the parameters in the command line.
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients",
+                        metavar="Clients",
+                        type=int,
+                        default=20,
+                        help="Number of concurrent clients.")
+    parser.add_argument("--requests",
+                        metavar="Requests",
+                        type=int,
+                        default=200,
+                        help="Number of notifications per client.")
+    parser.add_argument("--idle",
+                        metavar="Seconds",
+                        type=int,
+                        default=10,
+                        help="Seconds to measure CPU time of idle server.")
+    return parser.parse_args()
+
+
+class BenchNotifyServer(NotifyServer):
+    '''
+    Notify server which keeps status in memory, and has no poll thread.
+    '''
+    def __init__(self, server_port):
+        self.server_name = 'localhost'
+        self.server_ip = '127.0.0.1'
+        self.server_port = server_port
+        self._default_event = 'GhostClient'
+        self._statuses = {}
+        self.handle_wait = self.handle()
+
+    def accept(self, name, event, status='Passed'):
+        self._statuses[(name, event)] = status
+        return True
+
+    def query(self, name, event):
+        return self._statuses.get((name, event), 'None')
+
+    def stop(self):
+        self.handle_wait.stop()
+
+
+def get_free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def get_cpu_time():
+    (user, system) = os.times()[:2]
+    return user + system
+
+
+def run_client(index, port, persistent, count, errors):
+    '''
+    Send `count` notifications, and query each of them.
+    '''
+    client = NotifyClient('127.0.0.1', port, persistent=persistent)
+    address = ('127.0.0.1', port)
+    name = 'bench-%d' % index
+    for i in range(count):
+        try:
+            client._framed_exchange(address, 'FinishCmd %s Event%d Passed'
+                                    % (name, i))
+            status = client._framed_exchange(
+                address, 'GetCmdStat %s Event%d' % (name, i), isrecv=True)
+            if status != 'Passed':
+                errors.append(status)
+        except (socket.error, wire.WireError), error:
+            errors.append(error)
+    client.close()
+
+
+def bench(mode, port, persistent):
+    '''
+    Run all clients against the server, and print the result.
+    '''
+    errors = []
+    clients = [threading.Thread(target=run_client,
+                                args=(i, port, persistent,
+                                      args.requests, errors))
+               for i in range(args.clients)]
+    start = time.time()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.time() - start
+    total = args.clients * args.requests
+    print('%-10s %8d notifications %6d errors %10.1f notifications/s'
+          % (mode, total, len(errors), total / elapsed))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    port = get_free_port()
+    server = BenchNotifyServer(port)
+    time.sleep(1)
+
+    start_cpu = get_cpu_time()
+    time.sleep(args.idle)
+    idle_cpu = get_cpu_time() - start_cpu
+    print('idle       %8.3f s CPU in %d s (%.2f%%)'
+          % (idle_cpu, args.idle, idle_cpu * 100.0 / args.idle))
+
+    bench('connection', port, False)
+    bench('session', port, True)
+    server.stop()
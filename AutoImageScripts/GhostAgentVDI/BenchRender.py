@@ -0,0 +1,86 @@
+'''
+This script is to compare the rendering of :class:`util.render.Template`,
+with regular expressions one by one, and with the compiled template.
+
+The setupenv templates in INCOMING, and templates repeated from them to
+larger sizes, are rendered many times, and renders per second are reported.
+
+Example:
+    python BenchRender.py --count 2000 --scales 1,10,100
+
+'''
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+sys.path.append('..')
+from util.render import Template
+
+
+args = None
+
+VALUES = {'is_general': True,
+          'boot_dir_home': 'C:\\Boot',
+          'machine_name': 'sh-rfsts-vm01',
+          'script_ini_dir_server': '\\\\cn-sha-rdfs01\\RD\\SAST\\APPDATA',
+          'notify_server': 'sh-rfsts-ga01',
+          'server_port': 8135}
+
+
+def parse_args():
+    '''
+    process the parameters in the command line.
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count",
+                        metavar="Count",
+                        type=int,
+                        default=2000,
+                        help="Number of renders for each template.")
+    parser.add_argument("--scales",
+                        metavar="Scales",
+                        type=str,
+                        default="1,10,100",
+                        help="Times to repeat each template, split by comma.")
+    return parser.parse_args()
+
+
+def bench(name, path, count):
+    '''
+    Render the template file `count` times in both ways, and print the result.
+    '''
+    expected = Template(filename=path)._render_regex(**VALUES)
+    count_regex = max(1, count / 10)
+    start = time.time()
+    for i in range(count_regex):
+        Template(filename=path)._render_regex(**VALUES)
+    regex_rate = count_regex / (time.time() - start)
+
+    start = time.time()
+    for i in range(count):
+        result = Template(filename=path).render(**VALUES)
+    compiled_rate = count / (time.time() - start)
+    print('%-24s %8d bytes %10.1f regex/s %10.1f compiled/s %6.1fx %s'
+          % (name, os.path.getsize(path), regex_rate, compiled_rate,
+             compiled_rate / regex_rate,
+             ['DIFFERENT', 'identical'][result == expected]))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    incoming = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'INCOMING')
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for filename in ('setupenv.bat', 'setupenv.sh'):
+            with open(os.path.join(incoming, filename), 'rb') as fp:
+                content = fp.read()
+            for scale in [int(x) for x in args.scales.split(',')]:
+                path = os.path.join(temp_dir, '%s.x%d' % (filename, scale))
+                with open(path, 'wb') as fp:
+                    fp.write(content * scale)
+                bench('%s x%d' % (filename, scale), path, args.count / scale)
+    finally:
+        shutil.rmtree(temp_dir)
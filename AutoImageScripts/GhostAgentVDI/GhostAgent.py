@@ -32,6 +32,10 @@
 +------------------------------------------------------+---------+-------+--------+-----+---------+-------+--------+------------+----------+
 | ReleaseMachine ServiceID MachineID                   |         |       |        |     |         |       |        |            |          |
 +------------------------------------------------------+---------+-------+--------+-----+---------+-------+--------+------------+----------+
+| GetCmdStats                                          | Yes     | Yes   | Yes    | Yes | N/A     | N/A   | N/A    | N/A        | N/A      |
++------------------------------------------------------+---------+-------+--------+-----+---------+-------+--------+------------+----------+
+| GetCacheStats                                        | Yes     | Yes   | Yes    | Yes | N/A     | N/A   | N/A    | N/A        | N/A      |
++------------------------------------------------------+---------+-------+--------+-----+---------+-------+--------+------------+----------+
 """
 from __future__ import with_statement
 import os
@@ -72,7 +76,8 @@ def rm_lock_root():
 @asynchronized(True)
 def create_handle_server():
     """
-    Create a threading TCP server to handle requests with specific port.
+    Create a TCP server to handle requests with specific port.
+    The server mode is decided by :const:`globalvar.g_server_mode`.
     """
     # Create Threading TCP Server
     try:
@@ -91,8 +96,13 @@ def create_handle_server():
 
         LOGGER.info("GhostAgent Information: %s:%d"
                     % (gv.g_server_ip, server_port))
-        handle_server = util.ThreadedTCPServer(
-            (gv.g_server_ip, server_port), EchoRequestHandler)
+        if gv.g_server_mode == 'select':
+            handle_server = util.SelectTCPServer(
+                (gv.g_server_ip, server_port), EchoRequestHandler)
+        else:
+            handle_server = util.ThreadedTCPServer(
+                (gv.g_server_ip, server_port), EchoRequestHandler)
+        LOGGER.info("Server mode: %s" % (gv.g_server_mode))
         LOGGER.info("Request handler in working ...")
         handle_server.serve_forever()  # block call
     except Exception, error:
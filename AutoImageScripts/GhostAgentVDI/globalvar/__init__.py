@@ -126,6 +126,32 @@ g_check_upgrade_interval = 5
 The interval to check whether GhostAgent needs to upgrade.
 """
 
+g_server_mode = 'threading'
+"""
+The mode of GhostAgent command server:
+    * **threading** - start a new thread for each connection.
+    * **select** - multiplex all connections in one loop,
+      see :class:`util.SelectTCPServer`.
+"""
+
+g_server_max_workers = 64
+"""
+The max count of worker threads, when :const:`g_server_mode` is `select`.
+Long-running commands like `GhostClient` occupy a worker until finished.
+"""
+
+g_server_client_idle_timeout = 60
+"""
+A connection which sends no command in this time (seconds) is closed,
+when :const:`g_server_mode` is `select`.
+"""
+
+g_session_idle_timeout = 600
+"""
+The session (see :class:`nicu.wire.Session`) will be closed if no request
+is received in this time (seconds).
+"""
+
 g_ns_port = None
 """
 The port of Notify Server, will be initialed after started.
@@ -186,6 +212,12 @@ g_vm_image_archive_root = os.path.join(g_ga_root, "VMImageArchiveRoot")
 The directory to store archive images.
 """
 
+g_vm_template_cache_root = os.path.join(g_ga_root, "VMTemplateCache")
+"""
+The directory to mirror image templates, see :mod:`util.tmplcache`.
+If it's empty, images are copied from template server directly.
+"""
+
 g_vm_conf_file = 'config.ini'
 """
 The configure file about the vmware client machine.
@@ -216,4 +248,32 @@ The max count of local images reserved for each vmware client machine at one tim
 g_vm_parallel_max_count = 3
 """
 The max count to execute vmrun tools at the same time.
+"""
+
+g_vm_template_cache_expire_days = 30
+"""
+The days to keep the mirror of image template which is not used.
+"""
+
+g_vm_template_cache_max_size = 500
+"""
+The max size in GB of all mirrors of image templates, 0 means no limit.
+"""
+
+g_vm_template_cache_linked = False
+"""
+Whether to seed images as linked clones of the mirror of image template,
+which is used where the file system has no copy-on-write clones, such as
+NTFS. An archived linked clone still depends on its parent in the mirror.
+"""
+
+g_vm_deploy_max_count = 4
+"""
+The max count of images deployed at the same time by one DeployVMImage command.
+"""
+
+g_vm_deploy_volume_max_count = 2
+"""
+The max count of images copied to the same local volume at the same time,
+since they compete for its disk bandwidth.
 """
\ No newline at end of file
@@ -4,6 +4,10 @@ DB_POOL_DEFAULT_INITIAL_CONNECTION = 5
 
 DB_POOL_DEFAULT_INCREMENTAL_CONNECTION = 5
 
+DB_POOL_IDLE_VALIDATE = 300
+
+DB_SINGLE_LOCK = False
+
 DB_DEFAULT_HOST = "sast-saas"
 
 DB_DEFAULT_USER = "saas"
@@ -26,14 +30,38 @@ DB_LEN_SEQ_DESC = 500
 
 DB_LEN_STEP_DESC = 300
 
+DB_STATEMENT_CACHE_SIZE = 256
+
+DB_STATEMENT_BUCKETS = (0.001, 0.01, 0.1, 1, 10)
+
+REF_CACHE_TTL = 300
+
+REF_CACHE_ENABLED = True
+
 
 GHOST_CMD_TIMEOUT = 3600
 
 GHOST_WAIT_TIMEOUT = 3600
 
+GHOST_SUBSCRIBE_INTERVAL = 60
+
 
 NOTIFY_POLL_INTERVAL = 1
 
 NOTIFY_WAIT_TIMEOUT = 86400
 
+NOTIFY_RESYNC_INTERVAL = 3600
+
+NOTIFY_SESSION_IDLE_TIMEOUT = 600
+
+NOTIFY_REQUERY_INTERVAL = 10
+
+NOTIFY_WAIT_MARGIN = 60
+
+
+WIRE_FRAMED = True
+
+
+VM_LIST_CACHE_TTL = 5
+
 
@@ -10,6 +10,8 @@ import itertools
 import logging
 import threading
 import uuid
+import datetime
+import collections
 import config
 
 __all__ = [
@@ -28,9 +30,18 @@ _DB_USER = None
 _DB_PASSWORD = None
 _DB_DATABASE = None
 _DB_LOCK = threading.Lock()
-_DB_LOCK_SQLSERVERDB_POOL_GET = threading.Lock()
-_DB_LOCK_SQLSERVERDB_POOL_RETURN = threading.Lock()
 _DB_LOCK_SQLSERVERDB = threading.Lock()
+_DB_LOCK_STATEMENT = threading.Lock()
+_DB_STATEMENTS = collections.OrderedDict()
+_DB_STATEMENT_STATS = collections.OrderedDict()
+_PLACEHOLDER_RE = re.compile(r'%([%s])')
+# Errors of pymssql which mean the connection may be broken
+_CONNECTION_ERRORS = (pymssql.InterfaceError, pymssql.OperationalError)
+# DB-Lib messages of OperationalError which mean the connection is lost,
+# rather than the statement fails on server, e.g. by timeout or deadlock.
+_CONNECTION_LOST_RE = re.compile(
+    r'\b(20004|20006|20009|20017|20047)\b|DBPROCESS is dead'
+    r'|connection is closed|Adaptive Server connection failed', re.I)
 
 def init_db(host, user, password, database):
     """Init the database connection strings"""
@@ -77,7 +88,27 @@ def _get_connection(retry=False,
 
 
 def run_query_sql(query, retry=False):
-    """Execute a query SQL statement, and return the query result."""
+    """
+    Execute a query SQL statement, and return the query result.
+
+    The statement runs on a connection of the :class:`SQLServerDB` pool of
+    the database set by :func:`init_db`, so that independent statements
+    run concurrently. If `config.DB_SINGLE_LOCK` is True, all statements
+    are serialised, each with its own connection, as old versions did.
+
+    retry     whether to wait until the database server recovers.
+    """
+    if config.DB_SINGLE_LOCK:
+        return _run_query_sql_locked(query, retry)
+    try:
+        return _run_pooled_statements([query], retry, fetch=True)
+    except Exception, error:
+        LOGGER.error("Failed to execute query statement <%s> : %s" %
+                     (query, error))
+
+
+def _run_query_sql_locked(query, retry=False):
+    """Execute a query SQL statement behind the global lock."""
     conn = None
     try:
         _DB_LOCK.acquire()
@@ -97,7 +128,31 @@ def run_query_sql(query, retry=False):
 
 
 def run_action_sql(query, retry=False):
-    """Execute an insert/update SQL Statement."""
+    """
+    Execute an insert/update SQL Statement, it could be a string or a list.
+    See :func:`run_query_sql` for the connection used.
+    """
+    if config.DB_SINGLE_LOCK:
+        return _run_action_sql_locked(query, retry)
+    try:
+        if isinstance(query, basestring):
+            command_lists = [query]
+        elif isinstance(query, list):
+            command_lists = query
+        else:
+            raise CommonDatabaseException(
+                ["The input query of function "
+                 "execute is not a basic string or list."])
+        _run_pooled_statements(command_lists, retry)
+        return 0
+    except Exception, error:
+        LOGGER.error("Failed to execute action statement <%s> : %s" %
+                     (query, error))
+    return 1
+
+
+def _run_action_sql_locked(query, retry=False):
+    """Execute an insert/update SQL Statement behind the global lock."""
     conn = None
     try:
         _DB_LOCK.acquire()
@@ -128,6 +183,178 @@ def run_action_sql(query, retry=False):
     return 1
 
 
+def _is_connection_lost(error):
+    """
+    Whether the error means the connection is lost, so that the statements
+    could be run again with another connection. The transaction is never
+    committed in that case.
+    """
+    if isinstance(error, pymssql.InterfaceError):
+        return True
+    return bool(_CONNECTION_LOST_RE.search(str(error)))
+
+
+def _get_default_pool():
+    """Get the pool of the database set by :func:`init_db`."""
+    _DB_LOCK_SQLSERVERDB.acquire()
+    try:
+        return SQLServerDB._get_connection_pool(_DB_USER, _DB_PASSWORD,
+                                                _DB_DATABASE, _DB_HOST)
+    finally:
+        _DB_LOCK_SQLSERVERDB.release()
+
+
+def _run_pooled_statements(sql_statements, retry=False, fetch=False,
+                           interval=5):
+    """
+    Run statements with a connection of the default pool, and return rows
+    of the last statement if `fetch`.
+    """
+    pool = _get_default_pool()
+    conn = pool.get_connection()
+    # if server down, wait querying until server recover
+    while conn is None and retry:
+        time.sleep(interval)
+        conn = pool.get_connection()
+    if conn is None:
+        raise CommonDatabaseException(
+            ["Failed to connect host %s" % (_DB_HOST)])
+    try:
+        try:
+            rows = _run_statements(conn, sql_statements, None, fetch)
+        except _CONNECTION_ERRORS, error:
+            if not _is_connection_lost(error):
+                raise
+            conn = SQLServerDB._reconnect(conn, retry, interval)
+            rows = _run_statements(conn, sql_statements, None, fetch)
+    except:
+        if conn:
+            pool.return_connection(conn, True)
+        raise
+    pool.return_connection(conn)
+    return rows
+
+
+def _param_type(value):
+    """Get the SQL Server type used to declare a bound parameter."""
+    if isinstance(value, bool):
+        return 'bit'
+    if isinstance(value, (int, long)):
+        return 'bigint'
+    if isinstance(value, float):
+        return 'float'
+    if isinstance(value, datetime.datetime):
+        return 'datetime'
+    if isinstance(value, unicode):
+        if len(value) > 4000:
+            return 'nvarchar(max)'
+        return 'nvarchar(4000)'
+    # Columns are mostly varchar, and binding str as nvarchar converts
+    # the column implicitly, which turns index seeks into scans.
+    if isinstance(value, str) and len(value) > 8000:
+        return 'varchar(max)'
+    return 'varchar(8000)'
+
+
+def _prepare_statement(sql_statement, params):
+    """
+    Turn a statement with `%s` placeholders into a `sp_executesql` call,
+    so that SQL Server reuses one plan for all parameter values.
+    The prepared text is cached by statement and parameter types.
+
+    Return (text, params) which could be passed to `cursor.execute`.
+    """
+    params = tuple(params)
+    types = tuple(_param_type(x) for x in params)
+    key = (sql_statement, types)
+    _DB_LOCK_STATEMENT.acquire()
+    try:
+        text = _DB_STATEMENTS.pop(key, None)
+        if text is None:
+            indexes = itertools.count(1)
+            inner = _PLACEHOLDER_RE.sub(
+                lambda m: '%' if m.group(1) == '%' else '@P%d' % next(indexes),
+                sql_statement)
+            count = next(indexes) - 1
+            if count != len(params):
+                raise CommonDatabaseException(
+                    ["Statement requires %d parameters, but %d are given: %s"
+                     % (count, len(params), sql_statement)])
+            if params:
+                text = "exec sp_executesql N'%s', N'%s', %s" % (
+                    inner.replace("'", "''").replace('%', '%%'),
+                    ', '.join('@P%d %s' % (i + 1, x)
+                              for (i, x) in enumerate(types)),
+                    ', '.join('@P%d=%%s' % (i + 1)
+                              for i in range(len(params))))
+            else:
+                text = inner
+            if len(_DB_STATEMENTS) >= config.DB_STATEMENT_CACHE_SIZE:
+                _DB_STATEMENTS.popitem(last=False)
+        _DB_STATEMENTS[key] = text
+        return (text, params)
+    finally:
+        _DB_LOCK_STATEMENT.release()
+
+
+def _record_statement(sql_statement, elapsed):
+    """
+    Add the execution time of statement into its histogram. The histogram
+    of the least recently executed statement is dropped when there are too
+    many statements.
+    """
+    _DB_LOCK_STATEMENT.acquire()
+    try:
+        stats = _DB_STATEMENT_STATS.pop(sql_statement, None)
+        if stats is None:
+            if len(_DB_STATEMENT_STATS) >= config.DB_STATEMENT_CACHE_SIZE:
+                _DB_STATEMENT_STATS.popitem(last=False)
+            stats = [0, 0.0, [0] * (len(config.DB_STATEMENT_BUCKETS) + 1)]
+        _DB_STATEMENT_STATS[sql_statement] = stats
+        stats[0] += 1
+        stats[1] += elapsed
+        index = 0
+        for bound in config.DB_STATEMENT_BUCKETS:
+            if elapsed <= bound:
+                break
+            index += 1
+        stats[2][index] += 1
+    finally:
+        _DB_LOCK_STATEMENT.release()
+
+
+def _run_statements(conn, sql_statements, params, fetch=False):
+    """
+    Run statements in the pooled connection and commit, return rows of the
+    last statement if `fetch`.
+    """
+    cur = conn[1].cursor()
+    for sql_item in sql_statements:
+        _execute_statement(cur, sql_item, params)
+    rows = cur.fetchall() if fetch else None
+    conn[1].commit()
+    return rows
+
+
+def _execute_statement(cursor, sql_statement, params):
+    """
+    Execute statement in cursor, with bound parameters if `params` is
+    not None.
+    """
+    if params is None:
+        cursor.execute(sql_statement)
+        return
+    (text, params) = _prepare_statement(sql_statement, params)
+    start = time.time()
+    try:
+        if params:
+            cursor.execute(text, params)
+        else:
+            cursor.execute(text)
+    finally:
+        _record_statement(sql_statement, time.time() - start)
+
+
 class CommonDatabaseException(Exception):
     """Custom defined database exception"""
     pass
@@ -221,12 +448,13 @@ class SQLServerDB:
 
             pool = SQLServerDB._get_connection_pool(user, password,
                                                     database, host)
-            p_conn = SQLServerDB._get_connection(pool)
-            return p_conn
-
         finally:
             _DB_LOCK_SQLSERVERDB.release()
 
+        # Wait for a free connection without blocking other pools.
+        p_conn = SQLServerDB._get_connection(pool)
+        return p_conn
+
     @staticmethod
     def _get_connection_pool(user, password, database, host):
         """
@@ -249,6 +477,31 @@ class SQLServerDB:
         return p_conn
 
 
+    @staticmethod
+    def _reconnect(conn, retry=False, interval=5):
+        """
+        Close the broken connection, and get a validated one from the same
+        pool. Pooled connections are not tested at checkout, so a statement
+        failed by connection error is retried once with it.
+
+        retry     whether to wait until the database server recovers.
+                  Otherwise CommonDatabaseException is raised if no
+                  connection could be got.
+        """
+        LOGGER.warning("Connection %s seems broken, retry with another one"
+                       % (conn[0],))
+        pool = SQLServerDB.__pooldict[conn[3]]
+        pool.return_connection(conn, True)
+        new_conn = pool.get_connection(validate=True)
+        while new_conn is None and retry:
+            time.sleep(interval)
+            new_conn = pool.get_connection(validate=True)
+        if new_conn is None:
+            raise CommonDatabaseException(
+                ["Failed to reconnect host %s" % (pool.host,)])
+        return new_conn
+
+
     @staticmethod
     def close(conn, close=True):
         """Close connection to the database."""
@@ -260,9 +513,12 @@ class SQLServerDB:
 
 
     @staticmethod
-    def query(sql_statement, conn=None):
+    def query(sql_statement, conn=None, params=None):
         """
         Execute query SQL statement. The SQL statement should be a string.
+
+        If `params` is given, the statement is executed with bound
+        parameters, and each `%s` in it is a placeholder (`%%` for `%`).
         """
         rows = []
         msg = []
@@ -276,16 +532,21 @@ class SQLServerDB:
             if not conn:
                 new_fg = True
                 conn = SQLServerDB.connect()
-            cur = conn[1].cursor()
-            cur.execute(sql_statement)
-            rows = cur.fetchall()
-            conn[1].commit()
+            try:
+                rows = _run_statements(conn, [sql_statement], params, True)
+            except _CONNECTION_ERRORS, error:
+                if not new_fg or not _is_connection_lost(error):
+                    raise
+                conn = SQLServerDB._reconnect(conn)
+                rows = _run_statements(conn, [sql_statement], params, True)
             return rows
         except Exception, e:
             close_fg = True
             msg = []
             msg.append("Failed to execute query statement : %s" %
                        sql_statement)
+            if params is not None:
+                msg.append("Parameters : %s" % (params,))
             msg.append(e)
             raise CommonDatabaseException(msg)
         finally:
@@ -294,17 +555,20 @@ class SQLServerDB:
 
 
     @staticmethod
-    def query_one(sql_statement, conn=None):
-        rows = SQLServerDB.query(sql_statement, conn)
+    def query_one(sql_statement, conn=None, params=None):
+        rows = SQLServerDB.query(sql_statement, conn, params)
         if not rows:
             raise Exception('No record in database.')
         return rows[0]
 
 
     @staticmethod
-    def execute(sql_statements, conn=None):
+    def execute(sql_statements, conn=None, params=None):
         """Execute operation SQL statement. The SQL statement should
         be a string or a list of string.
+
+        If `params` is given, the statement should be a string, and it is
+        executed with bound parameters, see :meth:`query`.
         """
         command_lists = []
         msg = []
@@ -318,6 +582,9 @@ class SQLServerDB:
         if isinstance(sql_statements, basestring):
             command_lists.append(sql_statements)
         if isinstance(sql_statements, list):
+            if params is not None:
+                raise CommonDatabaseException(
+                    ["Parameters are only supported by a single statement."])
             command_lists += sql_statements
 
         try:
@@ -329,10 +596,13 @@ class SQLServerDB:
                 # are in the same pool will not be closed.
                 new_fg = True
                 conn = SQLServerDB.connect()
-            cur = conn[1].cursor()
-            for sql_item in command_lists:
-                cur.execute(sql_item)
-            conn[1].commit()
+            try:
+                _run_statements(conn, command_lists, params)
+            except _CONNECTION_ERRORS, error:
+                if not new_fg or not _is_connection_lost(error):
+                    raise
+                conn = SQLServerDB._reconnect(conn)
+                _run_statements(conn, command_lists, params)
             return 0
         except Exception, e:
             # It's required to close this connection when error is raised.
@@ -344,6 +614,8 @@ class SQLServerDB:
             msg = []
             msg.append("Failed to execute execute statement : %s" %
                        sql_statements)
+            if params is not None:
+                msg.append("Parameters : %s" % (params,))
             msg.append(e)
             raise CommonDatabaseException(msg)
         finally:
@@ -352,6 +624,35 @@ class SQLServerDB:
         return 1
 
 
+    @staticmethod
+    def get_statement_stats():
+        """
+        Get execution histogram of parameterized statements, as a dict
+        whose key is statement, and value is (count, elapsed, histogram).
+        The histogram is a list of (bound, count), where bound is the upper
+        bound in seconds, and None means no bound. Only the recently
+        executed `config.DB_STATEMENT_CACHE_SIZE` statements are kept.
+        """
+        bounds = list(config.DB_STATEMENT_BUCKETS) + [None]
+        _DB_LOCK_STATEMENT.acquire()
+        try:
+            return dict((key, (count, elapsed, zip(bounds, buckets)))
+                        for (key, (count, elapsed, buckets))
+                        in _DB_STATEMENT_STATS.items())
+        finally:
+            _DB_LOCK_STATEMENT.release()
+
+
+    @staticmethod
+    def reset_statement_stats():
+        """Clear execution histogram of all statements."""
+        _DB_LOCK_STATEMENT.acquire()
+        try:
+            _DB_STATEMENT_STATS.clear()
+        finally:
+            _DB_LOCK_STATEMENT.release()
+
+
     @staticmethod
     def get_connection_pool_size(user=None, password=None,
                                  host=None, database=None):
@@ -374,6 +675,24 @@ class SQLServerDB:
             return 0
 
 
+    @staticmethod
+    def get_connection_pool_stats(user=None, password=None,
+                                  host=None, database=None):
+        """
+        Get the occupancy and wait time of a specific pool owned by the
+        class, see :meth:`SQLServerDBPool.get_stats`.
+        """
+        user = user or SQLServerDB.__last_used_username or _DB_USER
+        password = password or SQLServerDB.__last_used_password or _DB_PASSWORD
+        host = host or SQLServerDB.__last_used_host or _DB_HOST
+        database = database or SQLServerDB.__last_used_database or _DB_DATABASE
+
+        key = '_'.join([host, user, password, database])
+        if key in SQLServerDB.__pooldict:
+            return SQLServerDB.__pooldict[key].get_stats()
+        return {}
+
+
     @staticmethod
     def close_all_connections(no_wait=False):
         """close all connections generated by the SQLServerDB"""
@@ -393,6 +712,10 @@ class SQLServerDBPool:
     """
     Connect to the MS SQL Server and execute SQL statement.
     Based on pymssql module @http://pymssql.sourceforge.net/index.php
+
+    Free connections are kept in a free list, so that checkout and return
+    are constant-time. If no connection is free and the pool is full,
+    callers wait on a condition, and are woken once a connection returns.
     """
 
     def __init__(
@@ -407,7 +730,17 @@ class SQLServerDBPool:
         host      database host and instance
         database  the database you want initially to connect to
         """
-        self.__p_connections = []
+        # All connections, keyed by connection id
+        self.__p_connections = {}
+        # Ids of free connections, the last returned one is used first
+        self.__free = []
+        # The last time each connection is returned, keyed by connection id
+        self.__last_used = {}
+        # Count of connections being created out of the lock
+        self.__pending = 0
+        # Count of callers waiting for a free connection
+        self.__waiting = 0
+        self.__cond = threading.Condition(threading.Lock())
 
         self.user = user
         self.password = password
@@ -423,38 +756,76 @@ class SQLServerDBPool:
         if self.max_conn < self.init_conn:
             self.max_conn = self.init_conn
 
+        self.reset_stats()
         try:
             self._create_pool()
         except Exception:
             LOGGER.exception("Failed to creat connection pool")
 
 
-    def get_connection(self):
-        """Returns a pymssql connection object"""
-        #make sure the connection pool had been created
-        if len(self.__p_connections)==0:
-            return None
+    def get_connection(self, validate=False):
+        """
+        Returns a pymssql connection object
 
+        validate  whether to test the connection. Otherwise, only connections
+                  idle for more than DB_POOL_IDLE_VALIDATE seconds are tested,
+                  so that the hot path doesn't touch the network.
+        """
+        start_time = time.time()
         try:
-
-            _DB_LOCK_SQLSERVERDB_POOL_GET.acquire()
-            p_conn = self._get_free_connection()
-
-            while not p_conn:
-                p_conn = self._get_free_connection()
-                time.sleep(1)
-
-            return p_conn
-
+            p_conn = self._checkout()
         except Exception:
             LOGGER.exception("Exception thrown when getting a free" \
                              " connection, return None")
             return None
+        if not p_conn:
+            return None
+        idle_time = self._record_checkout(p_conn, time.time() - start_time)
 
-        finally:
-            _DB_LOCK_SQLSERVERDB_POOL_GET.release()
+        # Test if this connection is still useable
+        if (validate or idle_time > config.DB_POOL_IDLE_VALIDATE) and \
+                not self._test_connection(p_conn):
+            try:
+                p_conn = self._new_p_connection(True)
+                self._add_connection(p_conn)
+            except Exception:
+                LOGGER.error("Failed to create new connection")
+                return None
+
+        return p_conn
 
 
+    def _checkout(self):
+        """
+        Take a free connection, create new connections if there's no free
+        one, or wait until a connection is returned if the pool is full.
+        """
+        self.__cond.acquire()
+        try:
+            while True:
+                if self.__free:
+                    conn_id = self.__free.pop()
+                    p_conn = self.__p_connections[conn_id]
+                    p_conn = (p_conn[0], p_conn[1], True, self.pool_id)
+                    self.__p_connections[conn_id] = p_conn
+                    return p_conn
+
+                room = self.incremental_conn
+                if self.max_conn > 0:
+                    room = min(room, self.max_conn - self.__pending -
+                               len(self.__p_connections))
+                if room > 0:
+                    return self._create_connections(room)
+
+                # Wait in steps, so that a killable thread could be killed.
+                self.__waiting += 1
+                try:
+                    self.__cond.wait(1)
+                finally:
+                    self.__waiting -= 1
+        finally:
+            self.__cond.release()
+
 
     def _new_connection(self):
         """Create a new pymssql connection"""
@@ -475,6 +846,23 @@ class SQLServerDBPool:
         return conn
 
 
+    def _new_p_connection(self, is_busy=False):
+        """Create a new pymssql connection wrapped as pool connection"""
+        return (uuid.uuid1(), self._new_connection(), is_busy, self.pool_id)
+
+
+    def _add_connection(self, p_conn):
+        """Put a new connection into the pool"""
+        self.__cond.acquire()
+        try:
+            self.__p_connections[p_conn[0]] = p_conn
+            if not p_conn[2]:
+                self.__free.append(p_conn[0])
+                self.__cond.notify()
+        finally:
+            self.__cond.release()
+
+
     def _create_pool(self):
         """
         Create the connection pool
@@ -484,64 +872,44 @@ class SQLServerDBPool:
         if len(self.__p_connections) > 0:
             return
 
-        self._create_connections(self.init_conn)
+        self.__cond.acquire()
+        try:
+            p_conn = self._create_connections(self.init_conn)
+            if p_conn:
+                self.__p_connections[p_conn[0]] = \
+                    (p_conn[0], p_conn[1], False, self.pool_id)
+                self.__free.append(p_conn[0])
+        finally:
+            self.__cond.release()
         LOGGER.debug("Connection pool had been created")
 
 
     def _create_connections(self, number_of_connections=1):
         """
-        Create connections and put them into the connection pool
+        Create connections out of the lock, which should be held by caller.
+        The first connection is returned as busy, and others are put into
+        the free list. Return None if failed to create any connection.
 
         number_of_connections
-                number of connections to be created and put into the pool
+                number of connections to be created
         """
+        self.__pending += number_of_connections
+        self.__cond.release()
+        p_conns = []
         try:
             for connection in range(number_of_connections):
-                if self.max_conn > 0 and \
-                        len(self.__p_connections) >= self.max_conn:
-                    break
-                self.__p_connections.append(
-                        (uuid.uuid1(), self._new_connection(),
-                         False, self.pool_id))
-        except Exception, e:
-            raise e
-
-
-    def _get_free_connection(self):
-        """Get a free connection in the pool"""
-        p_conn = self._find_free_connection()
-
-        # If there's no free connection in the pool, create new connections
-        if not p_conn:
-            self._create_connections(self.incremental_conn)
-            p_conn = self._find_free_connection()
-            if not p_conn:
-                return None
-
-        return p_conn
-
-
-    def _find_free_connection(self):
-        """Find a free connection from the pool"""
-        for index, p_conn in enumerate(self.__p_connections):
-            if not p_conn[2]:
-                self.__p_connections[index] = (p_conn[0], p_conn[1],
-                                               True, self.pool_id)
-
-                # Test if this connection is still useable
-                if not self._test_connection(p_conn):
-                    try:
-                        new_conn = self._new_connection()
-                        new_p_conn = (uuid.uuid1(), new_conn,
-                                      True, self.pool_id)
-                        self.__p_connections[index] = new_p_conn
-
-                        return new_p_conn
-                    except Exception:
-                        LOGGER.error("Failed to create new connection")
-                        return None
-
-                return p_conn
+                p_conns.append(self._new_p_connection(not p_conns))
+        except Exception:
+            LOGGER.exception("Failed to create new connection")
+        finally:
+            self.__cond.acquire()
+            self.__pending -= number_of_connections
+        for p_conn in p_conns:
+            self.__p_connections[p_conn[0]] = p_conn
+        for p_conn in p_conns[1:]:
+            self.__free.append(p_conn[0])
+            self.__cond.notify()
+        return p_conns and p_conns[0] or None
 
 
     def _test_connection(self, p_conn):
@@ -576,27 +944,33 @@ class SQLServerDBPool:
 
     def close_connection_pool(self, no_wait=False):
         """Close connection pool and delete all connections"""
+        self.__cond.acquire()
         try:
-            #request the get lock, so that when closing connection pool,
-            #there should not be new get request happening.
-            _DB_LOCK_SQLSERVERDB_POOL_GET.acquire()
             # If connection pool is empty, return
             if len(self.__p_connections) <= 0:
                 return
 
-            while len(self.__p_connections) > 0:
-
-                p_conn = self.__p_connections[0]
-
-                # if the connection is still busy, wait 5 seconds
-                if p_conn[2] and not no_wait:
-                    time.sleep(5)
-
-                self._close_connection(p_conn)
-
-                del self.__p_connections[0]
+            # if some connections are still busy, wait 5 seconds for
+            # each of them
+            deadline = time.time() + 5 * (len(self.__p_connections) -
+                                          len(self.__free))
+            while not no_wait and \
+                    len(self.__free) < len(self.__p_connections) and \
+                    time.time() < deadline:
+                self.__cond.wait(deadline - time.time())
+
+            p_conns = self.__p_connections.values()
+            self.__p_connections = {}
+            self.__free = []
+            self.__last_used = {}
         finally:
-            _DB_LOCK_SQLSERVERDB_POOL_GET.release()
+            self.__cond.release()
+
+        for p_conn in p_conns:
+            try:
+                p_conn[1].close()
+            except Exception:
+                pass
 
 
     def return_connection(self, p_conn, close=False):
@@ -606,21 +980,84 @@ class SQLServerDBPool:
                 p_conn[1].close()
         except Exception:
             pass
+        if not p_conn:
+            return
+        self.__cond.acquire()
         try:
-            _DB_LOCK_SQLSERVERDB_POOL_RETURN.acquire()
-            # If connection pool is empty, return
-            if len(self.__p_connections) <= 0:
+            # The connection may have been removed
+            if p_conn[0] not in self.__p_connections:
                 return
+            if self.__p_connections[p_conn[0]][2]:
+                self.__checkins += 1
+            if close:
+                # A closed connection leaves the pool, so that a new one
+                # could be created in its place.
+                del self.__p_connections[p_conn[0]]
+                self.__last_used.pop(p_conn[0], None)
+                if p_conn[0] in self.__free:
+                    self.__free.remove(p_conn[0])
+            elif self.__p_connections[p_conn[0]][2]:
+                self.__p_connections[p_conn[0]] = \
+                    (p_conn[0], p_conn[1], False, self.pool_id)
+                self.__last_used[p_conn[0]] = time.time()
+                self.__free.append(p_conn[0])
+            self.__cond.notify()
+        finally:
+            self.__cond.release()
 
-            for index, p_conn_list in enumerate(self.__p_connections):
 
-                # Find the index in the connection pool
-                if p_conn[0] == p_conn_list[0]:
-                    self.__p_connections[index] = \
-                        (p_conn_list[0], p_conn_list[1], False, self.pool_id)
-                    break
+    def _record_checkout(self, p_conn, wait_time):
+        """
+        Record the time to wait for a connection, and return seconds the
+        connection has been idle.
+        """
+        self.__cond.acquire()
+        try:
+            now = time.time()
+            idle_time = now - self.__last_used.get(p_conn[0], now)
+            self.__checkouts += 1
+            self.__wait_time += wait_time
+            self.__max_wait_time = max(self.__max_wait_time, wait_time)
+            busy = len(self.__p_connections) - len(self.__free)
+            self.__peak_busy = max(self.__peak_busy, busy)
+            return idle_time
+        finally:
+            self.__cond.release()
+
+
+    def get_stats(self):
+        """
+        Get the occupancy and wait time of the pool, as a dict of:
+
+        size          count of connections
+        busy          count of connections in use
+        waiting       count of callers waiting for a connection
+        peak_busy     max count of connections in use
+        checkouts     count of connections taken
+        wait_time     total seconds to take connections
+        max_wait_time max seconds to take a connection
+        """
+        self.__cond.acquire()
+        try:
+            return {'size': len(self.__p_connections),
+                    'busy': len(self.__p_connections) - len(self.__free),
+                    'waiting': self.__waiting,
+                    'peak_busy': self.__peak_busy,
+                    'checkouts': self.__checkouts,
+                    'checkins': self.__checkins,
+                    'wait_time': self.__wait_time,
+                    'max_wait_time': self.__max_wait_time}
         finally:
-            _DB_LOCK_SQLSERVERDB_POOL_RETURN.release()
+            self.__cond.release()
+
+
+    def reset_stats(self):
+        """Clear the statistics of the pool."""
+        self.__peak_busy = 0
+        self.__checkouts = 0
+        self.__checkins = 0
+        self.__wait_time = 0.0
+        self.__max_wait_time = 0.0
 
 
     def get_connection_pool_size(self):
@@ -4,8 +4,12 @@ import socket
 import logging
 
 from config import GHOST_CMD_TIMEOUT, GHOST_WAIT_TIMEOUT
+from config import GHOST_SUBSCRIBE_INTERVAL
 import nicu.misc as misc
 import nicu.db as db
+import nicu.wire as wire
+from nicu.notify import NotifyClient
+from nicu.refcache import ref_cache
 import nicu.errcode as errcode
 
 
@@ -33,6 +37,13 @@ class GhostCenter:
       If it's True, ghost commands will return unprocessed value immediately
       after:func:`misc.remote_execute` or :func:`misc.remote_execute_diff_port`.
       Otherwise, ghost commands will return processed value.
+    :param persistent:
+      If it's True, commands which wait reply are sent through a long-lived
+      session (:class:`nicu.wire.Session`) to `GhostAgent Server`, instead
+      of a new connection for each command. `Notify Command` is also sent
+      to `GhostAgent Server` in this mode. If the server doesn't support
+      sessions, it falls back to :func:`misc.remote_execute`.
+      Call :meth:`close` to close sessions.
 
     Support commands are:
 
@@ -133,7 +144,7 @@ class GhostCenter:
     """
 
     def __init__(self, server_name='', throw_exception=False,
-                 block_timeout=0, raw=False):
+                 block_timeout=0, raw=False, persistent=False):
         """
         Initial :class:`GhostCenter`. All member variables can be reset
         temporarily, when member function called.
@@ -148,6 +159,14 @@ class GhostCenter:
         self.throw_exception = throw_exception
         self.block_timeout = block_timeout
         self.raw = raw
+        self.persistent = persistent
+        self._sessions = {}
+        self._session_refused = set()
+        # {(machine name or id, server name): (machine name, machine ID,
+        #  server name, whether server keeps running)}, memoized in waiting,
+        # or until close() if it's persistent.
+        self._event_targets = {}
+        self._memo_depth = 0
 
         self._block_mode = (self.block_timeout != 0)
         # the index of machineID in argument command
@@ -248,10 +267,18 @@ class GhostCenter:
         timeout = self.block_timeout
         raw = self.raw
         LOGGER.info("Start Execute command: %s" % (command))
-        res = misc.remote_execute(server, port, command,
-                                  isrecv=is_recv,
-                                  resbool=res_bool,
-                                  timeout=timeout)
+        res = None
+        if self.persistent and is_recv:
+            if notify_cmd_flag:
+                # GhostAgent Server answers notify commands in session.
+                (server, port) = self.get_machine_server_addr(command)
+            res = self._session_execute(server, port, command,
+                                        res_bool, timeout)
+        if res is None:
+            res = misc.remote_execute(server, port, command,
+                                      isrecv=is_recv,
+                                      resbool=res_bool,
+                                      timeout=timeout)
         self.restore_attrs(arg_dict_org)
 
         if not notify_cmd_flag:
@@ -287,6 +314,68 @@ class GhostCenter:
                 res = "None"
         return res
 
+    def _session_execute(self, server, port, command, res_bool, timeout):
+        """
+        Same as :func:`misc.remote_execute`, but through the session to
+        server. Return None if the server doesn't support sessions.
+
+        If a reused session is broken, e.g. it is closed by server after
+        idle, the command is retried once in a new session.
+        """
+        if (server, port) in self._session_refused:
+            return None
+        session = self._sessions.get((server, port))
+        reused = session is not None
+        try:
+            if session is None:
+                session = self._new_session(server, port)
+            try:
+                recv_data = session.request(command, timeout)
+            except (socket.timeout, wire.SessionRefusedError):
+                raise
+            except (wire.WireError, socket.error), error:
+                if not reused:
+                    raise
+                LOGGER.warning("Session to server<%s>, port<%s> is broken:"
+                               " %s, retry in a new session."
+                               % (server, port, error))
+                session.close()
+                session = self._new_session(server, port)
+                recv_data = session.request(command, timeout)
+            LOGGER.debug("Session Result: %s" % (recv_data))
+            return [recv_data, True][res_bool]
+        except wire.SessionRefusedError, error:
+            LOGGER.warning("%s, use legacy connection instead." % (error))
+            self._session_refused.add((server, port))
+            self._sessions.pop((server, port), None)
+            return None
+        except socket.timeout:
+            LOGGER.error("Timeout in session, server<%s>, port<%s>, cmd<%s>"
+                         % (server, port, command))
+            return [socket.timeout, False][res_bool]
+        except Exception, error:
+            LOGGER.error("%s: %s" % (error.__class__.__name__, error))
+            return [Exception(error), False][res_bool]
+
+    def _new_session(self, server, port):
+        """
+        Open a session to server, and keep it for the following commands.
+        """
+        ipaddr = misc.gethostipbyname(server)
+        session = wire.Session((ipaddr, port))
+        self._sessions[(server, port)] = session
+        return session
+
+    def close(self):
+        """
+        Close all sessions, see `persistent` parameter.
+        """
+        for session in self._sessions.values():
+            session.close()
+        self._sessions.clear()
+        self._event_targets.clear()
+        return
+
     def _base_cmd_nonblock(self, command, **args):
         """
         Execute base command and do not wait returned value.
@@ -321,12 +410,15 @@ class GhostCenter:
 
     def get_machineID_by_name(self, machine_name):
         """Get machine ID via machine name."""
-        machineID = None
-        result = db.run_query_sql("select MachineID from Machine_Info"
-                                  " where MachineName = '%s'" % (machine_name))
-        if result:
-            machineID = int(result[0][0])
-        return machineID
+        def _query():
+            result = db.run_query_sql(
+                "select MachineID from Machine_Info"
+                " where MachineName = '%s'" % (machine_name))
+            if result:
+                return tuple(result[0])
+        row = ref_cache.get('Machine_Info', ('id', machine_name.lower()),
+                            _query, lambda row: ('MachineID', row[0]))
+        return int(row[0]) if row else None
 
     def get_machineID(self, cmd_line):
         """Get machine ID from cmd_line"""
@@ -346,13 +438,15 @@ class GhostCenter:
         """
         This is used to query machine name.
         """
-        name = None
-        sql_str = ("select MachineName from Machine_Info"
-                   " where MachineID=%s" % (machineID))
-        result = db.run_query_sql(sql_str)
-        if result:
-            name = result[0][0].lower()
-        return name
+        def _query():
+            sql_str = ("select MachineName from Machine_Info"
+                       " where MachineID=%s" % (machineID))
+            result = db.run_query_sql(sql_str)
+            if result:
+                return tuple(result[0])
+        row = ref_cache.get('Machine_Info', ('name', str(machineID)), _query,
+                            ('MachineID', machineID))
+        return row[0].lower() if row else None
 
     def get_machine_name(self, machine_name_or_id):
         name = None
@@ -371,43 +465,48 @@ class GhostCenter:
         """
         Get the address of GhostAgent Server, related with this image.
         """
-        serverID = None
-        result = db.run_query_sql("select ServerID from Machine_Reimage"
-                                  " where MachineID = %d and OSID = %d"
-                                  % (machineID, OSID))
-        if result:
-            serverID = int(result[0][0])
-        server_addr = None
-        result = db.run_query_sql("select ServerName, ServerPort from"
-                                  " GhostServer where ServerID = %d"
-                                  % (serverID))
-        if result:
-            server_addr = (result[0][0], int(result[0][1]))
-        return server_addr
+        def _query():
+            serverID = None
+            result = db.run_query_sql("select ServerID from Machine_Reimage"
+                                      " where MachineID = %d and OSID = %d"
+                                      % (machineID, OSID))
+            if result:
+                serverID = int(result[0][0])
+            server_addr = None
+            result = db.run_query_sql("select ServerName, ServerPort from"
+                                      " GhostServer where ServerID = %d"
+                                      % (serverID))
+            if result:
+                server_addr = (result[0][0], int(result[0][1]))
+            return server_addr
+        return ref_cache.get(('Machine_Reimage', 'GhostServer'),
+                             ('ga_addr', str(machineID), str(OSID)), _query)
 
     def get_gs_port(self, server_name):
         """
         Get the port of GhostAgent Server.
         """
-        server_port = None
-        result = db.run_query_sql("select ServerPort from GhostServer"
-                                  " where ServerName = '%s'"
-                                  % (server_name))
-        if result:
-            server_port = int(result[0][0])
-        return server_port
+        def _query():
+            result = db.run_query_sql("select ServerPort from GhostServer"
+                                      " where ServerName = '%s'"
+                                      % (server_name))
+            if result:
+                return int(result[0][0])
+        return ref_cache.get('GhostServer', ('port', server_name.lower()),
+                             _query)
 
     def get_ns_port(self, server_name):
         """
         Get the port of :class:`nicu.notify.NotifyServer`.
         """
-        server_port = None
-        result = db.run_query_sql(
-            "select NotifyPort from NotifyServer where ServerName = '%s'"
-            " and Type = 'GhostAgent'" % (server_name))
-        if result:
-            server_port = int(result[0][0])
-        return server_port
+        def _query():
+            result = db.run_query_sql(
+                "select NotifyPort from NotifyServer where ServerName = '%s'"
+                " and Type = 'GhostAgent'" % (server_name))
+            if result:
+                return int(result[0][0])
+        return ref_cache.get('NotifyServer', ('port', server_name.lower()),
+                             _query)
 
     def get_machine_server_addr(self, command, notify_cmd_flag=False):
         """
@@ -466,6 +565,42 @@ class GhostCenter:
             return False
         return True
 
+    def _resolve_event_target(self, machine_name_or_id, server_name=''):
+        """
+        Resolve (machine name, machine ID, server name, whether server keeps
+        running) of the target machine. If `server_name` is empty, it's the
+        `GhostAgent Server` related with current image of the machine.
+
+        The result is memoized in :meth:`wait_event_finish`, or until
+        :meth:`close` if `persistent` is True, so that repeated status
+        queries don't resolve them again.
+        """
+        key = (str(machine_name_or_id).lower(), server_name)
+        target = self._event_targets.get(key)
+        if target:
+            return target
+        machine_name = self.get_machine_name(machine_name_or_id)
+        machineID = self.get_machineID_by_name(machine_name)
+        if not server_name:
+            OSID = self.get_machine_OSID(machineID)
+            server_name = self.get_image_ga_server_addr(machineID, OSID)[0]
+        target = (machine_name, machineID, server_name,
+                  self.is_server_keep_run(server_name))
+        if self._memo_depth > 0 or self.persistent:
+            self._event_targets[key] = target
+        return target
+
+    def _forget_event_target(self, machine_name_or_id):
+        """
+        Drop memoized targets of the machine, since it may be moved to
+        another server, e.g. after ghosted.
+        """
+        name_or_id = str(machine_name_or_id).lower()
+        for key in self._event_targets.keys():
+            if key[0] == name_or_id:
+                del self._event_targets[key]
+        return
+
     def get_ghost_db_status(self, server_name, machineID):
         """
         Get ghost status from database.
@@ -1408,19 +1543,18 @@ class GhostCenter:
                     "No machine or integrated GetCmdStat command")
 
             machine_name_or_id = base_cmd_line.split()[1]
-            machine_name = self.get_machine_name(machine_name_or_id)
-            machineID = self.get_machineID_by_name(machine_name)
             # If server name is None, set server name here, to conveniently
             # judge whether server is linux/mac physical machine or not.
+            (machine_name, machineID, target_server, keep_run) = \
+                self._resolve_event_target(machine_name_or_id, server_name)
             if not server_name:
-                OSID = self.get_machine_OSID(machineID)
-                server_name = self.get_image_ga_server_addr(machineID, OSID)[0]
+                server_name = target_server
                 args['server_name'] = server_name
 
             # If server is deployed in linux/mac physical machine,
             # it will be shut down when ghost a machine.
             # So, we can only get status from Ghost_Info table.
-            if not self.is_server_keep_run(server_name):
+            if not keep_run:
                 res = self.get_ghost_db_status(server_name, machineID)
                 return res
 
@@ -1437,12 +1571,68 @@ class GhostCenter:
                            'InstallFailed']:
                 raise Exception(
                     "Ghost notification \"%s\" nonexistence" % (base_cmd_line))
+            if res in ['None', 'Timeout']:
+                self._forget_event_target(machine_name_or_id)
         except Exception, error:
+            self._forget_event_target(machine_name_or_id)
             self._deal_exception("Fail to Get Ghost Stat", error,
                                  self._get_throw_ex(**args))
             res = 'None'
         return res
 
+    def subscribe_event_stat(self, machine_name_or_id, event, timeout=-1,
+                             **args):
+        """
+        Wait until the event of target machine is finished, and return the
+        status pushed by :class:`nicu.notify.NotifyServer`, without polling.
+
+        :param timeout:
+            Seconds to wait, <=0 means waiting forever.
+
+        Returned value presents in one of three conditions:
+            #) Event is finished
+                --> Return **Passed**/**Timeout**/**InstallFailed**
+            #) Event isn't finished in `timeout` seconds
+                --> Return **InProcess**
+            #) Status can't be subscribed, e.g. notify server doesn't
+               support subscription, or server is shut down when ghosting
+                --> Return None
+
+        .. note::
+            If the event isn't in process when subscribing, its current
+            status is returned immediately, which may be of the previous
+            registration.
+        """
+        return self._subscribe_event_stat(machine_name_or_id, event, timeout,
+                                          **args)[0]
+
+    def _subscribe_event_stat(self, machine_name_or_id, event, timeout=-1,
+                              **args):
+        """
+        Same as :meth:`subscribe_event_stat`, but return (status, pushed),
+        `pushed` is False if the status is replied immediately rather than
+        pushed after subscribing.
+        """
+        server_name = args.get('server_name', self.server_name)
+        try:
+            (machine_name, machineID, server_name, keep_run) = \
+                self._resolve_event_target(machine_name_or_id, server_name)
+            if not keep_run:
+                return (None, False)
+            notify_client = NotifyClient(server_name,
+                                         self.get_ns_port(server_name))
+            (res, pushed) = notify_client.subscribe(machine_name, event,
+                                                    timeout)
+        except Exception, error:
+            LOGGER.warning("Failed to subscribe status of %s[%s]: %s"
+                           % (machine_name_or_id, event, error))
+            self._forget_event_target(machine_name_or_id)
+            return (None, False)
+        if res not in ['InProcess', 'Passed', 'Timeout', 'InstallFailed']:
+            self._forget_event_target(machine_name_or_id)
+            return (None, False)
+        return (res, pushed)
+
     def get_ghost_stat(self, machine_name_or_id='', **args):
         """
         Get current ghost status of the target machine.
@@ -1458,6 +1648,11 @@ class GhostCenter:
         """
         Wait event until finished or timeout.
 
+        The final status is pushed by :class:`nicu.notify.NotifyServer`
+        (see :meth:`subscribe_event_stat`), so it returns as soon as the
+        event is finished. If the status can't be subscribed, it falls back
+        to poll :meth:`get_event_stat`.
+
         :param machine_name_or_id:
             Machine name or machine id.
         :param event:
@@ -1499,10 +1694,49 @@ class GhostCenter:
         # Client can modify this value by passing arguments.
         repeat_count_default = args.get('repeat_count', 3)
         repeat_count = repeat_count_default
+        # Set "subscribe" as False to poll only.
+        subscribe = args.get('subscribe', True)
         start_time = time.time()
+        # Resolve the machine and its server only once in waiting.
+        self._memo_depth += 1
         try:
             stat = 'None'
             while (timeout == -1) or (time.time() - start_time < timeout):
+                if subscribe:
+                    # Subscribe in slices to check the break condition.
+                    wait_time = -1
+                    if timeout != -1:
+                        wait_time = max(1, timeout - (time.time() - start_time))
+                    if (break_condition != 'False' and
+                            not 0 < wait_time <= GHOST_SUBSCRIBE_INTERVAL):
+                        wait_time = GHOST_SUBSCRIBE_INTERVAL
+                    (stat, pushed) = self._subscribe_event_stat(
+                        machine_name_or_id, event, wait_time, **args)
+                    if stat is None:
+                        LOGGER.info('Poll status of machine %s instead'
+                                    % (machine_name_or_id))
+                        subscribe = False
+                        continue
+                    if stat != 'InProcess':
+                        # Pushed status is final, no need to check it
+                        # repeatedly.
+                        if pushed:
+                            break
+                        # The status before subscribing may be of the
+                        # previous registration, check it like polling.
+                        repeat_count -= 1
+                        if repeat_count <= 0:
+                            break
+                    else:
+                        repeat_count = repeat_count_default
+                    if eval(break_condition):
+                        LOGGER.info('Meet the breaking condition when waiting'
+                                    ' machine %s ghost finished.'
+                                    % (machine_name_or_id))
+                        break
+                    if not pushed:
+                        misc.xsleep(max(1, min(60, timeout - 2)))
+                    continue
                 stat = self.get_event_stat(machine_name_or_id, event, **args)
                 if stat in ["None", "Timeout", "Passed", "InstallFailed"]:
                     repeat_count -= 1
@@ -1545,6 +1779,10 @@ class GhostCenter:
         except Exception, error:
             self._deal_exception('', error, self._get_throw_ex(**args))
             res = errcode.ER_FAILED
+        finally:
+            self._memo_depth -= 1
+            if self._memo_depth == 0 and not self.persistent:
+                self._event_targets.clear()
         return res
 
     def wait_ghost_finish(self, machine_name_or_id='',
@@ -1558,7 +1796,7 @@ class GhostCenter:
     @classmethod
     def get_ghost_center(cls, server_name='',
                          throw_exception=False,
-                         block_timeout=0):
+                         block_timeout=0, persistent=False):
         """
         Get and initial Ghost Center.
 
@@ -1567,10 +1805,13 @@ class GhostCenter:
             If empty, it will be set temporarily, according to target machine.
         :param throw_exception:
             If failed or timeout, log it or raise exception.
+        :param persistent:
+            Whether to keep a long-lived session to the server.
         """
         ghost_center = GhostCenter(server_name=server_name,
                                    throw_exception=throw_exception,
-                                   block_timeout=block_timeout)
+                                   block_timeout=block_timeout,
+                                   persistent=persistent)
         return ghost_center
 
     def get_last_error(self, machine_name_or_id):
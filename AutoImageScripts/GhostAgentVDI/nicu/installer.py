@@ -3,6 +3,7 @@ import sys
 import stat
 import shutil
 import re
+import time
 import hashlib
 import optparse
 import datetime
@@ -13,8 +14,10 @@ import codecs
 import p4lib
 import logging
 import tempfile
+import threading
 import subprocess
 from misc import execute
+from path import get_folder_size
 # win32api needs installed
 from win32api import GetFileVersionInfo, LOWORD, HIWORD
 
@@ -649,8 +652,8 @@ class InstallerReview:
         p4path = "//NIInstallers/export/Legal/license/NIReleased"
         try:
             perforce = os.getenv('nibuild_perforce_clientspec').rstrip("\\")
-            perforce = p4lib.P4(user=os.getenv("P4USER"), client=perforce,
-                                port="perforce:1666")
+            perforce = p4lib.P4Session(user=os.getenv("P4USER"),
+                                       client=perforce, port="perforce:1666")
             perforce.sync(p4path + "/...", force=True)
             f1 = perforce.files(files=p4path + "/NI Released License"
                                 " Agreement...rtf")
@@ -1035,6 +1038,19 @@ class ICE:
     ICELogFile = "ice.log"
     # The scan result name
     ScanLogFile = "scan.xml"
+    # The max count of items syncing from one p4 server at the same time
+    SyncServerMaxCount = 2
+    # The cookie which records the changelist of a synced export
+    SyncCookieFile = "cookie.sync.p4"
+    # The cache of mini product sets, shared by runs on this machine
+    MiniTreeCacheRoot = os.path.join(tempfile.gettempdir(), "ICEMiniTree")
+    # The max total size of cached mini product sets, in bytes
+    MiniTreeCacheMaxSize = 10 * 1024 ** 3
+    # Cached mini product sets used in these seconds are never evicted
+    MiniTreeCacheMinAge = 10 * 60
+    # In-use marks of mini product sets older than these seconds are left
+    # by crashed runs, and ignored
+    MiniTreeCacheInUseTimeout = 24 * 60 * 60
 
     def __init__(self, root, products, output="", MIF=None,
                  iBuild=None, debug=False):
@@ -1051,6 +1067,8 @@ class ICE:
         self.debug = debug
         self.minitree = None
         self.ForceSync = False
+        self._toolchain_lock = threading.Lock()
+        self._toolchain_dir = None
 
     def prepare_env_ice(self, output):
         '''
@@ -1061,15 +1079,15 @@ class ICE:
         '''
 
         # Initialize the pacific, perforce and penguin
-        self.pacific = p4lib.P4(user=os.getenv("P4USER"), client=os.getenv
-                                ("nibuild_pacific_clientspec"),
-                                port="pacific:1666")
-        self.perforce = p4lib.P4(user=os.getenv("P4USER"), client=os.getenv
-                                 ('nibuild_perforce_clientspec'),
-                                 port="perforce:1666")
-        self.penguin = p4lib.P4(user=os.getenv("P4USER"), client=os.getenv
-                                ('nibuild_penguin_clientspec'),
-                                port="penguin:1666")
+        self.pacific = p4lib.P4Session(user=os.getenv("P4USER"), client=os.getenv
+                                       ("nibuild_pacific_clientspec"),
+                                       port="pacific:1666")
+        self.perforce = p4lib.P4Session(user=os.getenv("P4USER"), client=os.getenv
+                                        ('nibuild_perforce_clientspec'),
+                                        port="perforce:1666")
+        self.penguin = p4lib.P4Session(user=os.getenv("P4USER"), client=os.getenv
+                                       ('nibuild_penguin_clientspec'),
+                                       port="penguin:1666")
 
         # Find the 7-Zip path
         try:
@@ -1187,7 +1205,7 @@ class ICE:
         self.minitree = rt
         LOGGER.info("create mini tree: %s", rt)
         try:
-            self.create_mini_product(rt)
+            self.get_mini_product(rt)
             # Step 4 Run ICE check
             ts = datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S")
             ruby = self.perforce.where(rubyexe)[0]["localFile"]
@@ -1233,12 +1251,21 @@ class ICE:
             if not self.debug:
                 shutil.rmtree(rt, True)                     # ignore error
                 self.minitree = None
+            LOGGER.debug("p4 where/dirs lookups saved: %d", sum(
+                [p4.savedSpawns for p4 in (self.pacific, self.perforce,
+                                           self.penguin)]))
+            for p4 in (self.pacific, self.perforce, self.penguin):
+                p4.close()
 
     def create_mini_product(self, rt):
         '''
         Create a mini product set to the temp path. The mini product
         set only contains products that we want to check.
+
+        Return False if merged.bin.msi fails to be created, so that the
+        incomplete set is used only once, but not cached.
         '''
+        complete = True
         for p in self.products:
             src = os.path.join(self.root, 'Products', p)
             dst = os.path.join(rt, "Products", p)
@@ -1262,15 +1289,17 @@ class ICE:
             if not os.path.exists(f):
                 LOGGER.error("unzip %s cause error!", src)
                 raise Exception("unzip error")
+        msiformat = f + ".msi"
         try:
-            msiformat = f + ".msi"
             # this is for ICE test, it requires file surffix to be .msi
             shutil.copy(f, msiformat)
-            if not msiformat:
+            if not os.path.exists(msiformat):
                 LOGGER.error("create file fail: %s", msiformat)
+                complete = False
         except:
             LOGGER.error("create %s fail! This will result ice"
                          "check missing on merged.bin.", msiformat)
+            complete = False
         # remove READONLY attribute from mini product set
         # if the depot is readonly, smoke.exe will fail,
         # reporting temp.xml access rejected.
@@ -1278,6 +1307,153 @@ class ICE:
             for file_name in files:
                 full_path = os.path.join(r, file_name)
                 os.chmod(full_path, stat.S_IWRITE)
+        return complete
+
+    def get_mini_product_digest(self):
+        '''
+        Get the digest of the source product set of the mini product set,
+        from the root and (path, size, modified time) of all source files.
+        '''
+        md5 = hashlib.md5()
+        md5.update("%s\n" % os.path.normcase(os.path.abspath(self.root)))
+        srcs = [os.path.join('Products', p) for p in sorted(self.products)]
+        srcs += [os.path.join("Bin", "merged.bin"),
+                 os.path.join("Bin", "merged.cab")]
+        for src in srcs:
+            full_src = os.path.join(self.root, src)
+            if os.path.isfile(full_src):
+                files = [full_src]
+            else:
+                files = []
+                for r, d, file_names in os.walk(full_src):
+                    d.sort()
+                    files.extend([os.path.join(r, file_name)
+                                  for file_name in sorted(file_names)])
+            md5.update("%s\n" % src)
+            for f in files:
+                st = os.stat(f)
+                md5.update("%s|%d|%d\n" % (os.path.relpath(f, full_src),
+                                            st.st_size, int(st.st_mtime)))
+        return md5.hexdigest()
+
+    def get_mini_product(self, rt):
+        '''
+        Copy a mini product set to the temp path from the cache, which is
+        keyed by digest of the source product set. If it's not cached, it
+        is created by :meth:`create_mini_product` into the cache first.
+
+        The cached one is never used directly, since ICE check may change
+        the mini product set.
+        '''
+        digest = self.get_mini_product_digest()
+        entry = os.path.join(ICE.MiniTreeCacheRoot, digest)
+        if not os.path.isdir(ICE.MiniTreeCacheRoot):
+            try:
+                os.makedirs(ICE.MiniTreeCacheRoot)
+            except OSError:
+                # Created by another run at the same time.
+                pass
+        # Mark the entry in use before checking it, so that it's not
+        # evicted by another run while being built or copied.
+        (fd, in_use) = tempfile.mkstemp(prefix=digest + ".inuse_",
+                                        dir=ICE.MiniTreeCacheRoot)
+        os.close(fd)
+        try:
+            if os.path.isdir(entry):
+                LOGGER.info("use cached mini tree: %s", entry)
+            else:
+                building = tempfile.mkdtemp(prefix="building_",
+                                            dir=ICE.MiniTreeCacheRoot)
+                try:
+                    if not self.create_mini_product(building):
+                        LOGGER.warning("mini tree is incomplete, "
+                                       "not cached: %s", building)
+                        self._copy_mini_product(building, rt)
+                        return
+                    try:
+                        os.rename(building, entry)
+                    except OSError:
+                        # Created by another run at the same time.
+                        if not os.path.isdir(entry):
+                            raise
+                    LOGGER.info("cache mini tree: %s", entry)
+                finally:
+                    shutil.rmtree(building, True)
+                self.evict_mini_products(entry)
+            self._copy_mini_product(entry, rt)
+            # Touch the mark of entry for LRU eviction.
+            with open(entry + ".used", "w"):
+                pass
+        finally:
+            os.remove(in_use)
+
+    def _copy_mini_product(self, src_root, rt):
+        '''
+        Copy all files and folders of a mini product set to `rt`.
+        '''
+        for name in os.listdir(src_root):
+            src = os.path.join(src_root, name)
+            dst = os.path.join(rt, name)
+            if os.path.isdir(src):
+                shutil.copytree(src, dst)
+            else:
+                shutil.copy2(src, dst)
+
+    def evict_mini_products(self, keep):
+        '''
+        Remove least recently used mini product sets from the cache, until
+        total size is less than `MiniTreeCacheMaxSize`, except `keep` and
+        the ones used in `MiniTreeCacheMinAge` seconds.
+        '''
+        min_used_time = time.time() - ICE.MiniTreeCacheMinAge
+        total_size = 0
+        entries = []
+        for name in os.listdir(ICE.MiniTreeCacheRoot):
+            entry = os.path.join(ICE.MiniTreeCacheRoot, name)
+            if name.startswith("building_") or not os.path.isdir(entry):
+                continue
+            size = get_folder_size(entry)
+            if os.path.exists(entry + ".used"):
+                used_time = os.path.getmtime(entry + ".used")
+            else:
+                used_time = os.path.getmtime(entry)
+            total_size += size
+            entries.append((used_time, entry, size))
+        entries.sort()
+        for used_time, entry, size in entries:
+            if total_size <= ICE.MiniTreeCacheMaxSize:
+                break
+            if (entry == keep or used_time > min_used_time or
+                    self._mini_product_in_use(entry)):
+                continue
+            LOGGER.info("remove cached mini tree: %s", entry)
+            shutil.rmtree(entry, True)
+            if os.path.exists(entry + ".used"):
+                os.remove(entry + ".used")
+            total_size -= size
+
+    def _mini_product_in_use(self, entry):
+        '''
+        Whether a cached mini product set is being built or copied by any
+        run. In-use marks older than `MiniTreeCacheInUseTimeout` are left by
+        crashed runs, and removed.
+        '''
+        prefix = os.path.basename(entry) + ".inuse_"
+        stale_time = time.time() - ICE.MiniTreeCacheInUseTimeout
+        in_use = False
+        for name in os.listdir(ICE.MiniTreeCacheRoot):
+            if not name.startswith(prefix):
+                continue
+            mark = os.path.join(ICE.MiniTreeCacheRoot, name)
+            try:
+                if os.path.getmtime(mark) > stale_time:
+                    in_use = True
+                else:
+                    os.remove(mark)
+            except OSError:
+                # Removed by its run at the same time.
+                pass
+        return in_use
 
     def remove_readonly_file(self, f):
         '''
@@ -1441,37 +1617,91 @@ class ICE:
         and I choose the 1.8.1f2 ibuild for setupEnv.bat
         '''
         toolchain = r"//sa/ss/build/export/1.8/1.8.1f2"  # perforce
-        self.perforce.sync(toolchain + "/...", force=self.ForceSync)
-        local_toolchain_dir = self.perforce.where(toolchain)[0]["localFile"]
+        # Items may be synced concurrently, sync the toolchain only once.
+        with self._toolchain_lock:
+            if self._toolchain_dir is None:
+                self._toolchain_dir = \
+                    self.perforce.where(toolchain)[0]["localFile"]
+                change = self.get_head_change(self.perforce, toolchain)
+                if self.is_synced(self._toolchain_dir, change):
+                    LOGGER.info("%s is up to date at change %s.",
+                                toolchain, change)
+                else:
+                    self.perforce.sync(toolchain + "/...",
+                                       force=self.ForceSync)
+                    self.write_sync_cookie(self._toolchain_dir, change)
+        local_toolchain_dir = self._toolchain_dir
         # sync para, whether this is a force sync or not
         sync_para = ''
         if self.ForceSync:
             sync_para += ' --force'
-        if (server=='perforce'):
-            local_path = self.perforce.where(path)[0]["localFile"]
-        elif (server=='penguin'):
-            local_path = self.penguin.where(path)[0]["localFile"]
-        else:
-            local_path = self.pacific.where(path)[0]["localFile"]
-
-        if os.path.exists(local_path):
-            for file_name in os.listdir(local_path):
-                if file_name.startswith(r'cookie.sync'):
-                    LOGGER.info("%s has existed in this machine.", path)
-                    return
+        p4 = getattr(self, server)
+        local_path = p4.where(path)[0]["localFile"]
+
+        # Only sync when the export is changed since the last sync, even if
+        # it's a force sync.
+        change = self.get_head_change(p4, path)
+        if self.is_synced(local_path, change):
+            LOGGER.info("%s is up to date at change %s.", path, change)
+            return
 
         export_path = server + ':' + path.rstrip("/") + "/..."
         sync_export = ('cd /d "%s" && setupEnv.bat && p4sync %s "%s"' %
                        (local_toolchain_dir, sync_para, export_path))
         LOGGER.info("Run script to sync export (know about export on"
                     "file server):\n%s", sync_export)
-        execute(sync_export)
-        with open(local_path+r'\cookie.sync.p4', "w"):
-            pass
+        ret = execute(sync_export)
+        if ret:
+            LOGGER.error("fail to sync export %s, return %s", export_path,
+                         ret)
+            raise Exception("fail to sync export %s, return %s"
+                            % (export_path, ret))
+        self.write_sync_cookie(local_path, change)
+
+    def get_head_change(self, p4, path):
+        '''
+        Get the latest submitted changelist under the depot path, return
+        None if fail.
+        '''
+        try:
+            changes = p4.changes(path.rstrip("/") + "/...", max=1,
+                                 status="submitted")
+        except p4lib.P4LibError:
+            LOGGER.error(traceback.format_exc())
+            return None
+        if not changes:
+            return None
+        return changes[0]["change"]
+
+    def is_synced(self, local_path, change):
+        '''
+        Check whether the cookie of `local_path` records `change`, which
+        means nothing is submitted since the last sync.
+        '''
+        if change is None:
+            return False
+        cookie = os.path.join(local_path, ICE.SyncCookieFile)
+        try:
+            with open(cookie) as f:
+                return f.read().strip() == str(change)
+        except IOError:
+            return False
+
+    def write_sync_cookie(self, local_path, change):
+        '''
+        Record the synced `change` in the cookie of `local_path`.
+        '''
+        if change is None or not os.path.isdir(local_path):
+            return
+        with open(os.path.join(local_path, ICE.SyncCookieFile), "w") as f:
+            f.write(str(change))
 
     def do_syncing(self, items):
         '''
         Sync items from p4 server. Throw exception if sync fail.
+        Items are synced concurrently, at most `SyncServerMaxCount` items
+        from one server at the same time, and the exception reports all
+        failed items.
 
         Param items
             Is a list of the structure (path, server, type)
@@ -1486,17 +1716,51 @@ class ICE:
                     Release/DistScanner.exe", perforce, 'file')
                     ])
         '''
-        for path_server_type in items:
-            path, server_name, item_type = path_server_type
-            server = getattr(self, server_name)
-            if item_type == 'dir':
-                LOGGER.info("syncing %s%s ... ", server_name, path)
-                server.sync(path + "/...", force=self.ForceSync)
-                self.sync_export(path, server_name)
-            elif item_type == 'file':
-                LOGGER.info("syncing %s%s ... ", server_name, path)
-                server.sync(path, force=self.ForceSync)
-            else:
+        for path, server_name, item_type in items:
+            if item_type not in ('dir', 'file'):
                 LOGGER.error("p4: %s, file: %s, type: %s",
                              server_name, path, item_type)
                 raise Exception('bad parameter, only "dir/file" are allowed')
+
+        semaphores = {}
+        for path, server_name, item_type in items:
+            semaphores[server_name] = threading.Semaphore(
+                ICE.SyncServerMaxCount)
+        failures = []
+        threads = []
+        for item in items:
+            thread = threading.Thread(target=self._sync_item,
+                                      args=(item, semaphores[item[1]],
+                                            failures))
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            while thread.isAlive():
+                thread.join(1)
+        if failures:
+            raise Exception('fail to sync %d of %d items:\n%s'
+                            % (len(failures), len(items), '\n'.join(failures)))
+
+    def _sync_item(self, path_server_type, semaphore, failures):
+        '''
+        Sync one item of :meth:`do_syncing`, holding `semaphore` of its
+        server. The error is appended to `failures` if sync fail.
+        '''
+        path, server_name, item_type = path_server_type
+        server = getattr(self, server_name)
+        with semaphore:
+            start_time = time.time()
+            try:
+                LOGGER.info("syncing %s%s ... ", server_name, path)
+                if item_type == 'dir':
+                    server.sync(path + "/...", force=self.ForceSync)
+                    self.sync_export(path, server_name)
+                else:
+                    server.sync(path, force=self.ForceSync)
+                LOGGER.info("synced %s%s in %.1f seconds", server_name, path,
+                            time.time() - start_time)
+            except Exception, error:
+                LOGGER.error("fail to sync %s%s:\n%s", server_name, path,
+                             traceback.format_exc())
+                failures.append('%s%s: %s' % (server_name, path, error))
@@ -15,6 +15,8 @@ except NameError:
     from sets import Set as set
 
 import errcode
+import config
+import wire
 
 
 logger = logging.getLogger(__name__)
@@ -107,11 +109,16 @@ def execute(cmd, workdir=None):
 
 
 def remote_execute(hostname, port, cmd, ipaddr=None,
-                   isrecv=False, resbool=True, timeout=-1):
+                   isrecv=False, resbool=True, timeout=-1, framed=None):
     """
     Execute a command on remote host.
     Improve this function with socket of nonblock mode,
     to make sure this function can be used in killable thread.
+
+    :param framed:
+        Whether to send the command in frame mode (see :mod:`nicu.wire`),
+        default is :const:`config.WIRE_FRAMED`. If the remote host doesn't
+        support it, legacy text is sent instead.
     """
     res = None
     recv_data = ""
@@ -119,25 +126,36 @@ def remote_execute(hostname, port, cmd, ipaddr=None,
     logger.info("Remote_execute: %s, %s, %s, %s" %
                 (cmd, isrecv, resbool, timeout))
     try:
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         if not ipaddr:
             ipaddr = gethostipbyname(hostname)
         logger.info("Execute command %s on host with IP %s" % (cmd, ipaddr))
-        client_socket.connect((ipaddr, port))
-        client_socket.send(cmd)
-        import time
-        time.sleep(1)
-        client_socket.setblocking(0)
-        if isrecv:
-            loop_count = 0
-            infds, outfds, errfds = ([], [], [])
-            while not infds:
-                if timeout > 0 and loop_count >= timeout:
-                    raise socket.timeout()
-                infds, outfds, errfds = select.select([client_socket],
-                                                      [], [], 1)
-                loop_count += 1
-            recv_data = client_socket.recv(1024)
+        if framed is None:
+            framed = config.WIRE_FRAMED
+        if framed and not wire.is_legacy((ipaddr, port)):
+            try:
+                recv_data = wire.exchange((ipaddr, port), cmd, isrecv, timeout)
+                framed = True
+            except wire.NegotiationError, error:
+                logger.info("%s, use legacy text instead." % (error))
+                framed = False
+        else:
+            framed = False
+        if not framed:
+            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            client_socket.connect((ipaddr, port))
+            client_socket.send(cmd)
+            time.sleep(1)
+            client_socket.setblocking(0)
+            if isrecv:
+                loop_count = 0
+                infds, outfds, errfds = ([], [], [])
+                while not infds:
+                    if timeout > 0 and loop_count >= timeout:
+                        raise socket.timeout()
+                    infds, outfds, errfds = select.select([client_socket],
+                                                          [], [], 1)
+                    loop_count += 1
+                recv_data = client_socket.recv(1024)
         res = [recv_data, True][resbool]
         logger.debug("Remote_execute Result: %s" % (res))
     except socket.timeout:
@@ -40,6 +40,13 @@ There are three important differences between this version and previous version.
             #) GetCmdStat MachineName/MachineID Event
                 This is used to query status from notify server of certain
                 machine with certain event.
+            #) SubscribeCmd MachineName/MachineID [Event]
+                This is used to wait the status of certain machine with
+                certain event. The connection is kept open, and the final
+                status is pushed once the event is finished or timeout.
+                If it isn't in process when subscribing, "Current <Status>"
+                is replied immediately, which may be the status of the
+                previous registration.
         While, new communicating protocol is quite different from previous, but
         we cann't obsolete instantly since that we can't make sure all the
         services update their codes to the latest code at the same time.
@@ -61,6 +68,7 @@ There are three important differences between this version and previous version.
 
 import os
 import sys
+import errno
 import traceback
 import socket
 import select
@@ -68,17 +76,22 @@ import logging
 import time
 import shlex
 import getopt
+import heapq
+import threading
 
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 from nicu.misc import xsleep, gethostipbyname
+import nicu.wire as wire
 try:
     import nicu.config as config
     from nicu.decor import asynchronized
     from nicu.db import init_db, SQLServerDB
+    from nicu.refcache import ref_cache
 except:
     pass
 
 __all__ = [
+    "Subscription",
     "NotifyServer",
     "NotifyClient",
     "client_send",
@@ -86,16 +99,55 @@ __all__ = [
 
 LOGGER = logging.getLogger(__name__)
 
+# Prefix of the status replied immediately to SubscribeCmd, rather than
+# pushed after subscribing.
+CURRENT_STATUS_PREFIX = 'Current'
+# Bytes to receive from a readable connection at a time.
+_RECV_SIZE = 65536
+# Seconds to wait a client to receive the reply.
+_SEND_TIMEOUT = 10
+
+
+class Subscription(object):
+    """
+    Interest of one waiter in the final status of a machine with certain
+    event. The waiter is either a thread in this process, or a socket of
+    remote client which the status is pushed to.
+    """
+    def __init__(self, key, sock=None, framed=False):
+        self.key = key
+        self.sock = sock
+        self.framed = framed
+        self.status = None
+        self._finished = threading.Event()
+
+    def wait(self, timeout=None):
+        """
+        Wait until the status is pushed, return whether it is pushed.
+        """
+        self._finished.wait(timeout)
+        return self._finished.isSet()
+
+    def finish(self, status):
+        self.status = status
+        self._finished.set()
+
 
 class NotifyServer():
     """
     Initial NotifyServer, which will start two threads automatically:
         #) Thead 1: poll thread
-            Poll whether notification is timeout or expired.
+            Sweep notifications which are timeout. The deadlines are kept
+            in a heap, which is loaded from database at startup, so the
+            thread only wakes when the next deadline is due.
         #) Thead 2: handle thread
             Provide querying current status of machine with certain event,
             or accept the status from notify client with certain event.
 
+    Once a notification is finished (or timeout), its status is pushed to all
+    subscriptions of it, so waiters don't need to poll database, which keeps
+    the record only for durability.
+
     :param server_name:
         The name of notify server.
     :param server_type:
@@ -103,7 +155,8 @@ class NotifyServer():
     :param platform:
         The platform where this notify server deployed in.
     :param poll_interval:
-        The interval time to poll.
+        The interval time to poll. It's kept for compatibility, since
+        timeouts are swept when they are due.
 
     Every notification will go through two phases in sequence:
         * Phase 1(**Register Phase**):
@@ -144,6 +197,14 @@ class NotifyServer():
                           'InstallFailed']
         # This is only for compatibility with previous notify.py
         self._default_event = 'GhostClient'
+        # {(machine name, event): [Subscription, ...]}
+        self._subscriptions = {}
+        self._sub_lock = threading.Lock()
+        # Heap of (deadline, (machine name, event)), and the valid deadline
+        # of each key. Entries not matching the valid deadline are stale.
+        self._deadlines = []
+        self._deadline_keys = {}
+        self._deadline_cond = threading.Condition(threading.Lock())
 
         (self.server_id, self.server_port) = self._get_ns_info()
 
@@ -200,7 +261,10 @@ class NotifyServer():
         try:
             sql_str = ("select MachineID from Machine_Info"
                        " where MachineName='%s'" % (name))
-            (machine_id, ) = SQLServerDB.query_one(sql_str)
+            (machine_id, ) = ref_cache.get(
+                'Machine_Info', ('id', name.lower()),
+                lambda: SQLServerDB.query_one(sql_str),
+                lambda row: ('MachineID', row[0]))
         except Exception, error:
             LOGGER.error('Failed to query table Machine_Info "%s": %s'
                          % (sql_str, error))
@@ -218,7 +282,10 @@ class NotifyServer():
         try:
             sql_str = ("select MachineName from Machine_Info"
                        " where MachineID=%s" % (machine_id))
-            (name, ) = SQLServerDB.query_one(sql_str)
+            (name, ) = ref_cache.get(
+                'Machine_Info', ('name', str(machine_id)),
+                lambda: SQLServerDB.query_one(sql_str),
+                ('MachineID', machine_id))
             name = name.lower()
         except Exception, error:
             LOGGER.error('Failed to query table Machine_Info "%s": %s'
@@ -398,10 +465,16 @@ class NotifyServer():
             #) block mode: Return status
         """
         event = self._compatible_event(event)
+        subscription = None
         try:
             name = self._get_machine_name(machine_name_or_id)
+            if is_block:
+                # Subscribe before registering, so that the finish is never
+                # missed.
+                subscription = self.subscribe(name, event)
+            start_time_sec = int(time.time())
             start_time = time.strftime('%Y-%m-%d %H:%M:%S',
-                                       time.localtime(time.time()))
+                                       time.localtime(start_time_sec))
             record = self._query_db(name, event)
             if record:
                 res = self._operate_db('update', name, 'InProcess',
@@ -424,19 +497,244 @@ class NotifyServer():
                     LOGGER.info('Register notification "%s", '
                                 'New:[Start:%s, TimeOut:%ds, Event:%s]'
                                 % (name, start_time, timeout, event))
+            if res:
+                self._schedule(name, event, start_time_sec, timeout)
         except Exception, error:
             LOGGER.error("Failed to register new notification \"%s\"[%s]: %s"
                          % (machine_name_or_id, event, error))
             LOGGER.error(traceback.format_exc())
+            if subscription:
+                self.unsubscribe(subscription)
             return False if not is_block else 'None'
         if not is_block:
             return True
-        # block until finished or time out
-        record = self._query_db(name, event)
-        while record and record['Status'] == 'InProcess':
-            xsleep(1)
-            record = self._query_db(name, event)
-        return record['Status'] if record else 'None'
+        # block until finished or time out, the status is pushed by
+        # accept() or poll(). The record is also queried every
+        # `config.NOTIFY_REQUERY_INTERVAL` seconds, in case it is finished
+        # by others, e.g. another notify server.
+        try:
+            if not res:
+                return self.query(name, event)
+            end_time_sec = start_time_sec + timeout + config.NOTIFY_WAIT_MARGIN
+            slices = 0
+            while not subscription.wait(1):
+                slices += 1
+                expired = timeout >= 0 and time.time() > end_time_sec
+                if slices % config.NOTIFY_REQUERY_INTERVAL and not expired:
+                    continue
+                status = self.query(name, event)
+                if status != 'InProcess':
+                    return status
+                if expired:
+                    LOGGER.warning('Notification "%s"[%s] is still in process'
+                                   ' after timeout %ds' % (name, event, timeout))
+                    return 'Timeout'
+            return subscription.status
+        finally:
+            self.unsubscribe(subscription)
+
+    def subscribe(self, machine_name_or_id, event=None, sock=None,
+                  framed=False):
+        """
+        Subscribe the final status of this machine with certain event.
+
+        :param sock:
+            The socket to push status to. If None, wait the returned
+            :class:`Subscription` in this process.
+        :param framed:
+            Whether to push status in frame mode, see :mod:`nicu.wire`.
+        :returns: :class:`Subscription`
+        """
+        name = self._get_machine_name(machine_name_or_id)
+        key = (name, self._compatible_event(event))
+        subscription = Subscription(key, sock, framed)
+        self._sub_lock.acquire()
+        try:
+            self._subscriptions.setdefault(key, []).append(subscription)
+        finally:
+            self._sub_lock.release()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Remove the subscription, return False if it has been finished.
+        """
+        self._sub_lock.acquire()
+        try:
+            subscriptions = self._subscriptions.get(subscription.key, [])
+            if subscription not in subscriptions:
+                return False
+            subscriptions.remove(subscription)
+            if not subscriptions:
+                del self._subscriptions[subscription.key]
+            return True
+        finally:
+            self._sub_lock.release()
+
+    def _schedule(self, name, event, start_time_sec, timeout):
+        """
+        Set the deadline of this machine with certain event, which replaces
+        the previous one. Negative timeout means no deadline.
+        """
+        key = (name, self._compatible_event(event))
+        self._deadline_cond.acquire()
+        try:
+            if timeout is None or timeout < 0:
+                self._deadline_keys.pop(key, None)
+                return
+            deadline = start_time_sec + timeout
+            if self._deadline_keys.get(key) == deadline:
+                return
+            self._deadline_keys[key] = deadline
+            heapq.heappush(self._deadlines, (deadline, key))
+            if self._deadlines[0] == (deadline, key):
+                # Wake poll thread to wait for the new earliest deadline.
+                self._deadline_cond.notify()
+        finally:
+            self._deadline_cond.release()
+
+    def _unschedule(self, name, event):
+        self._deadline_cond.acquire()
+        try:
+            self._deadline_keys.pop((name, self._compatible_event(event)),
+                                    None)
+        finally:
+            self._deadline_cond.release()
+
+    def _load_deadlines(self):
+        """
+        Load deadlines of unfinished notifications from database, which are
+        not known by this server yet.
+        """
+        for row in self._query_db_unfinished():
+            name = row['MachineName'].lower()
+            event = self._compatible_event(row['Event'])
+            if row['Status'] != 'InProcess':
+                LOGGER.warning(
+                    'Notification \"%s\"[%s] should be InProcess now'
+                    % (name, event))
+            if (name, event) in self._deadline_keys:
+                continue
+            start_time_sec = time.mktime(row['StartTime'].timetuple())
+            self._schedule(name, event, start_time_sec, row['Timeout'])
+        return
+
+    def _wait_due_deadlines(self, timeout):
+        """
+        Wait until some deadlines are due, or `timeout` seconds elapsed.
+        Return keys of the due deadlines, which are removed.
+        """
+        end_time = time.time() + timeout
+        self._deadline_cond.acquire()
+        try:
+            while True:
+                now = time.time()
+                due = []
+                while self._deadlines:
+                    (deadline, key) = self._deadlines[0]
+                    if self._deadline_keys.get(key) != deadline:
+                        heapq.heappop(self._deadlines)
+                    elif now > deadline:
+                        heapq.heappop(self._deadlines)
+                        del self._deadline_keys[key]
+                        due.append(key)
+                    else:
+                        break
+                if due or now >= end_time:
+                    return due
+                wait_time = end_time - now
+                if self._deadlines:
+                    wait_time = min(wait_time,
+                                    self._deadlines[0][0] - now + 0.5)
+                self._deadline_cond.wait(wait_time)
+        finally:
+            self._deadline_cond.release()
+
+    def _publish(self, name, event, status):
+        """
+        Push the final status to all subscriptions of this machine with
+        certain event.
+        """
+        self._unschedule(name, event)
+        key = (name, self._compatible_event(event))
+        self._sub_lock.acquire()
+        try:
+            subscriptions = self._subscriptions.pop(key, [])
+        finally:
+            self._sub_lock.release()
+        for subscription in subscriptions:
+            self._push(subscription, status)
+        return
+
+    def _push(self, subscription, status):
+        subscription.finish(status)
+        if not subscription.sock:
+            return
+        try:
+            subscription.sock.settimeout(10)
+            self._reply(subscription.sock, status, subscription.framed)
+        except Exception, error:
+            LOGGER.warning('Failed to push status of "%s"[%s]: %s'
+                           % (subscription.key + (error,)))
+        finally:
+            subscription.sock.close()
+        return
+
+    def _drop_dead_subscriptions(self, key=None):
+        """
+        Remove socket subscriptions whose client has closed the socket.
+
+        :param key:
+            (machine name, event) to check, or None to check all.
+        """
+        self._sub_lock.acquire()
+        try:
+            if key is None:
+                keys = self._subscriptions.keys()
+            else:
+                keys = [key]
+            subscriptions = [subscription for k in keys
+                             for subscription in self._subscriptions.get(k, [])
+                             if subscription.sock]
+        finally:
+            self._sub_lock.release()
+        if not subscriptions:
+            return
+        socks = [subscription.sock for subscription in subscriptions]
+        try:
+            readable = select.select(socks, [], [], 0)[0]
+        except (select.error, socket.error, ValueError):
+            readable = socks
+        for subscription in subscriptions:
+            if subscription.sock not in readable:
+                continue
+            # Clients never send after subscribing, so readable means closed,
+            # except data which is left in socket.
+            try:
+                alive = bool(subscription.sock.recv(1, socket.MSG_PEEK))
+            except socket.error:
+                alive = False
+            if not alive and self.unsubscribe(subscription):
+                LOGGER.info('Drop subscription of "%s"[%s], client is gone'
+                            % subscription.key)
+                subscription.sock.close()
+        return
+
+    def _subscribe_socket(self, machine_name_or_id, event, sock, framed):
+        """
+        Subscribe for remote client. If it has been finished, reply the
+        status immediately.
+
+        :returns: Whether the socket is kept by the subscription.
+        """
+        subscription = self.subscribe(machine_name_or_id, event, sock, framed)
+        status = self.query(machine_name_or_id, event)
+        if status != 'InProcess' and self.unsubscribe(subscription):
+            # It may be not registered yet, so tell it's not pushed.
+            self._reply(sock, '%s %s' % (CURRENT_STATUS_PREFIX, status),
+                        framed)
+            return False
+        return True
 
     def accept(self, machine_name_or_id, event=None, status='Passed'):
         """
@@ -458,6 +756,7 @@ class NotifyServer():
                                    end_time=end_time, event=event)
             if res:
                 LOGGER.info('Finish notification "%s"' % (name))
+                self._publish(name, event, status)
         except Exception, error:
             LOGGER.error("Failed to process reply message \"%s\"[%s]: %s"
                          % (machine_name_or_id, event, error))
@@ -498,40 +797,73 @@ class NotifyServer():
     def poll(self):
         """
         Poll whether notification is timeout.
+
+        Deadlines are loaded from database at startup, and reloaded every
+        `config.NOTIFY_RESYNC_INTERVAL` seconds in case of any missed one.
+        Once a deadline is due, the record is checked again before it is
+        set to "Timeout", since it may be finished or registered again.
         """
         try:
+            resync_time = 0
             while True:
-                cur_time_sec = time.time()
-                cur_time = time.strftime(
-                    '%Y-%m-%d %H:%M:%S', time.localtime(cur_time_sec))
-                rows = self._query_db_unfinished()
-                for row in rows:
-                    name = row['MachineName']
-                    status = row['Status']
-                    event = self._compatible_event(row['Event'])
-                    start_time = row['StartTime']
-                    timeout = row['Timeout']
-                    if status != 'InProcess':
-                        LOGGER.warning(
-                            'Notification \"%s\"[%s] should be InProcess now'
-                            % (name, event))
-
-                    start_time_sec = time.mktime(start_time.timetuple())
-                    if timeout >= 0 and cur_time_sec - start_time_sec > timeout:
-                        self._operate_db('finish', name, 'Timeout',
-                                         end_time=cur_time, event=event)
-
-                xsleep(self.poll_interval)
+                if time.time() >= resync_time:
+                    self._drop_dead_subscriptions()
+                    self._load_deadlines()
+                    resync_time = time.time() + config.NOTIFY_RESYNC_INTERVAL
+                keys = self._wait_due_deadlines(resync_time - time.time())
+                for (name, event) in keys:
+                    self._sweep(name, event)
         except SystemExit:
             LOGGER.warning("NotifyServer Poll Thread is killed")
         LOGGER.info("Notification poll() exit")
         return
 
+    def _sweep(self, name, event):
+        """
+        Set the notification to "Timeout" if it is still in process and
+        timeout, or reschedule it with the deadline in database.
+
+        If it has been finished, e.g. by another notify server, the final
+        status is pushed to subscriptions here. If it is in process on
+        another notify server, it is only rescheduled for subscriptions.
+        """
+        self._drop_dead_subscriptions((name, self._compatible_event(event)))
+        record = self._query_db(name, event)
+        if not record:
+            return
+        if record['Status'] != 'InProcess':
+            if record['Status'] in self._statuses:
+                self._publish(name, event, record['Status'])
+            return
+        cur_time_sec = time.time()
+        start_time_sec = time.mktime(record['StartTime'].timetuple())
+        timeout = record['Timeout']
+        if record['ServerID'] != self.server_id:
+            if self._subscriptions.get((name, self._compatible_event(event))):
+                self._schedule(name, event, start_time_sec, timeout)
+            return
+        if timeout >= 0 and cur_time_sec - start_time_sec > timeout:
+            cur_time = time.strftime(
+                '%Y-%m-%d %H:%M:%S', time.localtime(cur_time_sec))
+            if self._operate_db('finish', name, 'Timeout',
+                                end_time=cur_time, event=event):
+                self._publish(name, event, 'Timeout')
+        else:
+            self._schedule(name, event, start_time_sec, timeout)
+        return
+
     @asynchronized(True)
     def handle(self):
         """
         Provide querying and updating interfaces for the status of certain
         machine with corresponding event.
+
+        The thread blocks in `select` until any socket is readable, or the
+        earliest idle session expires. Legacy text and frame connections
+        carry one message, while sessions (see :class:`nicu.wire.Session`)
+        carry any number of notifications and queries until the client
+        closes it, or it is idle for `config.NOTIFY_SESSION_IDLE_TIMEOUT`
+        seconds.
         """
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -541,73 +873,213 @@ class NotifyServer():
         LOGGER.info("Create notification server socket: %s(%s):%s" %
                     (self.server_name, self.server_ip, self.server_port))
 
-        socket_list = [server_socket]
-        while True:
-            LOGGER.debug('Waiting for new ghost client notification ...')
-            infds, outfds, errfds = ([], [], [])
-            while not infds:
-                infds, outfds, errfds = select.select(socket_list,
-                                                      [], [], 0.1)
-            for infd in infds:
-                if infd == server_socket:
-                    accept_socket, client_addr = server_socket.accept()
-                    socket_list.append(accept_socket)
-                else:
-                    try:
-                        data = infd.recv(512)
-                        cmdList = shlex.split(data)
-                        command = cmdList[0].lower()
-                        # Keep GhostFinish & GetGhostStat for compatibility
-                        if command == 'GhostFinish'.lower():
-                            machine_name_or_id = cmdList[1].lower()
-                            LOGGER.info(
-                                'Receive GhostFinish %s from %s'
-                                % (machine_name_or_id, client_addr))
-                            self.accept(machine_name_or_id, self._default_event)
-                        elif command == 'GetGhostStat'.lower():
-                            machine_name_or_id = cmdList[1].lower()
-                            LOGGER.debug(
-                                'Receive GetGhostStat %s from %s'
-                                % (machine_name_or_id, client_addr))
-                            stat = self.query(
-                                machine_name_or_id, self._default_event)
-                            infd.send(stat)
-                        # We begin to use FinishCmd to process all
-                        # notifications about task implemented.
-                        elif command == 'FinishCmd'.lower():
-                            machine_name_or_id = cmdList[1].lower()
-                            event = cmdList[2]
-                            status = cmdList[3]
-                            LOGGER.info(
-                                'Receive FinishCmd %s[%s,%s] from %s'
-                                % (machine_name_or_id, event, status, client_addr))
-                            self.accept(machine_name_or_id, event, status)
-                        # We begin to use GetCmdStat to process all queries
-                        elif command == 'GetCmdStat'.lower():
-                            machine_name_or_id = cmdList[1].lower()
-                            event = cmdList[2]
-                            LOGGER.debug(
-                                'Receive GetCmdStat %s[%s] from %s'
-                                % (machine_name_or_id, event, client_addr))
-                            stat = self.query(machine_name_or_id, event)
-                            infd.send(stat)
-                        else:
-                            LOGGER.warning(
-                                "Receive Unknown notification \"%s\" from %s"
-                                % (str(cmdList), client_addr))
-                    except SystemExit:
-                        LOGGER.warning("NotifyServer Handle Thread is killed")
-                        return
-                    except Exception, e:
-                        LOGGER.error("NotifyServer has a exception: %s" % e)
-                    finally:
-                        if infd:
+        # {socket: [client address, wire mode, last active time,
+        #           received data]}
+        connections = {}
+        try:
+            while True:
+                LOGGER.debug('Waiting for new ghost client notification ...')
+                # Wait in 1 second steps at most, so that it could be killed.
+                wait_time = 1
+                if connections:
+                    idle_deadline = (
+                        min([x[2] for x in connections.values()])
+                        + config.NOTIFY_SESSION_IDLE_TIMEOUT)
+                    wait_time = min(wait_time,
+                                    max(0, idle_deadline - time.time()))
+                infds = select.select([server_socket] + connections.keys(),
+                                      [], [], wait_time)[0]
+                for infd in infds:
+                    if infd == server_socket:
+                        try:
+                            (accept_socket, client_addr) = \
+                                server_socket.accept()
+                        except socket.error, error:
+                            LOGGER.warning("Failed to accept connection: %s"
+                                           % (error))
+                            continue
+                        # Never block the loop by one client.
+                        accept_socket.setblocking(0)
+                        connections[accept_socket] = [client_addr, None,
+                                                      time.time(), '']
+                    else:
+                        keep = self._handle_readable(infd, connections[infd])
+                        if keep is not True:
+                            del connections[infd]
+                        if keep is False:
                             infd.close()
-                        if infd in socket_list:
-                            socket_list.remove(infd)
+                self._close_idle_sessions(connections)
+        except SystemExit:
+            LOGGER.warning("NotifyServer Handle Thread is killed")
+        finally:
+            for conn in connections.keys():
+                conn.close()
+            server_socket.close()
         LOGGER.info("Notification handle() exit")
         return
 
+    def _close_idle_sessions(self, connections):
+        """
+        Close sessions (and connections never sent anything) which are idle
+        for `config.NOTIFY_SESSION_IDLE_TIMEOUT` seconds.
+        """
+        expire_time = time.time() - config.NOTIFY_SESSION_IDLE_TIMEOUT
+        for (conn, (client_addr, mode, active_time, data)) in \
+                connections.items():
+            if active_time <= expire_time:
+                LOGGER.info('Connection from %s is idle for %s seconds'
+                            % (client_addr, config.NOTIFY_SESSION_IDLE_TIMEOUT))
+                del connections[conn]
+                conn.close()
+        return
+
+    def _handle_readable(self, infd, conn_info):
+        """
+        Receive data from the readable connection without blocking, and
+        handle the messages which have been received completely.
+        Return True if the connection should be kept in select loop, None
+        if it is handed over to a subscription, or False to close it.
+
+        :param conn_info:
+            [client address, wire mode, last active time, received data]
+            of the connection, the wire mode is None before the first
+            message received.
+        """
+        client_addr = conn_info[0]
+        conn_info[2] = time.time()
+        try:
+            try:
+                data = infd.recv(_RECV_SIZE)
+            except socket.error, error:
+                if error.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return True
+                raise
+            if not data:
+                if conn_info[1] == wire.MODE_SESSION:
+                    LOGGER.debug('Session from %s is closed' % (client_addr,))
+                return False
+            conn_info[3] += data
+            if conn_info[1] is None:
+                if not wire.is_greeting(conn_info[3]):
+                    # Legacy text, only one message in a connection.
+                    return self._handle_message(infd, conn_info[3],
+                                                client_addr, False)
+                (greeting, conn_info[3]) = wire.split_greeting(conn_info[3])
+                if greeting is None:
+                    return True
+                self._send(infd, wire.accept_greeting,
+                           (wire.MODE_FRAME, wire.MODE_SESSION), greeting)
+                conn_info[1] = greeting[0]
+                if conn_info[1] == wire.MODE_SESSION:
+                    LOGGER.debug('Session from %s is created'
+                                 % (client_addr,))
+            if conn_info[1] == wire.MODE_FRAME:
+                (payload, conn_info[3]) = wire.split_frame(conn_info[3])
+                if payload is None:
+                    return True
+                return self._handle_message(infd, payload, client_addr, True)
+            # Session mode, each request is replied with its request id.
+            while True:
+                (payload, conn_info[3]) = wire.split_frame(conn_info[3])
+                if payload is None:
+                    return True
+                (req_id, data) = wire.unpack_request(payload)
+                reply = self._dispatch(data, client_addr)[0]
+                self._send(infd, wire.send_frame,
+                           wire.pack_request(req_id, reply or ''))
+        except SystemExit:
+            raise
+        except Exception, e:
+            LOGGER.error("NotifyServer has a exception: %s" % e)
+        return False
+
+    def _handle_message(self, infd, data, client_addr, framed):
+        """
+        Handle the only message of a legacy text or frame connection, and
+        return whether to keep it, see :meth:`_handle_readable`.
+        """
+        # The connection is closed or handed over to a subscription after
+        # this message, so it's unnecessary to be non-blocking any more.
+        infd.settimeout(_SEND_TIMEOUT)
+        (reply, keep_open) = self._dispatch(data, client_addr, infd, framed)
+        if reply is not None:
+            self._reply(infd, reply, framed)
+        return [False, None][keep_open]
+
+    def _send(self, sock, func, *args):
+        """
+        Call `func(sock, *args)` to send data in the non-blocking socket.
+        Replies are small, so it blocks only if the client doesn't receive.
+        """
+        sock.settimeout(_SEND_TIMEOUT)
+        try:
+            func(sock, *args)
+        finally:
+            sock.setblocking(0)
+        return
+
+    def _dispatch(self, data, client_addr, sock=None, framed=False):
+        """
+        Process one message, and return (reply, keep_open). The reply is
+        None if the command doesn't reply.
+
+        :param sock:
+            The connection which the message comes from, it's None in
+            session, where subscription is not supported.
+        """
+        cmdList = shlex.split(data)
+        command = cmdList[0].lower()
+        reply = None
+        keep_open = False
+        # Keep GhostFinish & GetGhostStat for compatibility
+        if command == 'GhostFinish'.lower():
+            machine_name_or_id = cmdList[1].lower()
+            LOGGER.info('Receive GhostFinish %s from %s'
+                        % (machine_name_or_id, client_addr))
+            self.accept(machine_name_or_id, self._default_event)
+        elif command == 'GetGhostStat'.lower():
+            machine_name_or_id = cmdList[1].lower()
+            LOGGER.debug('Receive GetGhostStat %s from %s'
+                         % (machine_name_or_id, client_addr))
+            reply = self.query(machine_name_or_id, self._default_event)
+        # We begin to use FinishCmd to process all
+        # notifications about task implemented.
+        elif command == 'FinishCmd'.lower():
+            machine_name_or_id = cmdList[1].lower()
+            event = cmdList[2]
+            status = cmdList[3]
+            LOGGER.info('Receive FinishCmd %s[%s,%s] from %s'
+                        % (machine_name_or_id, event, status, client_addr))
+            self.accept(machine_name_or_id, event, status)
+        # We begin to use GetCmdStat to process all queries
+        elif command == 'GetCmdStat'.lower():
+            machine_name_or_id = cmdList[1].lower()
+            event = cmdList[2]
+            LOGGER.debug('Receive GetCmdStat %s[%s] from %s'
+                         % (machine_name_or_id, event, client_addr))
+            reply = self.query(machine_name_or_id, event)
+        elif command == 'SubscribeCmd'.lower() and sock is not None:
+            machine_name_or_id = cmdList[1].lower()
+            event = (cmdList[2:] or [None])[0]
+            LOGGER.debug('Receive SubscribeCmd %s[%s] from %s'
+                         % (machine_name_or_id, event, client_addr))
+            keep_open = self._subscribe_socket(machine_name_or_id, event,
+                                               sock, framed)
+        else:
+            LOGGER.warning("Receive Unknown notification \"%s\" from %s"
+                           % (str(cmdList), client_addr))
+        return (reply, keep_open)
+
+    def _reply(self, sock, data, framed):
+        """
+        Reply data in the same format as the received message.
+        """
+        if framed:
+            wire.send_frame(sock, data)
+        else:
+            sock.send(data)
+        return
+
     def stop(self):
         """
         Stop poll thread and handle thread.
@@ -627,6 +1099,12 @@ class NotifyClient():
         The type of notify server.
     :param platform:
         The platform where the notify server deployed in.
+    :param persistent:
+        If it's True, notifications and queries are sent through a long-lived
+        session (:class:`nicu.wire.Session`) to notify server, instead of
+        a new connection for each message. If the server doesn't support
+        sessions, it falls back to short connections.
+        Call :meth:`close` to close sessions.
 
 
     :class:`NotifyClient` supports 3 mode:
@@ -646,11 +1124,14 @@ class NotifyClient():
           notification to notify server.
     """
     def __init__(self, server_name=None, server_port=None,
-                 server_type=None, platform=None):
+                 server_type=None, platform=None, persistent=False):
         self.server_name = server_name
         self.server_port = server_port
         self.server_type = server_type
         self.platform = platform
+        self.persistent = persistent
+        self._sessions = {}
+        self._session_refused = set()
         return
 
     def _get_ns_info(self, name):
@@ -662,20 +1143,7 @@ class NotifyClient():
         """
         if not self.server_name:
             # This mode is only used in GhostAgent.
-            result = SQLServerDB.query("select MachineID from Machine_Info"
-                                       " where MachineName='%s'" % (name))
-            machine_id = int(result[0][0])
-            result = SQLServerDB.query("select ServerID from Ghost_Info"
-                                       " where MachineID=%d" % (machine_id))
-            server_id = int(result[0][0])
-            result = SQLServerDB.query(
-                "select ServerName from GhostServer"
-                " where ServerID=%d" % (server_id))
-            server_name = result[0][0]
-            result = SQLServerDB.query(
-                "select NotifyPort from NotifyServer"
-                " where ServerName='%s'" % (server_name))
-            server_port = int(result[0][0])
+            (server_name, server_port) = self._query_ns_info(name)
         elif self.server_name and (not self.server_port):
             sql_str = ("select NotifyPort from NotifyServer"
                        " where ServerName = '%s'" % (self.server_name))
@@ -689,6 +1157,34 @@ class NotifyClient():
             (server_name, server_port) = (self.server_name, self.server_port)
         return (server_name, server_port)
 
+    def _query_ns_info(self, name):
+        """
+        Query the name & port of notify server related with this machine.
+
+        The machine is assigned to another ghost server by `Ghost_Info`,
+        which is not a reference table, so it is queried every time.
+
+        :param name:
+            Machine name.
+        """
+        (machine_id, ) = ref_cache.get(
+            'Machine_Info', ('id', name.lower()),
+            lambda: SQLServerDB.query_one(
+                "select MachineID from Machine_Info"
+                " where MachineName='%s'" % (name)),
+            lambda row: ('MachineID', row[0]))
+        result = SQLServerDB.query(
+            "select G.ServerName from Ghost_Info as I, GhostServer as G"
+            " where I.ServerID=G.ServerID and I.MachineID=%d"
+            % (int(machine_id)))
+        server_name = result[0][0]
+        (server_port, ) = ref_cache.get(
+            'NotifyServer', ('client_port', server_name.lower()),
+            lambda: SQLServerDB.query_one(
+                "select NotifyPort from NotifyServer"
+                " where ServerName='%s'" % (server_name)))
+        return (server_name, int(server_port))
+
     def _query_machine_name(self, machine_id):
         """
         This is used to query machine name.
@@ -701,7 +1197,10 @@ class NotifyClient():
         try:
             sql_str = ("select MachineName from Machine_Info"
                        " where MachineID=%s" % (machine_id))
-            (name, ) = SQLServerDB.query_one(sql_str)
+            (name, ) = ref_cache.get(
+                'Machine_Info', ('name', str(machine_id)),
+                lambda: SQLServerDB.query_one(sql_str),
+                ('MachineID', machine_id))
             name = name.lower()
         except Exception, error:
             LOGGER.error('Failed to query table Machine_Info "%s": %s'
@@ -722,6 +1221,67 @@ class NotifyClient():
                             % (str(machine_name_or_id)))
         return name
 
+    def _framed_exchange(self, address, msg, isrecv=False, timeout=10,
+                         session=True):
+        """
+        Send message in frame mode (see :mod:`nicu.wire`), or through
+        session if `persistent` and `session` are both True.
+        Return the reply (or True if not `isrecv`), or None if notify server
+        only supports legacy text.
+        """
+        if not config.WIRE_FRAMED or wire.is_legacy(address):
+            return None
+        if self.persistent and session:
+            reply = self._session_exchange(address, msg, timeout)
+            if reply is not None:
+                return [True, reply][isrecv]
+        try:
+            reply = wire.exchange(address, msg, isrecv, timeout=timeout)
+        except wire.NegotiationError, error:
+            LOGGER.info("%s, use legacy text instead." % (error))
+            return None
+        return [True, reply][isrecv]
+
+    def _session_exchange(self, address, msg, timeout):
+        """
+        Send message through the session to notify server, and return
+        the reply, or None if the server doesn't support sessions.
+
+        If a reused session is broken, e.g. it is closed by server after
+        idle, the message is sent once again in a new session.
+        """
+        if address in self._session_refused:
+            return None
+        session = self._sessions.get(address)
+        timeout = [None, timeout][timeout > 0]
+        try:
+            if session is not None:
+                try:
+                    return session.request(msg, timeout)
+                except (socket.timeout, wire.SessionRefusedError):
+                    raise
+                except (wire.WireError, socket.error), error:
+                    LOGGER.info("Session to %s is broken: %s, retry in a"
+                                " new session." % (address, error))
+                    session.close()
+            session = wire.Session(address)
+            self._sessions[address] = session
+            return session.request(msg, timeout)
+        except wire.SessionRefusedError, error:
+            LOGGER.info("%s, use short connection instead." % (error))
+            self._session_refused.add(address)
+            self._sessions.pop(address, None)
+            return None
+
+    def close(self):
+        """
+        Close all sessions, see `persistent` parameter.
+        """
+        for session in self._sessions.values():
+            session.close()
+        self._sessions.clear()
+        return
+
     def send(self, machine_name_or_id, event=None, status='Passed'):
         """
         Send message to notify server about the status of this event.
@@ -743,9 +1303,11 @@ class NotifyClient():
             name = self._get_machine_name(machine_name_or_id)
             (server_name, server_port) = self._get_ns_info(name)
             server_ip = gethostipbyname(server_name)
-            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client_socket.connect((server_ip, server_port))
-            client_socket.sendall(msg)
+            if not self._framed_exchange((server_ip, server_port), msg):
+                client_socket = socket.socket(socket.AF_INET,
+                                              socket.SOCK_STREAM)
+                client_socket.connect((server_ip, server_port))
+                client_socket.sendall(msg)
             LOGGER.info('Successfully send notification "%s"' % (msg))
         except Exception, error:
             LOGGER.error('Failed to send notification "%s": %s' % (msg, error))
@@ -770,16 +1332,20 @@ class NotifyClient():
             (server_name, server_port) = self._get_ns_info(name)
             server_ip = gethostipbyname(server_name)
 
-            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client_socket.connect((server_ip, server_port))
             if event is None:
                 msg = "GetGhostStat %s" % (name)
             else:
                 msg = "GetCmdStat %s %s" % (name, event)
-            client_socket.sendall(msg)
-            LOGGER.info('Successfully send notification "%s"' % (msg))
-            client_socket.settimeout(10)
-            status = client_socket.recv(512)
+            status = self._framed_exchange((server_ip, server_port), msg,
+                                           isrecv=True)
+            if status is None:
+                client_socket = socket.socket(socket.AF_INET,
+                                              socket.SOCK_STREAM)
+                client_socket.connect((server_ip, server_port))
+                client_socket.sendall(msg)
+                LOGGER.info('Successfully send notification "%s"' % (msg))
+                client_socket.settimeout(10)
+                status = client_socket.recv(512)
             LOGGER.info('Successfully receive status of %s[%s]: "%s"' %
                         (name, event, status))
         except Exception, error:
@@ -792,6 +1358,76 @@ class NotifyClient():
                 client_socket.close()
         return status
 
+    def subscribe(self, machine_name_or_id, event=None,
+                  timeout=config.NOTIFY_WAIT_TIMEOUT):
+        """
+        Wait until notify server pushes the final status of this machine
+        with certain event, without polling.
+
+        :param machine_name_or_id:
+            Machine name or machine id.
+        :param event:
+            Corresponding event.
+        :param timeout:
+            Seconds to wait, <=0 means waiting forever.
+        :returns: (status, pushed). The status is 'InProcess' if it isn't
+            finished in `timeout` seconds, 'None' if failed, or None if
+            notify server doesn't support subscription. `pushed` is False
+            if it isn't in process when subscribing, and the current status
+            is replied immediately, which may be of the previous
+            registration.
+        """
+        client_socket = None
+        name = machine_name_or_id
+        try:
+            name = self._get_machine_name(machine_name_or_id)
+            (server_name, server_port) = self._get_ns_info(name)
+            server_ip = gethostipbyname(server_name)
+
+            msg = "SubscribeCmd %s" % (name)
+            if event is not None:
+                msg += " %s" % (event)
+            # Subscription holds the connection, so it isn't in session.
+            status = self._framed_exchange((server_ip, server_port), msg,
+                                           isrecv=True, timeout=timeout,
+                                           session=False)
+            if status is None:
+                client_socket = socket.socket(socket.AF_INET,
+                                              socket.SOCK_STREAM)
+                client_socket.settimeout(10)
+                client_socket.connect((server_ip, server_port))
+                client_socket.sendall(msg)
+                # Wait in 1 second steps, so that it could be killed.
+                start_time = time.time()
+                while not select.select([client_socket], [], [], 1)[0]:
+                    if timeout > 0 and time.time() - start_time >= timeout:
+                        raise socket.timeout()
+                status = client_socket.recv(512)
+            if not status:
+                LOGGER.info('Notify server %s:%s does not support'
+                            ' subscription' % (server_name, server_port))
+                return (None, False)
+            if status.startswith(CURRENT_STATUS_PREFIX + ' '):
+                status = status[len(CURRENT_STATUS_PREFIX) + 1:]
+                LOGGER.info('%s[%s] is not in process, current status: "%s"'
+                            % (name, event, status))
+                return (status, False)
+            LOGGER.info('Successfully receive pushed status of %s[%s]: "%s"'
+                        % (name, event, status))
+        except socket.timeout:
+            status = 'InProcess'
+            LOGGER.info('%s[%s] is still in process after %s seconds'
+                        % (name, event, timeout))
+        except Exception, error:
+            status = 'None'
+            LOGGER.error('Failed to subscribe status of %s[%s]: %s' %
+                         (name, event, error))
+            LOGGER.error(traceback.format_exc())
+        finally:
+            if client_socket:
+                client_socket.close()
+        return (status, True)
+
     @classmethod
     def send_notify(cls, machine_name_or_id, server_name=None, server_port=None,
                     server_type=None, platform=None,
@@ -14,6 +14,10 @@
         p4 = p4lib.P4(<p4options>)
         result = p4.<command>(<options>)
 
+    P4Session keeps one connection to the server through P4Python if it
+    is installed, or runs commands in tagged output mode (p4 -G) with all
+    file arguments in one connection, see its doc string.
+
     For more information see the doc string on each command. For example:
         help(p4lib.P4.opened)
 
@@ -50,8 +54,16 @@ import marshal
 import getopt
 import tempfile
 import copy
+import time
+import threading
+import subprocess
+try:
+    # P4Python, which keeps a connection to the server open.
+    import P4 as _P4API
+except ImportError:
+    _P4API = None
 
-__all__ = ['P4LibError', 'P4', 'makeForm', 'parseForm', 'makeOptv', 'parseOptv']
+__all__ = ['P4LibError', 'P4', 'P4Session', 'makeForm', 'parseForm', 'makeOptv', 'parseOptv']
 
 class P4LibError(Exception):
     pass
@@ -461,6 +473,39 @@ class P4:
         self.p4 = p4
         self.optd = options
         self._optv = makeOptv(**self.optd)
+        # Results of 'where' and 'dirs', which are looked up repeatedly
+        # for the same paths, see _getMemo().
+        self._memo = {}
+        self.savedSpawns = 0
+
+    def _memoKey(self, command, args, p4options):
+        """Return the key of memoized results: the command, its arguments,
+        and the p4 options (client spec etc.) it runs with.
+        """
+        d = self.optd.copy()
+        d.update(p4options)
+        return (command, tuple(sorted(d.items())), tuple(args or []))
+
+    def _getMemo(self, key):
+        """Return a copy of the memoized results of `key`, or None."""
+        if key not in self._memo:
+            return None
+        self.savedSpawns += 1
+        return copy.deepcopy(self._memo[key])
+
+    def _setMemo(self, key, results):
+        """Memoize `results` of `key`, and return them."""
+        self._memo[key] = copy.deepcopy(results)
+        return results
+
+    def clearMemo(self):
+        """Forget memoized results of 'where' and 'dirs'.
+
+        It is called when the client view is changed by P4.client(). Call
+        it if the client view or the depot directories may be changed by
+        others.
+        """
+        self._memo = {}
 
     def _p4run(self, argv, **p4options):
         """Run the given p4 command.
@@ -582,6 +627,12 @@ class P4:
         if isinstance(files, basestring):
             files = [files]
 
+        if not _raw:
+            key = self._memoKey('where', files, p4options)
+            results = self._getMemo(key)
+            if results is not None:
+                return results
+
         argv = ['where']
         if files:
             argv += files
@@ -613,7 +664,7 @@ class P4:
             file['clientFile'] = line[clientFileStart:localFileStart-1]
             file['localFile'] = line[localFileStart:]
             results.append(file)
-        return results
+        return self._setMemo(key, results)
 
     def have(self, files=[], _raw=False, **p4options):
         """Get list of file revisions last synced.
@@ -1196,12 +1247,18 @@ class P4:
         if not dirs:
             raise P4LibError("Missing/wrong number of arguments.")
 
+        if not _raw:
+            key = self._memoKey('dirs', dirs, p4options)
+            results = self._getMemo(key)
+            if results is not None:
+                return results
+
         argv = ['dirs'] + dirs
         output, error, retval = self._p4run(argv, **p4options)
         if _raw:
             return {'stdout': output, 'stderr': error, 'retval': retval}
 
-        return [x.strip() for x in output.splitlines()]
+        return self._setMemo(key, [x.strip() for x in output.splitlines()])
 
     def filelog(self, files, followIntegrations=0, longOutput=0, maxRevs=None,
                 _raw=False, **p4options):
@@ -1965,6 +2022,9 @@ class P4:
                 argv = ['client', '-i', '<', formfile]
 
             output, error, retval = self._p4run(argv, **p4options)
+            if action != 'get':
+                # The client view may be changed.
+                self.clearMemo()
             if _raw:
                 return {'stdout': output, 'stderr': error, 'retval': retval}
 
@@ -2453,3 +2513,385 @@ class P4:
                           'retval': retval}
         else:
             return hits
+
+
+class P4Session(P4):
+    """A 'p4' proxy which runs commands in tagged output mode.
+
+    If P4Python is installed, one connection to the server is opened for
+    each set of p4 options (port, user, client, ...), and reused by all
+    commands until close() is called, so that no process is started.
+
+    Otherwise, each command is run with marshalled tagged output
+    ('p4 -G') and all of its file arguments are passed through an
+    argument file ('p4 -x'). It still starts one 'p4' process for every
+    command, but not one for every 10 files.
+
+    Either way, the tagged records are converted to the same results as
+    class P4, instead of parsing the text output with regexes. Tests
+    against a fake 'p4' client are in tests/test_p4lib.py.
+
+    Commands with tagged parsing: where, dirs, fstat, changes, sync,
+    filelog. Other commands, and any command with '_raw', are run the
+    same way as class P4.
+
+    Example:
+        >>> p4 = P4Session(port='perforce:1666', client='trentm-ra')
+        >>> p4.where('//depot/foo/...')[0]['localFile']
+        'c:\\trentm\\foo\\...'
+    """
+    # 'p4 help usage' severity of error records: E_EMPTY, E_INFO, E_WARN,
+    # E_FAILED, E_FATAL. Warnings, e.g. "file(s) up-to-date.", are not
+    # errors in text mode either.
+    E_FAILED = 3
+    # P4Python option names of the p4 options, see makeOptv().
+    API_OPTIONS = {'client': 'client', 'dir': 'cwd', 'host': 'host',
+                   'port': 'port', 'password': 'password', 'user': 'user'}
+
+    def __init__(self, p4='p4', persistent=None, **options):
+        """Create a 'p4' proxy object, see P4.__init__().
+
+        "persistent" is whether to keep connections through P4Python.
+            Defaults to True if P4Python is installed, and "p4" is not a
+            specific client app.
+        """
+        P4.__init__(self, p4, **options)
+        if persistent is None:
+            persistent = _P4API is not None and p4 == 'p4'
+        self.persistent = persistent
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def close(self):
+        """Disconnect all connections kept by P4Python."""
+        self._lock.acquire()
+        try:
+            for conn in self._connections.values():
+                if conn.connected():
+                    conn.disconnect()
+            self._connections = {}
+        finally:
+            self._lock.release()
+
+    def _p4run_tagged(self, argv, args=None, **p4options):
+        """Run the given p4 command in tagged output mode.
+
+        "args" is a list of arguments passed through an argument file, so
+            that all of them are handled in one connection.
+
+        Returns the list of 'stat' records, and raises P4LibError if the
+        command fails.
+        """
+        if self.persistent:
+            return self._p4run_api(argv, args, **p4options)
+        d = self.optd.copy()
+        d.update(p4options)
+        argv = [self.p4, '-G'] + makeOptv(**d) + argv
+        argfile = None
+        errfile = tempfile.TemporaryFile()
+        try:
+            if args:
+                fd, argfile = tempfile.mkstemp('.txt', 'p4lib')
+                os.write(fd, ''.join([arg + '\n' for arg in args]))
+                os.close(fd)
+                argv[2:2] = ['-x', argfile]
+            log.debug("Running '%s'..." % _joinArgv(argv))
+            p = subprocess.Popen(argv, stdout=subprocess.PIPE,
+                                 stderr=errfile)
+            nodes = list(_unmarshal(p.stdout))
+            p.stdout.close()
+            retval = p.wait()
+            errfile.seek(0)
+            error = errfile.read()
+        finally:
+            errfile.close()
+            if argfile:
+                os.remove(argfile)
+
+        records = []
+        errors = []
+        for node in nodes:
+            if node.get('code') == 'stat':
+                records.append(node)
+            elif (node.get('code') == 'error'
+                    and int(node.get('severity', self.E_FAILED))
+                    >= self.E_FAILED):
+                errors.append(node.get('data', '').strip())
+        if retval or errors:
+            raise P4LibError("Error running '%s': error='%s' retval='%s'"\
+                             % (_joinArgv(argv), error or '\n'.join(errors),
+                                retval))
+        log.debug("records='%s'", records)
+        return records
+
+    def _p4run_api(self, argv, args=None, **p4options):
+        """Same as _p4run_tagged(), but run in the kept P4Python connection
+        of the p4 options, which is connected at the first time.
+        """
+        d = self.optd.copy()
+        d.update(p4options)
+        key = tuple(sorted(d.items()))
+        argv = argv + list(args or [])
+        # A P4Python connection runs one command at a time.
+        self._lock.acquire()
+        try:
+            conn = self._connections.get(key)
+            if conn is None or not conn.connected():
+                conn = _P4API.P4()
+                # Raise on errors only, warnings like "file(s) up-to-date."
+                # are not errors, see E_FAILED.
+                conn.exception_level = 1
+                for name, value in d.items():
+                    if value is not None:
+                        setattr(conn, self.API_OPTIONS[name], value)
+                log.debug("Connecting to '%s'..." % conn.port)
+                conn.connect()
+                self._connections[key] = conn
+            log.debug("Running '%s' in P4Python..." % _joinArgv(argv))
+            try:
+                records = conn.run(*argv)
+            except _P4API.P4Exception, error:
+                if not conn.connected():
+                    self._connections.pop(key, None)
+                raise P4LibError("Error running '%s': error='%s'"\
+                                 % (_joinArgv(argv),
+                                    '\n'.join(conn.errors) or error))
+        finally:
+            self._lock.release()
+        records = [record for record in records if isinstance(record, dict)]
+        log.debug("records='%s'", records)
+        return records
+
+    def _formatTime(self, seconds):
+        """Format the tagged 'time' value as the date of text output."""
+        return time.strftime('%Y/%m/%d', time.localtime(int(seconds)))
+
+    def where(self, files=None, _raw=False, **p4options):
+        """Show how filenames map through the client view.
+
+        See P4.where().
+        """
+        if _raw:
+            return P4.where(self, files, _raw, **p4options)
+        if isinstance(files, basestring):
+            files = [files]
+
+        key = self._memoKey('where', files, p4options)
+        results = self._getMemo(key)
+        if results is not None:
+            return results
+
+        results = []
+        for record in self._p4run_tagged(['where'], files, **p4options):
+            results.append({'depotFile': record['depotFile'],
+                            'clientFile': record['clientFile'],
+                            'localFile': record['path'],
+                            'minus': 'unmap' in record})
+        return self._setMemo(key, results)
+
+    def dirs(self, dirs, _raw=False, **p4options):
+        """List the immediate subfolders of the given folders.
+
+        See P4.dirs().
+        """
+        if _raw:
+            return P4.dirs(self, dirs, _raw, **p4options)
+        if isinstance(dirs, basestring):
+            dirs = [dirs]
+
+        if not dirs:
+            raise P4LibError("Missing/wrong number of arguments.")
+
+        key = self._memoKey('dirs', dirs, p4options)
+        results = self._getMemo(key)
+        if results is not None:
+            return results
+
+        return self._setMemo(key, [record['dir'] for record in
+                                   self._p4run_tagged(['dirs'], dirs,
+                                                      **p4options)])
+
+    def fstat(self, files, _raw=False, **p4options):
+        """List files in the depot.
+
+        See P4.fstat().
+        """
+        if _raw:
+            return P4.fstat(self, files, _raw, **p4options)
+        if isinstance(files, basestring):
+            files = [files]
+
+        if not files:
+            raise P4LibError("Missing/wrong number of arguments.")
+
+        hits = []
+        for record in self._p4run_tagged(['fstat', '-C', '-P'], files,
+                                         **p4options):
+            hit = {'clientFile': '',
+                   'depotFile': '',
+                   'path': '',
+                   'headAction': '',
+                   'headChange': 0,
+                   'headRev': 0,
+                   'headType': '',
+                   'headTime': 0,
+                   'haveRev': 0,
+                   'action': '',
+                   'actionOwner': '',
+                   'change': '',
+                   'unresolved': '',
+                   'ourLock': 0,
+                   }
+            for key, value in record.items():
+                if key == 'code':
+                    continue
+                elif key == 'ourLock':
+                    hit['ourLock'] = 1
+                elif key in ['headChange', 'headRev', 'headTime', 'haveRev']:
+                    try:
+                        hit[key] = int(value)
+                    except ValueError:
+                        hit[key] = value
+                else:
+                    hit[key] = value
+            hits.append(hit)
+        return hits
+
+    def changes(self, files=[], followIntegrations=0, longOutput=0,
+                max=None, status=None, _raw=False, **p4options):
+        """Return a list of pending and submitted changelists.
+
+        See P4.changes().
+        """
+        if _raw:
+            return P4.changes(self, files, followIntegrations, longOutput,
+                              max, status, _raw, **p4options)
+        if max is not None and type(max) != types.IntType:
+            raise P4LibError("Incorrect 'max' value. It must be an integer: "\
+                             "'%s' (type '%s')" % (max, type(max)))
+        if status is not None and status not in ("pending", "submitted"):
+            raise P4LibError("Incorrect 'status' value: '%s'" % status)
+
+        if isinstance(files, basestring):
+            files = [files]
+
+        optv = []
+        if followIntegrations:
+            optv.append('-i')
+        if longOutput:
+            optv.append('-l')
+        if max is not None:
+            optv += ['-m', str(max)]
+        if status is not None:
+            optv += ['-s', status]
+
+        changes = []
+        for record in self._p4run_tagged(['changes'] + optv, files,
+                                         **p4options):
+            description = record.get('desc', '')
+            if not longOutput:
+                description = description.rstrip('\n')
+            changes.append({'change': int(record['change']),
+                            'date': self._formatTime(record['time']),
+                            'user': record['user'],
+                            'client': record['client'],
+                            'description': description})
+        return changes
+
+    def sync(self, files=[], force=0, dryrun=0, _raw=False, **p4options):
+        """Synchronize the client with its view of the depot.
+
+        See P4.sync().
+        """
+        if _raw:
+            return P4.sync(self, files, force, dryrun, _raw, **p4options)
+        if isinstance(files, basestring):
+            files = [files]
+
+        optv = []
+        if force:
+            optv.append('-f')
+        if dryrun:
+            optv.append('-n')
+
+        comments = {'added': 'added as %s',
+                    'deleted': 'deleted as %s',
+                    'updated': 'updating %s',
+                    'refreshed': 'refreshing %s'}
+        hits = []
+        for record in self._p4run_tagged(['sync'] + optv, files,
+                                         **p4options):
+            if 'depotFile' not in record:
+                continue
+            action = record.get('action', '')
+            comment = comments.get(action, action + ' %s')
+            hits.append({'depotFile': record['depotFile'],
+                         'rev': int(record['rev']),
+                         'comment': comment % record.get('clientFile', ''),
+                         'notes': []})
+        return hits
+
+    def filelog(self, files, followIntegrations=0, longOutput=0, maxRevs=None,
+                _raw=False, **p4options):
+        """List revision histories of files.
+
+        See P4.filelog().
+        """
+        if _raw:
+            return P4.filelog(self, files, followIntegrations, longOutput,
+                              maxRevs, _raw, **p4options)
+        if maxRevs is not None and type(maxRevs) != types.IntType:
+            raise P4LibError("Incorrect 'maxRevs' value. It must be an "\
+                             "integer: '%s' (type '%s')"\
+                             % (maxRevs, type(maxRevs)))
+
+        if isinstance(files, basestring):
+            files = [files]
+
+        if not files:
+            raise P4LibError("Missing/wrong number of arguments.")
+
+        optv = []
+        if followIntegrations:
+            optv.append('-i')
+        if longOutput:
+            optv.append('-l')
+        if maxRevs is not None:
+            optv += ['-m', str(maxRevs)]
+
+        # Revisions are indexed in the tagged record: 'rev0', 'change0',
+        # ..., and their integrations: 'how0,0', 'file0,0', 'srev0,0', ...
+        hits = []
+        for record in self._p4run_tagged(['filelog'] + optv, files,
+                                         **p4options):
+            hit = {'depotFile': record['depotFile'], 'revs': []}
+            i = 0
+            while 'rev%d' % i in record:
+                description = record.get('desc%d' % i, '')
+                if not longOutput:
+                    description = description.rstrip('\n')
+                rev = {'rev': int(record['rev%d' % i]),
+                       'change': int(record['change%d' % i]),
+                       'action': record.get('action%d' % i, ''),
+                       'date': self._formatTime(record['time%d' % i]),
+                       'user': record.get('user%d' % i, ''),
+                       'client': record.get('client%d' % i, ''),
+                       'type': record.get('type%d' % i, ''),
+                       'description': description,
+                       'notes': []}
+                j = 0
+                while 'how%d,%d' % (i, j) in record:
+                    srev = record.get('srev%d,%d' % (i, j), '#none')
+                    erev = record.get('erev%d,%d' % (i, j), '')
+                    if srev == '#none' or '#%d' % (int(srev[1:]) + 1) == erev:
+                        revRange = erev
+                    else:
+                        revRange = '#%d,%s' % (int(srev[1:]) + 1, erev)
+                    rev['notes'].append('%s %s%s' % (
+                        record['how%d,%d' % (i, j)],
+                        record.get('file%d,%d' % (i, j), ''), revRange))
+                    j += 1
+                hit['revs'].append(rev)
+                i += 1
+            hits.append(hit)
+        return hits
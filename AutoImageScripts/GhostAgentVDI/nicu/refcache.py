@@ -0,0 +1,160 @@
+"""This module contains an in-process read-through cache for reference
+tables, such as `Machine_Info`, `OS_Info`, `GhostServer` and `NotifyServer`.
+
+These tables change only a few times a week, but they are queried many
+times per ghost request to resolve names, IDs and server addresses.
+
+.. doctest::
+
+    >>> from nicu.refcache import ref_cache
+    >>> ref_cache.get('Machine_Info', ('MachineName', 1),
+    ...               lambda: query_machine_name(1))
+    >>> ref_cache.invalidate('Machine_Info', ('MachineID', 1))
+    >>> ref_cache.invalidate('Machine_Info')
+    >>> ref_cache.get_stats()
+
+.. note::
+    Only the values which are not None are cached, so that a new record
+    is visible as soon as it is inserted.
+
+    An entry could be bound with the record it is loaded from, e.g.
+    ``('MachineID', 1)``, so that a write of one record only drops the
+    entries of this record, and the entries which are not bound.
+"""
+import time
+import logging
+import threading
+
+import config
+
+
+__all__ = [
+    "RefCache",
+    "ref_cache",
+]
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _normalize_ident(ident):
+    """
+    Normalize (column, value) of a record, so that ('MachineID', 1) equals
+    ('machineid', '1').
+    """
+    if ident is None:
+        return None
+    (column, value) = ident
+    return (column.lower(), str(value).lower())
+
+
+class RefCache(object):
+    """
+    A read-through cache whose entries expire after `ttl` seconds, and
+    could be invalidated by table, or by one record of table.
+
+    :param ttl:
+        Seconds to keep each entry.
+    :param enabled:
+        Whether to use the cache. If False, all lookups go to database,
+        which is useful for debugging.
+    """
+    def __init__(self, ttl=config.REF_CACHE_TTL,
+                 enabled=config.REF_CACHE_ENABLED):
+        self.ttl = ttl
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, tables, key, loader, ident=None):
+        """
+        Get the cached value, or call `loader()` to load and cache it.
+
+        :param tables:
+            The table name, or a tuple of table names which the value
+            depends on.
+        :param key:
+            The key of value in these tables, it should be hashable.
+        :param loader:
+            The function without arguments to query the value.
+        :param ident:
+            The (column, value) of the record which the value is loaded
+            from, or a function to get it from the loaded value. If it is
+            None, the entry is dropped by any write of these tables.
+        """
+        if not self.enabled:
+            return loader()
+        if isinstance(tables, basestring):
+            tables = (tables,)
+        entry_key = (tables, key)
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(entry_key)
+            if entry and time.time() - entry[0] < self.ttl:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self._generation
+        finally:
+            self._lock.release()
+
+        load_time = time.time()
+        value = loader()
+        if value is not None:
+            if callable(ident):
+                ident = ident(value)
+            ident = _normalize_ident(ident)
+            self._lock.acquire()
+            try:
+                # Don't cache the value loaded before an invalidation.
+                if generation == self._generation:
+                    self._entries[entry_key] = (load_time, value, ident)
+            finally:
+                self._lock.release()
+        return value
+
+    def invalidate(self, table=None, ident=None):
+        """
+        Drop entries which depend on `table`, or all entries if it is None.
+
+        :param ident:
+            The (column, value) of the written record. If it is not None,
+            only the entries of this record and the entries which are not
+            bound with any record are dropped.
+        """
+        self._lock.acquire()
+        try:
+            self._generation += 1
+            if table is None:
+                self._entries.clear()
+                return
+            table = table.lower()
+            ident = _normalize_ident(ident)
+            for (entry_key, entry) in self._entries.items():
+                if table not in [x.lower() for x in entry_key[0]]:
+                    continue
+                if ident is None or entry[2] is None or entry[2] == ident:
+                    del self._entries[entry_key]
+        finally:
+            self._lock.release()
+
+    def get_stats(self):
+        """
+        Get a dict of hits, misses, hit ratio and count of entries.
+        """
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'ratio': total and float(self.hits) / total,
+                'size': len(self._entries)}
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+
+ref_cache = RefCache()
+"""
+The shared :class:`RefCache` of this process.
+"""
@@ -158,16 +158,30 @@ def get_stack_id(schema_id, product_ids, stack_type):
     return stack_id
 
 
-def find_stack_info(step_ids):
+def _get_step_info(steps_info, step_id):
+    '''
+    Get (Description, Type, LatestInstaller) of step from the result of
+    :func:`get_steps_info`.
+    '''
+    if step_id not in steps_info:
+        raise Exception('Failed to get information of step %s' % (step_id))
+    step_info = steps_info[step_id]
+    return (step_info['Description'], step_info['Type'],
+            step_info['LatestInstaller'])
+
+
+def find_stack_info(step_ids, steps_info=None):
     '''
     Get stack type and products based on step id list.
+    `steps_info` is the result of :func:`get_steps_info` if it has been
+    queried.
     '''
     stack_type = StackType.NONE_STACK_TYPE
     product_ids = []
-    sql_str_temp = ("select Description, Type, LatestInstaller from GhostSteps"
-                    " where StepID=%s")
+    if steps_info is None:
+        steps_info = get_steps_info(step_ids)
     for i, step_id in enumerate(step_ids):
-        step_info = SQLServerDB.query_one(sql_str_temp % step_id)
+        step_info = _get_step_info(steps_info, step_id)
         if step_info[1] != 1:
             continue
         cur_stack_type = StackType.desr2type(step_info[0])
@@ -296,7 +310,9 @@ def gen_new_seq(seq_id, force=False, throw_exception=False):
         # First, scan all steps, to get all steps related to stack if exists.
         stack_step_ids = []
         stack_step_index = 0
-        (stack_type, product_ids) = find_stack_info(step_ids)
+        # Query all steps at once, rather than one by one.
+        steps_info = get_steps_info(step_ids)
+        (stack_type, product_ids) = find_stack_info(step_ids, steps_info)
         if StackType.is_dynamic_stack(stack_type):
             schema_id = get_stack_schema_id(product_ids)
             stack_id = get_stack_id(schema_id, product_ids, stack_type)
@@ -307,10 +323,8 @@ def gen_new_seq(seq_id, force=False, throw_exception=False):
         # If exists any daily installer, need to create new steps.
         # This new steps couldn't be deleted automatically, so we use special
         # description to mark them, for more convenient removing manually.
-        sql_str_temp = ("select Description, Type, LatestInstaller from"
-                        " GhostSteps where StepID=%s")
         for i, step_id in enumerate(step_ids):
-            step_info = SQLServerDB.query_one(sql_str_temp % step_id)
+            step_info = _get_step_info(steps_info, step_id)
             if step_info[1] != 1 or step_info[2] != 1:
                 new_step_ids.append(step_id)
                 continue
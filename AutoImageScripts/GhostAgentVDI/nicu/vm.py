@@ -13,9 +13,13 @@ import string
 import shutil
 import logging
 import time
+import threading
+
+import config
 
 __all__ = ['VmwareType', 'CommonVmwareException',
-           'copy_vm', 'init_vmx', 'load_vmx_conf', 'get_vmx_conf', 'Vmrun']
+           'copy_vm', 'init_vmx', 'load_vmx_conf', 'get_vmx_conf',
+           'RunningVmCache', 'running_vm_cache', 'Vmrun']
 
 
 logger = logging.getLogger(__name__)
@@ -126,6 +130,116 @@ def get_vmx_conf(vmconf, key):
         raise CommonVmwareException(msg)
 
 
+class RunningVmCache(object):
+    """
+    Process-wide snapshot of `vmrun list`, shared by all :class:`Vmrun`
+    instances of the same VMware host.
+
+    The snapshot is refreshed at most once per `ttl` seconds, and concurrent
+    callers of the same host share one refresh, while different hosts are
+    refreshed in parallel. It is invalidated by power commands
+    (start, stop, reset, ...) issued through :class:`Vmrun`.
+
+    :param ttl:
+        Seconds to reuse the snapshot, 0 means no cache.
+    """
+    def __init__(self, ttl=config.VM_LIST_CACHE_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        # One refresh lock per (VM_TYPE, VM_HOST).
+        self._refresh_locks = {}
+
+    def _get_fresh(self, key, since):
+        entry = self._entries.get(key)
+        if entry and entry[0] >= since:
+            self.hits += 1
+            return entry[1]
+        return None
+
+    def get(self, vm_object, refresh=False):
+        """
+        Get result of `vmrun list`, same as :meth:`Vmrun.vmrun`.
+
+        :param refresh:
+            Ignore the snapshot taken before this call.
+        """
+        start_time = time.time()
+        since = [start_time - self.ttl, start_time][refresh or self.ttl <= 0]
+        key = (vm_object.VM_TYPE, vm_object.VM_HOST)
+        self._lock.acquire()
+        try:
+            result = self._get_fresh(key, since)
+            refresh_lock = self._refresh_locks.get(key)
+            if refresh_lock is None:
+                refresh_lock = self._refresh_locks[key] = threading.Lock()
+        finally:
+            self._lock.release()
+        if result is not None:
+            return result
+
+        refresh_lock.acquire()
+        try:
+            # Another thread may have refreshed it during waiting.
+            self._lock.acquire()
+            try:
+                result = self._get_fresh(key, max(since, start_time))
+                if result is not None:
+                    return result
+                self.misses += 1
+                generation = self._generation
+            finally:
+                self._lock.release()
+            refresh_time = time.time()
+            result = vm_object.vmrun('list')
+            (vm_cmd, vm_res) = result
+            if vm_res and vm_res[0].startswith('Total running VMs'):
+                self._lock.acquire()
+                if generation == self._generation:
+                    self._entries[key] = (refresh_time, result)
+                self._lock.release()
+        finally:
+            refresh_lock.release()
+        return result
+
+    def invalidate(self):
+        """
+        Drop all snapshots, since state of virtual machines is changed.
+        """
+        self._lock.acquire()
+        self._generation += 1
+        self._entries.clear()
+        self._lock.release()
+
+    def get_stats(self):
+        """
+        Get a dict of hits, misses and hit ratio.
+        """
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'ratio': total and float(self.hits) / total}
+
+
+running_vm_cache = RunningVmCache()
+"""
+The shared :class:`RunningVmCache` used by :meth:`Vmrun.list`.
+"""
+
+
+def _invalidate_running_vms(func):
+    def _func(self, *args, **kwargs):
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            running_vm_cache.invalidate()
+    _func.__name__ = func.__name__
+    _func.__doc__ = func.__doc__
+    return _func
+
+
 class Vmrun:
     def VmModeValidate(self, vmtype):
         """
@@ -260,6 +374,7 @@ class Vmrun:
     #
     # POWER COMMANDS
     #
+    @_invalidate_running_vms
     def start(self):
         '''
         COMMAND                  PARAMETERS           DESCRIPTION
@@ -268,6 +383,7 @@ class Vmrun:
         '''
         return self.vmrun('start')
 
+    @_invalidate_running_vms
     def stop(self, mode='soft'):
         '''
         stop                     Path to vmx file     Stop a VM or Team
@@ -276,6 +392,7 @@ class Vmrun:
         '''
         return self.vmrun('stop', mode)
 
+    @_invalidate_running_vms
     def reset(self, mode='soft'):
         '''
         reset                    Path to vmx file     Reset a VM or Team
@@ -284,6 +401,7 @@ class Vmrun:
         '''
         return self.vmrun('reset', mode)
 
+    @_invalidate_running_vms
     def suspend(self, mode='soft'):
         '''
         suspend                 Path to vmx file     Suspend a VM or Team
@@ -336,6 +454,7 @@ class Vmrun:
             raise CommonVmwareException("The current virtual machine server<%s> do not support deleteSnapshot." % self.VM_TYPE)
             return 0
 
+    @_invalidate_running_vms
     def revertToSnapshot(self, name='binjo'):
         '''
         revertToSnapshot         Path to vmx file     Set VM state to a snapshot
@@ -602,11 +721,13 @@ class Vmrun:
     #
     # GENERAL COMMANDS
     #
-    def list(self):
+    def list(self, refresh=False):
         '''
         list                                          List all running VMs
+
+        The result is shared by :data:`running_vm_cache`.
         '''
-        return self.vmrun('list')
+        return running_vm_cache.get(self, refresh)
 
     def upgradevm(self):
         '''
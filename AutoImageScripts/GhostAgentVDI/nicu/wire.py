@@ -0,0 +1,454 @@
+"""This module contains the wire format shared by servers and clients.
+
+Legacy messages are plain text, and each connection carries only one of
+them. Besides that, a client could start a connection with a greeting::
+
+    MAGIC + Mode + chr(Version)
+
+and the server replies the same greeting with the version it accepts.
+After that, messages are frames, each frame is a 4 bytes length in network
+order followed by the payload.
+
+Modes:
+    * **F** - Frame. Only one message and its reply (if any) are sent in
+      this connection, same as legacy text, but without size limitation
+      and fragmentation issue.
+    * **S** - Session. The connection keeps alive, and each payload is
+      a 4 bytes request id followed by the command. Replies carry the
+      same request id, so that requests could be pipelined.
+
+Since legacy commands never start with a NUL byte, servers are able to
+distinguish them by the first byte. If a server doesn't reply the greeting,
+clients fall back to legacy text, and remember the server as legacy.
+"""
+import time
+import socket
+import select
+import struct
+import logging
+import threading
+
+
+__all__ = [
+    "MAGIC",
+    "MODE_FRAME",
+    "MODE_SESSION",
+    "VERSION",
+    "WireError",
+    "NegotiationError",
+    "SessionRefusedError",
+    "is_greeting",
+    "make_greeting",
+    "recv_greeting",
+    "split_greeting",
+    "connect",
+    "accept_greeting",
+    "is_legacy",
+    "exchange",
+    "recv_exactly",
+    "send_frame",
+    "recv_frame",
+    "split_frame",
+    "pack_request",
+    "unpack_request",
+    "Session",
+]
+
+LOGGER = logging.getLogger(__name__)
+
+MAGIC = '\x00NI'
+MODE_FRAME = 'F'
+MODE_SESSION = 'S'
+VERSION = 1
+
+_GREETING_LEN = len(MAGIC) + 2
+_LEN_FORMAT = '!I'
+_LEN_SIZE = struct.calcsize(_LEN_FORMAT)
+_ID_FORMAT = '!I'
+_ID_SIZE = struct.calcsize(_ID_FORMAT)
+_MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+class WireError(Exception):
+    pass
+
+
+class NegotiationError(WireError):
+    """
+    Server doesn't accept the greeting, e.g. a legacy server.
+    """
+    pass
+
+
+class SessionRefusedError(NegotiationError):
+    """
+    Server doesn't support sessions.
+    """
+    pass
+
+# The addresses of servers which only support legacy text.
+_legacy_addresses = set()
+
+
+def is_greeting(head):
+    """
+    Whether the head of message is a greeting rather than legacy text.
+    """
+    return head[:1] == MAGIC[:1]
+
+
+def make_greeting(mode, version=VERSION):
+    return MAGIC + mode + chr(version)
+
+
+def recv_greeting(sock):
+    """
+    Receive a greeting, and return (mode, version).
+    """
+    greeting = recv_exactly(sock, _GREETING_LEN)
+    if greeting is None or not greeting.startswith(MAGIC):
+        raise WireError('Invalid greeting: %r' % (greeting,))
+    return (greeting[len(MAGIC)], ord(greeting[-1]))
+
+
+def split_greeting(data):
+    """
+    Split the greeting from the head of data received in non-blocking mode.
+    Return ((mode, version), rest of data), or (None, data) if the greeting
+    is incomplete.
+    """
+    if len(data) < _GREETING_LEN:
+        return (None, data)
+    greeting = data[:_GREETING_LEN]
+    if not greeting.startswith(MAGIC):
+        raise WireError('Invalid greeting: %r' % (greeting,))
+    return ((greeting[len(MAGIC)], ord(greeting[-1])),
+            data[_GREETING_LEN:])
+
+
+def connect(address, mode, timeout=None, error_class=NegotiationError):
+    """
+    Connect to server and negotiate the mode, return the connected socket.
+
+    :param timeout:
+        The timeout to connect and negotiate, None means blocking.
+    :raises: `error_class` if server doesn't accept the greeting.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(address)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.sendall(make_greeting(mode))
+        try:
+            (ack_mode, version) = recv_greeting(sock)
+        except socket.timeout:
+            raise
+        except (WireError, socket.error), error:
+            raise error_class('Greeting is refused by %s:%s: %s'
+                              % (address + (error,)))
+        if ack_mode != mode:
+            raise error_class('Mode %s is refused by %s:%s'
+                              % ((mode,) + address))
+    except:
+        sock.close()
+        raise
+    LOGGER.debug('Connected to %s:%s in mode %s, version %d'
+                 % (address + (mode, version)))
+    return sock
+
+
+def accept_greeting(sock, modes, greeting=None):
+    """
+    Receive the greeting in server side, and reply it if the mode is one of
+    `modes`. Return (mode, version).
+
+    :param greeting:
+        The (mode, version) which has been received, e.g. by
+        :func:`split_greeting`.
+    """
+    if greeting is None:
+        greeting = recv_greeting(sock)
+    (mode, version) = greeting
+    if mode not in modes:
+        raise WireError('Unsupported wire mode %r' % (mode,))
+    version = min(version, VERSION)
+    sock.sendall(make_greeting(mode, version))
+    return (mode, version)
+
+
+def is_legacy(address):
+    """
+    Whether the server is known to support legacy text only.
+    """
+    return address in _legacy_addresses
+
+
+def exchange(address, data, isrecv=False, timeout=-1, connect_timeout=10):
+    """
+    Send one message in frame mode, and receive its reply if `isrecv`.
+    The reply is waited in 1 second steps, so that it could be used in
+    killable thread.
+
+    :param timeout:
+        Seconds to wait the reply, <=0 means waiting forever.
+    :returns: The reply, or '' if server closes without reply.
+    :raises: :class:`NegotiationError` if the server is legacy, and the
+        address is remembered, see :func:`is_legacy`.
+    """
+    try:
+        sock = connect(address, MODE_FRAME, connect_timeout)
+    except NegotiationError:
+        _legacy_addresses.add(address)
+        raise
+    try:
+        send_frame(sock, data)
+        if not isrecv:
+            return ''
+        start_time = time.time()
+        while not select.select([sock], [], [], 1)[0]:
+            if timeout > 0 and time.time() - start_time >= timeout:
+                raise socket.timeout()
+        sock.settimeout([None, timeout][timeout > 0])
+        return recv_frame(sock) or ''
+    finally:
+        sock.close()
+
+
+def recv_exactly(sock, size):
+    """
+    Receive exactly `size` bytes, or None if connection is closed before
+    any byte received.
+    """
+    chunks = []
+    remain = size
+    while remain > 0:
+        chunk = sock.recv(remain)
+        if not chunk:
+            if remain == size:
+                return None
+            raise WireError('Connection closed in the middle of message')
+        chunks.append(chunk)
+        remain -= len(chunk)
+    return ''.join(chunks)
+
+
+def send_frame(sock, payload):
+    sock.sendall(struct.pack(_LEN_FORMAT, len(payload)) + payload)
+
+
+def recv_frame(sock):
+    """
+    Receive one frame, and return its payload, or None if connection
+    is closed.
+    """
+    head = recv_exactly(sock, _LEN_SIZE)
+    if head is None:
+        return None
+    (size,) = struct.unpack(_LEN_FORMAT, head)
+    if size > _MAX_FRAME_SIZE:
+        raise WireError('Frame too large: %d bytes' % size)
+    if size == 0:
+        return ''
+    payload = recv_exactly(sock, size)
+    if payload is None:
+        raise WireError('Connection closed in the middle of message')
+    return payload
+
+
+def split_frame(data):
+    """
+    Split one frame from the head of data received in non-blocking mode.
+    Return (payload, rest of data), or (None, data) if the frame is
+    incomplete.
+    """
+    if len(data) < _LEN_SIZE:
+        return (None, data)
+    (size,) = struct.unpack(_LEN_FORMAT, data[:_LEN_SIZE])
+    if size > _MAX_FRAME_SIZE:
+        raise WireError('Frame too large: %d bytes' % size)
+    if len(data) < _LEN_SIZE + size:
+        return (None, data)
+    return (data[_LEN_SIZE:_LEN_SIZE + size], data[_LEN_SIZE + size:])
+
+
+def pack_request(req_id, data):
+    return struct.pack(_ID_FORMAT, req_id) + data
+
+
+def unpack_request(payload):
+    """
+    Return (req_id, data) of the session payload.
+    """
+    if len(payload) < _ID_SIZE:
+        raise WireError('Invalid session payload: %r' % (payload,))
+    (req_id,) = struct.unpack(_ID_FORMAT, payload[:_ID_SIZE])
+    return (req_id, payload[_ID_SIZE:])
+
+
+class Session(object):
+    """
+    A long-lived connection, which pipelines requests and matches replies
+    by request id. It is safe to share one session between threads.
+
+    :param address:
+        The (ip, port) of server.
+    :param connect_timeout:
+        The timeout to connect and negotiate.
+
+    .. doctest::
+
+        >>> session = Session(('127.0.0.1', 8080))
+        >>> ids = [session.submit('GetInfo') for i in range(3)]
+        >>> [session.result(x, timeout=10) for x in ids]
+        >>> session.request('GetCmdStat sh-lvtest31 GhostClient', timeout=10)
+        >>> session.close()
+    """
+    def __init__(self, address, connect_timeout=10):
+        self.address = address
+        self.connect_timeout = connect_timeout
+        self._sock = None
+        self._next_id = 0
+        self._replies = {}
+        self._send_lock = threading.Lock()
+        # Guards _replies, only one thread receives at a time and the
+        # others wait for it.
+        self._recv_cond = threading.Condition(threading.Lock())
+        self._receiving = False
+        # Replies of the requests whose waiters have timed out.
+        self._abandoned = set()
+        # Increased whenever the socket is reset.
+        self._generation = 0
+
+    def _connect(self):
+        return connect(self.address, MODE_SESSION, self.connect_timeout,
+                       SessionRefusedError)
+
+    def is_open(self):
+        return self._sock is not None
+
+    def submit(self, data):
+        """
+        Send one request without waiting its reply, and return request id.
+        """
+        self._send_lock.acquire()
+        try:
+            if self._sock is None:
+                self._sock = self._connect()
+            self._next_id = (self._next_id + 1) % 0xFFFFFFFF
+            req_id = self._next_id
+            try:
+                send_frame(self._sock, pack_request(req_id, data))
+            except:
+                self._reset()
+                raise
+        finally:
+            self._send_lock.release()
+        return req_id
+
+    def result(self, req_id, timeout=None):
+        """
+        Wait the reply of request, and return its data.
+
+        :param timeout:
+            Seconds to wait in total, including waiting other threads to
+            receive, None or negative value means waiting forever.
+            If timeout in the middle of receiving, :class:`socket.timeout`
+            is raised and the session is closed, since the stream can't be
+            trusted any more.
+        """
+        deadline = None
+        if timeout is not None and timeout >= 0:
+            deadline = time.time() + timeout
+        self._recv_cond.acquire()
+        try:
+            generation = self._generation
+            while req_id not in self._replies:
+                if self._sock is None or self._generation != generation:
+                    raise WireError('Session is closed')
+                remain = None
+                if deadline is not None:
+                    remain = deadline - time.time()
+                    if remain <= 0:
+                        self._abandoned.add(req_id)
+                        raise socket.timeout('timed out')
+                if self._receiving:
+                    self._recv_cond.wait(remain)
+                else:
+                    self._receive(self._sock, remain)
+            return self._replies.pop(req_id)
+        finally:
+            self._recv_cond.release()
+
+    def _receive(self, sock, timeout):
+        """
+        Receive one reply. It's called with `_recv_cond` held, which is
+        released while receiving.
+        """
+        self._receiving = True
+        self._recv_cond.release()
+        try:
+            try:
+                sock.settimeout(timeout)
+                payload = recv_frame(sock)
+                if payload is None:
+                    if sock is not self._sock:
+                        raise WireError('Session is closed')
+                    raise WireError('Session is closed by server')
+                (reply_id, data) = unpack_request(payload)
+            except:
+                self._send_lock.acquire()
+                try:
+                    self._reset(sock)
+                finally:
+                    self._send_lock.release()
+                raise
+        finally:
+            self._recv_cond.acquire()
+            self._receiving = False
+            self._recv_cond.notifyAll()
+        if reply_id in self._abandoned:
+            self._abandoned.discard(reply_id)
+        else:
+            self._replies[reply_id] = data
+
+    def request(self, data, timeout=None):
+        """
+        Send one request and wait its reply.
+        """
+        return self.result(self.submit(data), timeout)
+
+    def _reset(self, sock=None):
+        """
+        Close the socket and drop the pending replies, the caller must hold
+        `_send_lock`. If `sock` is given, it's closed only if it's still the
+        socket in use.
+        """
+        self._recv_cond.acquire()
+        try:
+            if sock is not None and sock is not self._sock:
+                return
+            sock, self._sock = self._sock, None
+            self._replies.clear()
+            self._abandoned.clear()
+            self._generation += 1
+            self._recv_cond.notifyAll()
+        finally:
+            self._recv_cond.release()
+        if sock:
+            try:
+                # Wake up the thread blocked in receiving.
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            try:
+                sock.close()
+            except socket.error:
+                pass
+
+    def close(self):
+        self._send_lock.acquire()
+        try:
+            self._reset()
+        finally:
+            self._send_lock.release()
@@ -0,0 +1,125 @@
+"""A fake 'p4' client used by test_p4lib.py.
+
+It accepts 'p4 -G [-x argfile] [options] command [args]', writes canned
+marshalled tagged records to stdout, or text output of the 'client'
+command without '-G', and appends each command line to the
+file named by the FAKEP4_LOG environment variable. The records are also
+available by run_command() for a fake P4Python.
+
+File arguments which trigger error records:
+    * **bad** - an error with severity 3 (E_FAILED).
+    * **fatal** - an error with severity 4 (E_FATAL).
+"""
+import os
+import sys
+import marshal
+
+
+def emit_file_errors(emit, args):
+    """Emit error records for the special file arguments."""
+    for arg in args:
+        if arg == 'bad':
+            emit({'code': 'error', 'severity': 3,
+                  'data': 'bad - file(s) not in client view.\n'})
+        elif arg == 'fatal':
+            emit({'code': 'error', 'severity': 4,
+                  'data': 'Connect to server failed.\n'})
+    return [arg for arg in args if arg not in ('bad', 'fatal')]
+
+
+def run_command(argv):
+    """
+    Return the records of 'p4 command [args]', where `argv` is
+    [command] + args, without global options.
+    """
+    records = []
+    emit = records.append
+    cmd = argv[0]
+    args = emit_file_errors(emit, [x for x in argv[1:]
+                                   if not x.startswith('-')
+                                   and not x.isdigit()
+                                   and x not in ('submitted', 'pending')])
+
+    if cmd == 'where':
+        for arg in args:
+            emit({'code': 'stat', 'depotFile': arg,
+                  'clientFile': arg.replace('//depot', '//ws'),
+                  'path': arg.replace('//depot', '/ws')})
+        if args:
+            emit({'code': 'stat', 'depotFile': args[0], 'unmap': '',
+                  'clientFile': args[0].replace('//depot', '//ws'),
+                  'path': args[0].replace('//depot', '/ws')})
+    elif cmd == 'dirs':
+        for arg in args:
+            emit({'code': 'stat', 'dir': arg.replace('/*', '/v1')})
+    elif cmd == 'fstat':
+        for arg in args:
+            emit({'code': 'stat', 'depotFile': arg, 'headRev': '3',
+                  'headType': 'text', 'ourLock': ''})
+    elif cmd == 'changes':
+        emit({'code': 'stat', 'change': '12', 'time': '1300000000',
+              'user': 'alice', 'client': 'ws', 'desc': 'fix build\n',
+              'status': 'submitted'})
+    elif cmd == 'sync':
+        emit({'code': 'error', 'severity': 2,
+              'data': '//depot/up - file(s) up-to-date.\n'})
+        for arg in args:
+            emit({'code': 'stat', 'depotFile': arg, 'rev': '2',
+                  'action': 'updated',
+                  'clientFile': arg.replace('//depot', '/ws')})
+    elif cmd == 'filelog':
+        for arg in args:
+            emit({'code': 'stat', 'depotFile': arg,
+                  'rev0': '2', 'change0': '5', 'action0': 'integrate',
+                  'time0': '1300000000', 'user0': 'alice', 'client0': 'ws',
+                  'type0': 'text', 'desc0': 'merge\n',
+                  'how0,0': 'copy from', 'file0,0': '//depot/y',
+                  'srev0,0': '#1', 'erev0,0': '#3',
+                  'rev1': '1', 'change1': '4', 'action1': 'add',
+                  'time1': '1290000000', 'user1': 'bob', 'client1': 'ws',
+                  'type1': 'text', 'desc1': 'initial\n'})
+    else:
+        emit({'code': 'error', 'severity': 3,
+              'data': 'Unknown command.  Try \'p4 help\' for info.\n'})
+    return records
+
+
+def run_text_command(argv):
+    """Write the text output of 'p4 client -o|-d name'."""
+    if argv[:2] == ['client', '-d']:
+        sys.stdout.write('Client %s deleted.\n' % argv[2])
+    elif argv[:2] == ['client', '-o']:
+        sys.stdout.write('Client:\t%s\n\nRoot:\t/ws\n\nView:\n'
+                         '\t//depot/... //%s/...\n' % (argv[2], argv[2]))
+    else:
+        sys.stderr.write('Unknown command.\n')
+        return 1
+    return 0
+
+
+def main(argv):
+    if os.environ.get('FAKEP4_LOG'):
+        log = open(os.environ['FAKEP4_LOG'], 'a')
+        log.write(' '.join(argv) + '\n')
+        log.close()
+    if argv[0] != '-G':
+        while argv and argv[0] in ('-c', '-u', '-p', '-P', '-d', '-H'):
+            argv = argv[2:]
+        return run_text_command(argv)
+    argv = argv[1:]
+    args = []
+    if argv[:1] == ['-x']:
+        args = open(argv[1]).read().splitlines()
+        argv = argv[2:]
+    while argv and argv[0] in ('-c', '-u', '-p', '-P', '-d', '-H'):
+        argv = argv[2:]
+    records = run_command(argv + args)
+    for record in records:
+        marshal.dump(record, sys.stdout)
+    if records and 'Unknown command' in records[-1].get('data', ''):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
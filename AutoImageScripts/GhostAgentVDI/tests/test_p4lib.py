@@ -0,0 +1,257 @@
+"""Tests of :class:`nicu.p4lib.P4Session` against the fake 'p4' client in
+fakep4.py, and a fake P4Python built on it.
+
+Run from the GhostAgentVDI folder::
+
+    python -m unittest discover -s tests
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from nicu import p4lib
+import fakep4
+
+
+class FakeP4Exception(Exception):
+    pass
+
+
+class FakeP4(object):
+    """A fake P4Python connection, which runs commands by fakep4."""
+    connects = 0
+
+    def __init__(self):
+        self.exception_level = 2
+        self.errors = []
+        self.warnings = []
+        self.commands = []
+        self._connected = False
+
+    def connect(self):
+        FakeP4.connects += 1
+        self._connected = True
+
+    def connected(self):
+        return self._connected
+
+    def disconnect(self):
+        self._connected = False
+
+    def run(self, *argv):
+        assert self._connected
+        self.commands.append(argv)
+        records = fakep4.run_command(list(argv))
+        self.errors = [x['data'] for x in records if x['code'] == 'error'
+                       and x['severity'] >= 3]
+        self.warnings = [x['data'] for x in records if x['code'] == 'error'
+                         and x['severity'] == 2]
+        if self.errors or (self.warnings and self.exception_level > 1):
+            raise FakeP4Exception(self.errors or self.warnings)
+        return [x for x in records if x['code'] == 'stat']
+
+
+class FakeP4API(object):
+    """A fake 'P4' module of P4Python."""
+    P4 = FakeP4
+    P4Exception = FakeP4Exception
+
+
+@unittest.skipIf(os.name == 'nt', 'the fake p4 is started by a shell script')
+class P4SessionTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmpdir, 'p4.log')
+        p4 = os.path.join(self.tmpdir, 'p4')
+        f = open(p4, 'w')
+        f.write('#!/bin/sh\nexec "%s" "%s" "$@"\n'
+                % (sys.executable, os.path.join(HERE, 'fakep4.py')))
+        f.close()
+        os.chmod(p4, 0755)
+        os.environ['FAKEP4_LOG'] = self.log
+        self.p4 = p4lib.P4Session(p4=p4, port='perforce:1666', client='ws',
+                                  user='alice')
+
+    def tearDown(self):
+        del os.environ['FAKEP4_LOG']
+        shutil.rmtree(self.tmpdir)
+
+    def commands(self):
+        """Return the command lines which the fake p4 is started with."""
+        if not os.path.exists(self.log):
+            return []
+        return open(self.log).read().splitlines()
+
+    def date(self, seconds):
+        return time.strftime('%Y/%m/%d', time.localtime(seconds))
+
+    def test_where(self):
+        results = self.p4.where(['//depot/a b', '//depot/c'])
+        self.assertEqual(results[:2], [
+            {'depotFile': '//depot/a b', 'clientFile': '//ws/a b',
+             'localFile': '/ws/a b', 'minus': False},
+            {'depotFile': '//depot/c', 'clientFile': '//ws/c',
+             'localFile': '/ws/c', 'minus': False}])
+        self.assertTrue(results[2]['minus'])
+        commands = self.commands()
+        self.assertEqual(len(commands), 1)
+        self.assertTrue(commands[0].startswith('-G -x '))
+
+    def test_dirs(self):
+        self.assertEqual(self.p4.dirs('//depot/*'), ['//depot/v1'])
+        self.assertRaises(p4lib.P4LibError, self.p4.dirs, [])
+
+    def test_fstat(self):
+        (hit, ) = self.p4.fstat('//depot/a')
+        self.assertEqual(hit['depotFile'], '//depot/a')
+        self.assertEqual(hit['headRev'], 3)
+        self.assertEqual(hit['headType'], 'text')
+        self.assertEqual(hit['ourLock'], 1)
+        self.assertEqual(hit['haveRev'], 0)
+
+    def test_changes(self):
+        self.assertEqual(self.p4.changes(max=1, status='submitted'), [
+            {'change': 12, 'date': self.date(1300000000), 'user': 'alice',
+             'client': 'ws', 'description': 'fix build'}])
+        self.assertEqual(
+            self.p4.changes(longOutput=1)[0]['description'], 'fix build\n')
+
+    def test_sync(self):
+        files = ['//depot/f%d' % i for i in range(25)]
+        hits = self.p4.sync(files, force=1)
+        self.assertEqual(len(hits), 25)
+        self.assertEqual(hits[0], {'depotFile': '//depot/f0', 'rev': 2,
+                                   'comment': 'updating /ws/f0',
+                                   'notes': []})
+        # All files are passed in one argument file, not 10 per process.
+        self.assertEqual(len(self.commands()), 1)
+
+    def test_sync_warning(self):
+        # The severity 2 record "file(s) up-to-date." is not an error.
+        self.assertEqual(self.p4.sync('//depot/a')[0]['depotFile'],
+                         '//depot/a')
+
+    def test_filelog(self):
+        (hit, ) = self.p4.filelog('//depot/x')
+        self.assertEqual(hit['depotFile'], '//depot/x')
+        self.assertEqual(len(hit['revs']), 2)
+        self.assertEqual(hit['revs'][0], {
+            'rev': 2, 'change': 5, 'action': 'integrate',
+            'date': self.date(1300000000), 'user': 'alice', 'client': 'ws',
+            'type': 'text', 'description': 'merge',
+            'notes': ['copy from //depot/y#2,#3']})
+        self.assertEqual(hit['revs'][1]['notes'], [])
+
+    def test_where_memo(self):
+        results = self.p4.where('//depot/a')
+        results[0]['localFile'] = 'changed'
+        self.assertEqual(self.p4.where('//depot/a')[0]['localFile'],
+                         '/ws/a')
+        self.assertEqual(self.p4.where(['//depot/a'])[0]['localFile'],
+                         '/ws/a')
+        self.assertEqual(len(self.commands()), 1)
+        self.assertEqual(self.p4.savedSpawns, 2)
+
+    def test_dirs_memo(self):
+        self.assertEqual(self.p4.dirs('//depot/*'), ['//depot/v1'])
+        self.assertEqual(self.p4.dirs('//depot/*'), ['//depot/v1'])
+        self.assertEqual(len(self.commands()), 1)
+        self.assertEqual(self.p4.savedSpawns, 1)
+        # Same arguments of another command are not shared.
+        self.p4.where('//depot/*')
+        self.assertEqual(len(self.commands()), 2)
+
+    def test_memo_key(self):
+        self.p4.where('//depot/a')
+        self.p4.where('//depot/b')
+        self.p4.where('//depot/a', client='other')
+        self.p4.where('//depot/a', port='pacific:1666')
+        self.assertEqual(len(self.commands()), 4)
+        self.assertEqual(self.p4.savedSpawns, 0)
+        self.assertTrue('-c other' in self.commands()[2])
+        self.p4.where('//depot/a', client='other')
+        self.assertEqual(len(self.commands()), 4)
+        self.assertEqual(self.p4.savedSpawns, 1)
+
+    def test_client_get_keeps_memo(self):
+        self.p4.where('//depot/a')
+        self.assertEqual(self.p4.client(name='ws')['client'], 'ws')
+        self.p4.where('//depot/a')
+        self.assertEqual(self.p4.savedSpawns, 1)
+
+    def test_client_delete_clears_memo(self):
+        self.p4.where('//depot/a')
+        self.p4.dirs('//depot/*')
+        self.assertEqual(self.p4.client(name='ws', delete=True),
+                         {'client': 'ws', 'action': 'deleted'})
+        self.p4.where('//depot/a')
+        self.p4.dirs('//depot/*')
+        self.assertEqual(self.p4.savedSpawns, 0)
+        self.assertEqual(len(self.commands()), 5)
+
+    def test_failed_error(self):
+        self.assertRaises(p4lib.P4LibError, self.p4.where, 'bad')
+        self.assertRaises(p4lib.P4LibError, self.p4.fstat,
+                          ['//depot/a', 'bad'])
+
+    def test_fatal_error(self):
+        self.assertRaises(p4lib.P4LibError, self.p4.sync, 'fatal')
+
+    def test_failed_command(self):
+        self.assertRaises(p4lib.P4LibError, self.p4._p4run_tagged,
+                          ['unknown'])
+
+
+class P4SessionApiTest(unittest.TestCase):
+    def setUp(self):
+        self.api = p4lib._P4API
+        p4lib._P4API = FakeP4API
+        FakeP4.connects = 0
+        self.p4 = p4lib.P4Session(port='perforce:1666', client='ws',
+                                  user='alice')
+
+    def tearDown(self):
+        self.p4.close()
+        p4lib._P4API = self.api
+
+    def test_persistent(self):
+        self.assertTrue(self.p4.persistent)
+        self.assertFalse(p4lib.P4Session(p4='/usr/bin/p4').persistent)
+
+    def test_one_connection(self):
+        self.assertEqual(self.p4.where('//depot/a')[0]['localFile'],
+                         '/ws/a')
+        self.assertEqual(self.p4.dirs('//depot/*'), ['//depot/v1'])
+        self.assertEqual(self.p4.changes(max=1)[0]['change'], 12)
+        self.assertEqual(len(self.p4.sync(['//depot/a', '//depot/b'])), 2)
+        self.assertEqual(FakeP4.connects, 1)
+        (conn, ) = self.p4._connections.values()
+        self.assertEqual((conn.port, conn.user, conn.client),
+                         ('perforce:1666', 'alice', 'ws'))
+        self.assertEqual(conn.exception_level, 1)
+
+    def test_other_client(self):
+        self.p4.where('//depot/a')
+        self.p4.where('//depot/a', client='other')
+        self.assertEqual(FakeP4.connects, 2)
+
+    def test_reconnect_after_close(self):
+        self.p4.where('//depot/a')
+        self.p4.close()
+        self.p4.fstat('//depot/a')
+        self.assertEqual(FakeP4.connects, 2)
+
+    def test_error(self):
+        self.assertRaises(p4lib.P4LibError, self.p4.where, 'bad')
+        self.assertRaises(p4lib.P4LibError, self.p4.sync, 'fatal')
+
+
+
+if __name__ == '__main__':
+    unittest.main()
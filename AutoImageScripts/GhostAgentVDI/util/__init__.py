@@ -1,7 +1,12 @@
 import os
 import sys
+import time
 import stat
 import socket
+import select
+import errno
+import Queue
+import threading
 import logging
 from logging.handlers import TimedRotatingFileHandler
 import shutil
@@ -31,6 +36,8 @@ except:
 
 __all__ = [
     "ThreadedTCPServer",
+    "SelectTCPServer",
+    "WorkerPool",
     "set_logger",
     "retries_default_hook",
     "retries_default",
@@ -90,6 +97,185 @@ class ThreadedTCPServer(MyThreadingMixIn, SocketServer.TCPServer):
     pass
 
 
+class WorkerPool(object):
+    """
+    A bounded pool of :class:`KThread` workers.
+
+    Workers are started on demand until `max_workers` is reached, after that
+    new tasks are queued until one worker is free. Workers are still
+    :class:`KThread`, so a worker could be killed (e.g. by `ReleaseMachine`),
+    and it will be replaced when the next task arrives.
+
+    :param max_workers:
+        The max count of worker threads.
+    :param target:
+        The function to call with the arguments of each task.
+    """
+    def __init__(self, max_workers, target):
+        self.max_workers = max(1, int(max_workers))
+        self._target = target
+        self._tasks = Queue.Queue()
+        self._workers = []
+        self._idle_count = 0
+        self._lock = threading.Lock()
+
+    def submit(self, *args):
+        """
+        Queue a task, and start a new worker if no worker is idle.
+        """
+        self._lock.acquire()
+        try:
+            self._workers = [t for t in self._workers if t.isAlive()]
+            if (self._idle_count <= self._tasks.qsize()
+                    and len(self._workers) < self.max_workers):
+                worker = KThread(target=self._work)
+                worker.setDaemon(1)
+                self._workers.append(worker)
+                self._idle_count += 1
+                worker.start()
+            self._tasks.put(args)
+        finally:
+            self._lock.release()
+        return
+
+    def _set_idle(self, delta):
+        self._lock.acquire()
+        self._idle_count += delta
+        self._lock.release()
+
+    def _work(self):
+        while True:
+            args = self._tasks.get()
+            self._set_idle(-1)
+            self._target(*args)
+            self._set_idle(1)
+
+
+class SelectTCPServer(SocketServer.TCPServer):
+    """
+    A tcp server which multiplexes all client sockets in one select loop.
+
+    The loop accepts new connections and waits until the command arrives,
+    without creating any thread. Commands in :attr:`inline_commands` are
+    cheap and handled in the loop directly, the others are handed to
+    a :class:`WorkerPool` with `max_workers` threads.
+
+    The handler is the same as :class:`ThreadedTCPServer`, since the command
+    is only peeked here, and still received by the handler itself.
+    The listen backlog is also larger, to absorb reconnection bursts.
+
+    Connections which send nothing in `idle_timeout` seconds are closed,
+    as the handler in :class:`ThreadedTCPServer` would wait forever.
+    """
+    inline_commands = ('GETINFO', 'SETLOGLEVEL')
+    request_queue_size = 128
+
+    def __init__(self, server_address, RequestHandlerClass, max_workers=None,
+                 idle_timeout=None):
+        SocketServer.TCPServer.__init__(self, server_address,
+                                        RequestHandlerClass)
+        if max_workers is None:
+            max_workers = gv.g_server_max_workers
+        if idle_timeout is None:
+            idle_timeout = gv.g_server_client_idle_timeout
+        self.idle_timeout = idle_timeout
+        self.pool = WorkerPool(max_workers, self.process_request_thread)
+        self._clients = {}
+        self._loop_ident = None
+        self._shutdown_request = False
+        self._is_shut_down = threading.Event()
+
+    def serve_forever(self, poll_interval=0.5):
+        """
+        Handle requests until :meth:`shutdown` is called.
+        """
+        self._is_shut_down.clear()
+        self._loop_ident = thread.get_ident()
+        try:
+            while not self._shutdown_request:
+                try:
+                    readable = select.select([self.socket] + self._clients.keys(),
+                                             [], [], poll_interval)[0]
+                except select.error, error:
+                    if error.args[0] == errno.EINTR:
+                        continue
+                    raise
+                for sock in readable:
+                    if sock is self.socket:
+                        self._accept_request()
+                    else:
+                        self._dispatch_request(sock)
+                self._close_idle_requests()
+        finally:
+            for request in self._clients.keys():
+                self.close_request(request)
+            self._clients.clear()
+            self._shutdown_request = False
+            self._is_shut_down.set()
+        return
+
+    def shutdown(self):
+        """
+        Stop the :meth:`serve_forever` loop, and wait until it exits
+        if it is called from another thread.
+        """
+        self._shutdown_request = True
+        if self._loop_ident != thread.get_ident():
+            self._is_shut_down.wait()
+        return
+
+    def _accept_request(self):
+        try:
+            request, client_address = self.get_request()
+        except socket.error:
+            return
+        if self.verify_request(request, client_address):
+            self._clients[request] = (client_address, time.time())
+        else:
+            self.close_request(request)
+        return
+
+    def _close_idle_requests(self):
+        if not self.idle_timeout:
+            return
+        expire_time = time.time() - self.idle_timeout
+        for (request, (client_address, accept_time)) in self._clients.items():
+            if accept_time < expire_time:
+                LOGGER.warning("Close connection from %s, since no command"
+                               " is received in %s seconds"
+                               % (client_address, self.idle_timeout))
+                del self._clients[request]
+                self.close_request(request)
+        return
+
+    def _dispatch_request(self, request):
+        client_address = self._clients.pop(request)[0]
+        try:
+            data = request.recv(512, socket.MSG_PEEK)
+        except socket.error:
+            data = ''
+        if not data:
+            self.close_request(request)
+            return
+        cmd = (data.split() or [''])[0].upper()
+        if cmd in self.inline_commands:
+            self.process_request_thread(request, client_address)
+        else:
+            self.pool.submit(request, client_address)
+        return
+
+    def process_request_thread(self, request, client_address):
+        """
+        Same as :meth:`MyThreadingMixIn.process_request_thread`.
+        """
+        try:
+            self.finish_request(request, client_address)
+            self.close_request(request)
+        except:
+            self.handle_error(request, client_address)
+            self.close_request(request)
+
+
 class LastErrorHandler(logging.Handler):
     """
     A handle to record last error, and make codes more intuitive.
@@ -407,6 +593,11 @@ def upgrade_ghostagent():
         # directly from Symantec Ghost Console. So we want to reserve it.
         if directory.lower() == "ghostscripts":
             continue
+        # keep the mirror of image templates, which is costly to copy again.
+        if (gv.g_vm_template_cache_root and
+                os.path.join(gv.g_ga_root, directory) ==
+                os.path.normpath(gv.g_vm_template_cache_root)):
+            continue
         delete_path(os.path.join(gv.g_ga_root, directory))
 
     # Also need to use system call to copy, to avoid copying failed.
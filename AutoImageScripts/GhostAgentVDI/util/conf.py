@@ -42,8 +42,14 @@ def gen_ini_step(si_config, seq_id_template):
     # Generate an ini file by seq_id
     seq_info = dbx.queryx_sequence_info(seq_id)
     step_ids = seq_info[0].split(",")
+    # Query all steps at once, rather than one by one.
+    steps_info = dbx.queryx_steps_info(step_ids)
     for i, step_id in enumerate(step_ids):
-        step_info = dbx.queryx_step_info(step_id)
+        step_info = steps_info.get(int(step_id))
+        if step_info is None:
+            LOGGER.error("Step %s of sequence %s doesn't exist"
+                         % (step_id, seq_id), extra={'error_level': 2})
+            raise Exception(errcode.ER_GA_GEN_CONF_EXCEPTION)
         step_name = "step%s" % (i)
         si_config.set("steps", step_name, 1)
         si_config.add_section(step_name)
@@ -101,7 +107,8 @@ def gen_ini_step(si_config, seq_id_template):
     return step_seq
 
 
-def get_run_key_value(is_vm_image, target_os_platform, target_os_bit):
+def get_run_key_value(is_vm_image, target_os_platform, target_os_bit,
+                      vm_root=None):
     """
     Get value of key `run_key_value` in `script.ini`.
 
@@ -111,18 +118,21 @@ def get_run_key_value(is_vm_image, target_os_platform, target_os_bit):
         The os platform of target machine.
     :param target_os_bit:
         The os bit of target machine.
+    :param vm_root:
+        The working directory in vmware, default is `gt_vm_root`.
     :returns:
         The value of key `run_key_value`.
     """
     gvt, hdl = util.export_target_modules()
     run_key_value = ''
     if is_vm_image:
+        if not vm_root:
+            vm_root = gvt.gt_vm_root
         if target_os_platform == 'windows':
             run_key_value = ('cmd /c "%s\\boot.bat %s"'
-                             % (gvt.gt_vm_root,
-                                gvt.gt_vm_root))
+                             % (vm_root, vm_root))
         elif target_os_platform == 'linux':
-            run_key_value = '%s/boot.sh' % gvt.gt_vm_root
+            run_key_value = '%s/boot.sh' % vm_root
     else:
         if target_os_platform == 'windows':
             if target_os_bit == 32:
@@ -208,7 +218,7 @@ def gen_ghost_conf(machine_id, os_id, seq_id, emails, req_addr=None,
         # Registry Settings
         si_config.add_section("settings")
         run_key_value = get_run_key_value(is_vm_image, target_os_platform,
-                                          target_os_bit)
+                                          target_os_bit, boot_dir_home)
         if run_key_value:
             si_config.set("settings", "run_key_value", run_key_value)
         si_config.set("settings", "AutoAdminLoginOriginalState", "1")
@@ -447,7 +457,9 @@ def gen_setupenv_script(target_os_platform, **argv):
         odict['script_ini_dir_server'] = (gvt.gt_vm_script_root %
             (gv.g_apply_images_folder, group_name, machine_name, os_id))
 
-    data_render = Template(filename=setupenv_script_local).render(**odict)
+    # Render the local copy of template in INCOMING, whose compiled form
+    # is cached, so that it's compiled only once for all machines.
+    data_render = Template(filename=setupenv_script_full).render(**odict)
     with open(setupenv_script_local, 'wb') as fp:
         fp.write(data_render)
 
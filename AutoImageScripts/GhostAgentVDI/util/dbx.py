@@ -8,10 +8,17 @@ All functions operate as follows:
 Error code is one of the following values:
     * **errcode.ER_DB_CDE_ERROR** - CommonDatabaseException
     * **errcode.ER_DB_COMMON_ERROR** - Other Exception
+
+Lookups of reference tables, such as `Machine_Info` and `OS_Info`, are read
+through :data:`nicu.refcache.ref_cache`, and writes by this module
+invalidate the related table. A write whose condition is a single
+`<Column>ID=<value>` only invalidates the entries of that record.
 """
+import re
 import logging
 
 from nicu.db import SQLServerDB, CommonDatabaseException
+from nicu.refcache import ref_cache
 import nicu.errcode as errcode
 import util
 
@@ -26,10 +33,12 @@ __all__ = [
     "queryx_target_server_info",
     "queryx_sequence_info",
     "queryx_step_info",
+    "queryx_steps_info",
     "queryx_is_general",
     "queryx_general_info",
     "queryx_image_info",
     "queryx_machine_name",
+    "queryx_machine_ids",
     "queryx_machine_info",
     "queryx_machine_current_os_id",
     "queryx_all_images",
@@ -47,7 +56,33 @@ __all__ = [
 LOGGER = logging.getLogger(__name__)
 
 
-def queryx_table(table, columns, condition, only_one=False):
+def _bind(condition, params):
+    """
+    Return (condition, params) for the statement. If `params` is None, the
+    condition is a literal one, and it is kept as None, so that the
+    statement is executed as it is, without the statement cache.
+    """
+    if params is None:
+        return (condition, None)
+    return (condition, tuple(params))
+
+
+def _record_ident(condition, params):
+    """
+    Return (column, value) if `condition` selects one record by its ID,
+    such as "MachineID=1" or "MachineID=%s", otherwise None.
+    """
+    match = re.match(r'^\s*(\w+ID)\s*=\s*(%s|\d+)\s*$', condition, re.I)
+    if not match:
+        return None
+    if match.group(2) != '%s':
+        return (match.group(1), match.group(2))
+    if params is not None and len(params) == 1:
+        return (match.group(1), tuple(params)[0])
+    return None
+
+
+def queryx_table(table, columns, condition, only_one=False, params=None):
     """
     Query record(s) of table.
 
@@ -59,6 +94,9 @@ def queryx_table(table, columns, condition, only_one=False):
         The filter to query.
     :param only_one:
         Whether we only need one result.
+    :param params:
+        The values bound to `%s` placeholders in `condition`. The statement
+        text is the same for all values, so its plan is reused by server.
 
     .. doctest::
 
@@ -68,6 +106,9 @@ def queryx_table(table, columns, condition, only_one=False):
         >>> queryx_table("Machine_Info", ["MachineID", "GroupID"],
         ...              "MachineName='sh-lvtest01'")
         [[1, 1]]
+        >>> queryx_table("Machine_Info", "MachineID, GroupID",
+        ...              "MachineName=%s", True, params=['sh-lvtest01'])
+        [1, 1]
 
     .. note::
         When set `only_one` as True:
@@ -77,19 +118,22 @@ def queryx_table(table, columns, condition, only_one=False):
     ret_code = 0
     try:
         cols = ','.join(columns) if isinstance(columns, list) else columns
+        (condition, params) = _bind(condition, params)
         sql_str = "select %s from %s where %s" % (cols, table, condition)
         if only_one:
-            result = SQLServerDB.query_one(sql_str)
+            result = SQLServerDB.query_one(sql_str, params=params)
         else:
-            result = SQLServerDB.query(sql_str)
+            result = SQLServerDB.query(sql_str, params=params)
     except CommonDatabaseException, error:
         LOGGER.error(
-            'Failed to query SQL statement "%s": %s' % (sql_str, error),
+            'Failed to query SQL statement "%s" %s: %s'
+            % (sql_str, params, error),
             extra={'error_level': 3})
         ret_code = errcode.ER_DB_CDE_ERROR
     except Exception, error:
         LOGGER.error(
-            'Failed to query SQL statement "%s", may be invalid: %s' % (sql_str, error),
+            'Failed to query SQL statement "%s" %s, may be invalid: %s'
+            % (sql_str, params, error),
             extra={'error_level': 3})
         ret_code = errcode.ER_DB_COMMON_ERROR
     if ret_code:
@@ -97,7 +141,8 @@ def queryx_table(table, columns, condition, only_one=False):
     return result
 
 
-def updatex_table(table, column, new_value, condition, quote=False):
+def updatex_table(table, column, new_value, condition, quote=False,
+                  params=None):
     """
     Update one record of table.
 
@@ -112,6 +157,11 @@ def updatex_table(table, column, new_value, condition, quote=False):
     :param quote:
         Whether add single quote to the new value. It is used when to update
         value of a string.
+    :param params:
+        The values bound to `%s` placeholders in `condition`.
+
+    The new value is bound as a parameter if it is a string to quote, a bool
+    or an integer, otherwise it is used as a SQL expression, e.g. GETDATE().
 
     .. doctest::
 
@@ -124,21 +174,34 @@ def updatex_table(table, column, new_value, condition, quote=False):
     """
     ret_code = 0
     try:
-        if isinstance(new_value, bool):
-            new_value = int(new_value)
+        ident = _record_ident(condition, params)
+        if ident and ident[0].lower() == column.lower():
+            # The record moves to another ID.
+            ident = None
+        (condition, params) = _bind(condition, params)
+        if quote or isinstance(new_value, (bool, int, long)):
+            if params is None:
+                (condition, params) = (condition.replace('%', '%%'), ())
+            params = (new_value,) + params
+            new_value = '%s'
         else:
-            new_value = new_value if not quote else "'%s'" % (new_value)
+            new_value = '%s' % (new_value,)
+            if params is not None:
+                new_value = new_value.replace('%', '%%')
         sql_str = ("update %s set %s=%s where %s"
                    % (table, column, new_value, condition))
-        SQLServerDB.execute(sql_str)
+        SQLServerDB.execute(sql_str, params=params)
+        ref_cache.invalidate(table, ident)
     except CommonDatabaseException, error:
         LOGGER.error(
-            'Failed to execute SQL statement "%s": %s' % (sql_str, error),
+            'Failed to execute SQL statement "%s" %s: %s'
+            % (sql_str, params, error),
             extra={'error_level': 3})
         ret_code = errcode.ER_DB_CDE_ERROR
     except Exception, error:
         LOGGER.error(
-            'Failed to execute SQL statement "%s": %s' % (sql_str, error),
+            'Failed to execute SQL statement "%s" %s: %s'
+            % (sql_str, params, error),
             extra={'error_level': 3})
         ret_code = errcode.ER_DB_COMMON_ERROR
     if ret_code:
@@ -146,7 +209,7 @@ def updatex_table(table, column, new_value, condition, quote=False):
     return ret_code
 
 
-def insertx_table(table, columns, values):
+def insertx_table(table, columns, values, params=None):
     """
     Insert one record of table.
 
@@ -156,6 +219,8 @@ def insertx_table(table, columns, values):
         The columns to insert, it can be a string or a list of strings.
     :param values:
         The values of the columns, it need be a string.
+    :param params:
+        The values bound to `%s` placeholders in `values`.
 
     .. doctest::
 
@@ -169,16 +234,20 @@ def insertx_table(table, columns, values):
     ret_code = 0
     try:
         cols = ','.join(columns) if isinstance(columns, list) else columns
+        (values, params) = _bind(values, params)
         sql_str = ("insert into %s(%s) VALUES (%s)" % (table, cols, values))
-        SQLServerDB.execute(sql_str)
+        SQLServerDB.execute(sql_str, params=params)
+        ref_cache.invalidate(table)
     except CommonDatabaseException, error:
         LOGGER.error(
-            'Failed to execute SQL statement "%s": %s' % (sql_str, error),
+            'Failed to execute SQL statement "%s" %s: %s'
+            % (sql_str, params, error),
             extra={'error_level': 3})
         ret_code = errcode.ER_DB_CDE_ERROR
     except Exception, error:
         LOGGER.error(
-            'Failed to execute SQL statement "%s": %s' % (sql_str, error),
+            'Failed to execute SQL statement "%s" %s: %s'
+            % (sql_str, params, error),
             extra={'error_level': 3})
         ret_code = errcode.ER_DB_COMMON_ERROR
     if ret_code:
@@ -186,7 +255,7 @@ def insertx_table(table, columns, values):
     return ret_code
 
 
-def deletex_table(table, condition):
+def deletex_table(table, condition, params=None):
     """
     Delete records of table.
 
@@ -194,6 +263,8 @@ def deletex_table(table, condition):
         The table to delete.
     :param condition:
         The filter to delete.
+    :param params:
+        The values bound to `%s` placeholders in `condition`.
 
     .. doctest::
 
@@ -202,16 +273,21 @@ def deletex_table(table, condition):
     """
     ret_code = 0
     try:
+        ident = _record_ident(condition, params)
+        (condition, params) = _bind(condition, params)
         sql_str = ("delete from %s where %s" % (table, condition))
-        SQLServerDB.execute(sql_str)
+        SQLServerDB.execute(sql_str, params=params)
+        ref_cache.invalidate(table, ident)
     except CommonDatabaseException, error:
         LOGGER.error(
-            'Failed to execute SQL statement "%s": %s' % (sql_str, error),
+            'Failed to execute SQL statement "%s" %s: %s'
+            % (sql_str, params, error),
             extra={'error_level': 3})
         ret_code = errcode.ER_DB_CDE_ERROR
     except Exception, error:
         LOGGER.error(
-            'Failed to execute SQL statement "%s": %s' % (sql_str, error),
+            'Failed to execute SQL statement "%s" %s: %s'
+            % (sql_str, params, error),
             extra={'error_level': 3})
         ret_code = errcode.ER_DB_COMMON_ERROR
     if ret_code:
@@ -228,8 +304,11 @@ def queryx_target_os_info(os_id):
     """
     table = "OS_Info"
     columns = "OSPlatform, OSBit, VMwareImage"
-    condition = "OSID=%s" % (os_id)
-    row = queryx_table(table, columns, condition, only_one=True)
+    condition = "OSID=%s"
+    row = ref_cache.get(
+        table, ('info', str(os_id)),
+        lambda: queryx_table(table, columns, condition, only_one=True,
+                             params=(os_id,)))
     (target_os_platform, target_os_bit, target_vm_image_dir) = row
     target_os_platform = target_os_platform.lower()
     return (target_os_platform, target_os_bit, target_vm_image_dir)
@@ -246,9 +325,12 @@ def queryx_target_server_info(machine_id, os_id):
     """
     table = "Machine_Reimage as R, GhostServer as G"
     columns = "G.ServerName, G.ServerPort, R.IsVM"
-    condition = ("R.ServerID=G.ServerID and R.MachineID=%s and R.OSID=%s"
-                 % (machine_id, os_id))
-    row = queryx_table(table, columns, condition, only_one=True)
+    condition = "R.ServerID=G.ServerID and R.MachineID=%s and R.OSID=%s"
+    row = ref_cache.get(
+        ('Machine_Reimage', 'GhostServer'),
+        ('server', str(machine_id), str(os_id)),
+        lambda: queryx_table(table, columns, condition, only_one=True,
+                             params=(machine_id, os_id)))
     return row
 
 
@@ -261,8 +343,9 @@ def queryx_sequence_info(seq_id):
     """
     table = "GhostSequences"
     columns = "Sequence, IsPublic"
-    condition = "SeqID=%s" % (seq_id)
-    row = queryx_table(table, columns, condition, only_one=True)
+    condition = "SeqID=%s"
+    row = queryx_table(table, columns, condition, only_one=True,
+                       params=(seq_id,))
     return row
 
 
@@ -277,11 +360,35 @@ def queryx_step_info(step_id):
     columns = ("Type, Command, Flags, BasePath, PathSuffix, "
                "LatestInstaller, SleepUntilReboot, NotifierHost, "
                "NotifierPort, NotifierMsg, AlwaysRun")
-    condition = "StepID=%s" % (step_id)
-    row = queryx_table(table, columns, condition, only_one=True)
+    condition = "StepID=%s"
+    row = queryx_table(table, columns, condition, only_one=True,
+                       params=(step_id,))
     return row
 
 
+def queryx_steps_info(step_ids):
+    """
+    Query information of all `StepID` in one statement, return a dict of
+    `StepID` and the row, which is the same as :func:`queryx_step_info`.
+
+    :param step_ids:
+        A list of `StepID` column in `GhostSteps` table.
+    """
+    steps_info = {}
+    step_ids = list(set([int(x) for x in step_ids]))
+    if not step_ids:
+        return steps_info
+    table = "GhostSteps"
+    columns = ("StepID, Type, Command, Flags, BasePath, PathSuffix, "
+               "LatestInstaller, SleepUntilReboot, NotifierHost, "
+               "NotifierPort, NotifierMsg, AlwaysRun")
+    condition = "StepID in (%s)" % ', '.join(['%s'] * len(step_ids))
+    rows = queryx_table(table, columns, condition, params=step_ids)
+    for row in rows:
+        steps_info[int(row[0])] = tuple(row[1:])
+    return steps_info
+
+
 def queryx_is_general(machine_id, os_id):
     """
     Query whether image of target (`MachineID`, `OSID`) is general image.
@@ -293,8 +400,9 @@ def queryx_is_general(machine_id, os_id):
     """
     table = "GhostNew_Info"
     columns = "count(*)"
-    condition = "MachineID=%s and OSID=%s" % (machine_id, os_id)
-    (count, ) = queryx_table(table, columns, condition, only_one=True)
+    condition = "MachineID=%s and OSID=%s"
+    (count, ) = queryx_table(table, columns, condition, only_one=True,
+                             params=(machine_id, os_id))
     return int(count) > 0
 
 
@@ -309,8 +417,9 @@ def queryx_general_info(machine_id, os_id):
     """
     table = "GhostNew_Info"
     columns = "ImageSource"
-    condition = "MachineID=%s and OSID=%s" % (machine_id, os_id)
-    rows = queryx_table(table, columns, condition)
+    condition = "MachineID=%s and OSID=%s"
+    rows = queryx_table(table, columns, condition,
+                        params=(machine_id, os_id))
     return [(len(rows) > 0), None if not rows else rows[0][0]]
 
 
@@ -327,11 +436,11 @@ def queryx_image_info(machine_id, os_id, condition_added=''):
     """
     table = "Machine_Reimage as M, GhostServer as G"
     columns = ("M.IsVM, M.ImageSource, M.LoginUsr, M.LoginPwd, G.VMRoot")
-    condition = ("G.ServerID=M.ServerID and M.MachineID=%s and M.OSID=%s"
-                 % (machine_id, os_id))
+    condition = "G.ServerID=M.ServerID and M.MachineID=%s and M.OSID=%s"
     if condition_added:
-        condition += ' and %s' % (condition_added)
-    row = queryx_table(table, columns, condition, only_one=True)
+        condition += ' and %s' % (condition_added.replace('%', '%%'))
+    row = queryx_table(table, columns, condition, only_one=True,
+                       params=(machine_id, os_id))
     return row
 
 
@@ -344,11 +453,34 @@ def queryx_machine_name(machine_id):
     """
     table = "Machine_Info"
     columns = "MachineName"
-    condition = ("MachineID=%s" % (machine_id))
-    row = queryx_table(table, columns, condition, only_one=True)
+    condition = "MachineID=%s"
+    row = ref_cache.get(
+        table, ('name', str(machine_id)),
+        lambda: queryx_table(table, columns, condition, only_one=True,
+                             params=(machine_id,)),
+        ident=('MachineID', machine_id))
     return row
 
 
+def queryx_machine_ids(machine_names):
+    """
+    Query `MachineName`, `MachineID` of all target `MachineName` in one
+    statement. Names which don't exist are not included.
+
+    :param machine_names:
+        A list of `MachineName` column in `Machine_Info` table.
+    """
+    if not machine_names:
+        return []
+    table = "Machine_Info"
+    columns = "MachineName, MachineID"
+    machine_names = list(set(machine_names))
+    condition = ("MachineName in (%s)"
+                 % ', '.join(['%s'] * len(machine_names)))
+    rows = queryx_table(table, columns, condition, params=machine_names)
+    return rows
+
+
 def queryx_machine_info(machine_id):
     """
     Query `MachineName`, `GroupName` of target `MachineID`.
@@ -359,8 +491,12 @@ def queryx_machine_info(machine_id):
     table = "Machine_Info, MachineGroup_Info"
     columns = "Machine_Info.MachineName, MachineGroup_Info.GroupName"
     condition = ("MachineID=%s AND Machine_Info.GroupID="
-                 "MachineGroup_Info.GroupID" % (machine_id))
-    row = queryx_table(table, columns, condition, only_one=True)
+                 "MachineGroup_Info.GroupID")
+    row = ref_cache.get(
+        ('Machine_Info', 'MachineGroup_Info'), ('info', str(machine_id)),
+        lambda: queryx_table(table, columns, condition, only_one=True,
+                             params=(machine_id,)),
+        ident=('MachineID', machine_id))
     return row
 
 
@@ -373,8 +509,9 @@ def queryx_machine_current_os_id(machine_id):
     """
     table = "Machine_Info"
     columns = "CurrentOSID"
-    condition = ("MachineID=%s" % (machine_id))
-    row = queryx_table(table, columns, condition, only_one=True)
+    condition = "MachineID=%s"
+    row = queryx_table(table, columns, condition, only_one=True,
+                       params=(machine_id,))
     return row
 
 
@@ -389,10 +526,10 @@ def queryx_all_images(machine_id, condition_added=''):
     """
     table = "Machine_Reimage"
     columns = "ImageSource, LoginUsr, LoginPwd"
-    condition = "MachineID=%s and IsVM=1" % (machine_id)
+    condition = "MachineID=%s and IsVM=1"
     if condition_added:
-        condition += ' and %s' % (condition_added)
-    rows = queryx_table(table, columns, condition)
+        condition += ' and %s' % (condition_added.replace('%', '%%'))
+    rows = queryx_table(table, columns, condition, params=(machine_id,))
     return rows
 
 
@@ -409,8 +546,9 @@ def queryx_daily_ghost(machine_id):
                "DailyGhost.Paused, DailyGhost.CurrentDaily, "
                "DailyGhost.StartTime, OS_Info.OSPlatform")
     condition = ("DailyGhost.MachineID=%s and DailyGhost.CurrentDaily = 1 "
-                 "and OS_Info.OSID = DailyGhost.OSID" % (machine_id))
-    row = queryx_table(table, columns, condition, only_one=True)
+                 "and OS_Info.OSID = DailyGhost.OSID")
+    row = queryx_table(table, columns, condition, only_one=True,
+                       params=(machine_id,))
     return row
 
 
@@ -424,8 +562,11 @@ def queryx_server_info(server_id):
     table = "GhostServer"
     columns = ("ServerName, ServerDomain, LoginUsr, LoginPwd, "
                "ServerType, VMRoot")
-    condition = "ServerID=%s" % (server_id)
-    row = queryx_table(table, columns, condition, only_one=True)
+    condition = "ServerID=%s"
+    row = ref_cache.get(
+        table, ('info', str(server_id)),
+        lambda: queryx_table(table, columns, condition, only_one=True,
+                             params=(server_id,)))
     return row
 
 
@@ -438,8 +579,11 @@ def queryx_server_id(server_name):
     """
     table = "GhostServer"
     columns = "ServerID"
-    condition = "ServerName='%s'" % (server_name)
-    row = queryx_table(table, columns, condition, only_one=True)
+    condition = "ServerName=%s"
+    row = ref_cache.get(
+        table, ('id', server_name.lower()),
+        lambda: queryx_table(table, columns, condition, only_one=True,
+                             params=(server_name,)))
     return row
 
 
@@ -456,9 +600,9 @@ def insertx_machine_reimage(machine_id, os_id, server_id):
     """
     table = 'Machine_Reimage'
     columns = 'MachineID, OSID, ServerID, IsVM, LoginUsr, LoginPwd'
-    values = ("%s, %s, %s, 0, 'administrator', 'w3L(0m3T3st'"
-              % (machine_id, os_id, server_id))
-    ret_code = insertx_table(table, columns, values)
+    values = "%s, %s, %s, 0, 'administrator', 'w3L(0m3T3st'"
+    ret_code = insertx_table(table, columns, values,
+                             params=(machine_id, os_id, server_id))
     return ret_code
 
 
@@ -473,8 +617,9 @@ def queryx_image_snapshot(machine_id, os_id):
     """
     table = 'Machine_Reimage'
     columns = 'ImageSnapshot'
-    condition = "MachineID='%s' and OSID='%s'" % (machine_id, os_id)
-    row = queryx_table(table, columns, condition, only_one=True)
+    condition = "MachineID=%s and OSID=%s"
+    row = queryx_table(table, columns, condition, only_one=True,
+                       params=(machine_id, os_id))
     return row
 
 
@@ -487,8 +632,9 @@ def queryx_mac_addr(machine_id):
     """
     table = 'Machine_Info'
     columns = 'MacAddress'
-    condition = "MachineID=%s" % machine_id
-    row = queryx_table(table, columns, condition, only_one=True)
+    condition = "MachineID=%s"
+    row = queryx_table(table, columns, condition, only_one=True,
+                       params=(machine_id,))
     return row
 
 
@@ -503,9 +649,9 @@ def updatex_mac_addr(machine_id, mac_addr):
     """
     table = 'Machine_Info'
     columns = 'MacAddress'
-    values = "'%s'" % mac_addr
-    condition = "MachineID=%s" % machine_id
-    ret_code = updatex_table(table, columns, values, condition)
+    condition = "MachineID=%s"
+    ret_code = updatex_table(table, columns, mac_addr, condition,
+                             quote=True, params=(machine_id,))
     return ret_code
 
 
@@ -518,8 +664,9 @@ def queryx_machine_config(machine_id):
     """
     table = 'Machine_Info'
     columns = 'CPUCore, MemorySize'
-    condition = "MachineID=%s" % machine_id
-    row = queryx_table(table, columns, condition, only_one=True)
+    condition = "MachineID=%s"
+    row = queryx_table(table, columns, condition, only_one=True,
+                       params=(machine_id,))
     return row
 
 
@@ -530,6 +677,6 @@ def queryx_available_machines(server_id):
     table = 'Machine_Info as MI, Machine_Reimage as MR'
     columns = 'MR.MachineID, MI.CurrentOSID'
     condition = ("MR.ServerID=%s and MI.MachineID=MR.MachineID and "
-                 "MI.CurrentOSID=MR.OSID" % server_id)
-    rows = queryx_table(table, columns, condition)
+                 "MI.CurrentOSID=MR.OSID")
+    rows = queryx_table(table, columns, condition, params=(server_id,))
     return rows
@@ -8,10 +8,14 @@ import traceback
 from SocketServer import StreamRequestHandler
 
 from nicu.decor import valid_param
+from registry import CommandRegistry, REPLY_NONE, REPLY_CODE, REPLY_DATA
 import nicu.misc as misc
 import nicu.errcode as errcode
 import nicu.version as version
 import nicu.notify as notify
+import nicu.wire as wire
+from nicu.refcache import ref_cache
+from nicu.vm import running_vm_cache
 
 import globalvar as gv
 import util
@@ -39,7 +43,11 @@ class EchoRequestHandler(StreamRequestHandler):
     return code is one of the following values:
         * **0**       - Success!
         * **Other**   - Failed, 1value is error code.
+
+    Commands are dispatched by :attr:`registry`, and new commands could be
+    added by :meth:`register_command`.
     """
+    registry = CommandRegistry()
 
     @valid_param(cmd_paras=(list, 'len(x)>=3 and len(x)<=5'))
     def ghost_machine(self, cmd_paras, client_addr, is_grab_image=False):
@@ -831,209 +839,171 @@ class EchoRequestHandler(StreamRequestHandler):
             util.process_error(error, errcode.ER_GA_HANDLE_EXCEPTION)
         return export_path
 
+    @classmethod
+    def register_command(cls, name, func, min_args=1, max_args=None,
+                         reply=REPLY_NONE, replace=False):
+        """
+        Register a command, so that plugins are able to add new commands
+        without changing this handler. See :meth:`CommandRegistry.register`.
+        """
+        return cls.registry.register(name, func, min_args, max_args,
+                                     reply, replace)
+
+    def reply_to_peer(self, cmd, ret_code):
+        """
+        Reply the return code with a new connection to port+1 of client,
+        since client of `GhostClient` waits result there.
+        """
+        client_socket = None
+        try:
+            (req_ip, req_port) = self.request.getpeername()
+            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            client_socket.connect((req_ip, req_port + 1))
+            client_socket.send(str(ret_code))
+        except Exception, error:
+            if '[Errno 10060]' in str(error) or '[Errno 10061]' in str(error):
+                # [Errno 10061]:
+                #   No connection could be made
+                #   because the target machine actively refused it
+                # [Errno 10060]:
+                #   A connection attempt failed because the connected
+                #   party did not properly respond after a period of time,
+                #   or established connection failed because connected
+                #   host has failed to respond
+                #
+                # Since that client often sends "GhostClient" to server,
+                # and exit directly without waiting the result of GhostClient,
+                # so an error will raise because server couldn't reply the result.
+                pass
+            else:
+                LOGGER.warning("Failed when trying to send return message"
+                               " of %s<%s>: %s" % (cmd, ret_code, error))
+        finally:
+            if client_socket:
+                client_socket.close()
+        return
+
+    def send_reply(self, cmd, data):
+        """
+        Send the reply of command to client.
+        """
+        try:
+            self.request.send(data)
+        except Exception, error:
+            LOGGER.warning("Failed when trying to send return message"
+                           " of %s<%s>: %s" % (cmd, data, error))
+        return
+
+    def dispatch(self, data_recv, client_addr):
+        """
+        Find the command in :attr:`registry` and call it.
+
+        :returns:
+            (ret_code, reply), `reply` is the string to send back to client,
+            or None if nothing should be sent.
+        """
+        ret_code = errcode.ER_FAILED
+        reply = None
+        cmd_paras = shlex.split(data_recv)
+        if not cmd_paras:
+            LOGGER.warn("nothing received.")
+            return (ret_code, reply)
+
+        # Threads could be reused by sessions and worker pool, so clear
+        # data of the previous command, like machine_id for last error.
+        util.reset_thread_data()
+        LOGGER.info('RECEIVE COMMAND "%s" from %s' % (data_recv, client_addr))
+        cmd = cmd_paras[0].upper()
+        command = self.registry.lookup(cmd)
+        if command is None:
+            LOGGER.error('Invalid Command %s from: %s:%s'
+                         % (cmd, client_addr[0], str(client_addr[1])))
+            LOGGER.error("Commands: %s" % (data_recv))
+        elif not command.is_valid(cmd_paras):
+            LOGGER.error('Invalid number of parameters for %s: %s'
+                         % (command.name, cmd_paras))
+            ret_code = errcode.ER_INVALID_PARAMETER_NUMBER
+            if command.reply == REPLY_CODE:
+                reply = str(ret_code)
+        elif command.reply == REPLY_DATA:
+            (ret_code, reply) = self.registry.call(
+                command, self, cmd_paras, client_addr)
+        else:
+            ret_code = self.registry.call(command, self, cmd_paras, client_addr)
+            if command.reply == REPLY_CODE:
+                reply = str(ret_code)
+
+        if ret_code != errcode.ER_SUCCESS:
+            LOGGER.error('Error in handle command: "%s", ret_code: %s'
+                         % (cmd_paras, ret_code))
+        LOGGER.info('FINISH COMMAND "%s" from %s', data_recv, client_addr)
+        return (ret_code, reply)
+
+    def handle_wire(self, client_addr):
+        """
+        Handle the connection started with a greeting, see :mod:`nicu.wire`.
+        """
+        (mode, version) = wire.accept_greeting(
+            self.request, (wire.MODE_FRAME, wire.MODE_SESSION))
+        if mode == wire.MODE_SESSION:
+            self.handle_session(client_addr)
+            return
+        data_recv = wire.recv_frame(self.request)
+        if not data_recv:
+            return
+        (ret_code, reply) = self.dispatch(data_recv, client_addr)
+        if reply is not None:
+            try:
+                wire.send_frame(self.request, reply)
+            except Exception, error:
+                LOGGER.warning("Failed when trying to send return message"
+                               " of %s<%s>: %s" % (data_recv, reply, error))
+        return
+
+    def handle_session(self, client_addr):
+        """
+        Handle a long-lived session, see :class:`nicu.wire.Session`.
+        Each request is replied with its request id, and commands without
+        reply data are replied with return code.
+        """
+        self.request.settimeout(gv.g_session_idle_timeout)
+        LOGGER.info('Session from %s is created' % (client_addr,))
+        while True:
+            try:
+                payload = wire.recv_frame(self.request)
+            except socket.timeout:
+                LOGGER.info('Session from %s is idle for %s seconds'
+                            % (client_addr, gv.g_session_idle_timeout))
+                break
+            if payload is None:
+                break
+            (req_id, data) = wire.unpack_request(payload)
+            (ret_code, reply) = self.dispatch(data, client_addr)
+            if reply is None:
+                reply = str(ret_code)
+            wire.send_frame(self.request, wire.pack_request(req_id, reply))
+        LOGGER.info('Session from %s is closed' % (client_addr,))
+        return
+
     def handle(self):
         """
         Handle of ThreadingTCPServer, to process all the commands.
+        Commands are found in :attr:`registry`.
         """
-        cmd = ""
-        cmd_paras = []
-        reply_flag = False
-        ret_code = errcode.ER_FAILED
+        client_addr = None
         try:
             LOGGER.info("waiting for new request ...")
-            data_recv = self.request.recv(512)
-            if not data_recv:
-                return
-            cmd_paras = shlex.split(data_recv)
-            if not cmd_paras:
-                LOGGER.warn("nothing received. handle() exit.")
+            head = self.request.recv(1, socket.MSG_PEEK)
+            if not head:
                 return
-
             client_addr = self.request.getpeername()
-            LOGGER.info('RECEIVE COMMAND "%s" from %s'
-                        % (data_recv, client_addr))
-            cmd = cmd_paras[0].upper()
-            if not cmp(cmd, "GhostClient".upper()):
-                # Ghost
-                ret_code = self.ghost_machine(cmd_paras, client_addr)
-                try:
-                    (req_ip, req_port) = self.request.getpeername()
-                    client_socket = socket.socket(socket.AF_INET,
-                                                  socket.SOCK_STREAM)
-                    client_socket.connect((req_ip, req_port + 1))
-                    client_socket.send(str(ret_code))
-                except Exception, error:
-                    if '[Errno 10060]' in str(error) or '[Errno 10061]' in str(error):
-                        # [Errno 10061]:
-                        #   No connection could be made
-                        #   because the target machine actively refused it
-                        # [Errno 10060]:
-                        #   A connection attempt failed because the connected
-                        #   party did not properly respond after a period of time,
-                        #   or established connection failed because connected
-                        #   host has failed to respond
-                        #
-                        # Since that client often sends "GhostClient" to server,
-                        # and exit directly without waiting the result of GhostClient,
-                        # so an error will raise because server couldn't reply the result.
-                        pass
-                    else:
-                        LOGGER.warning("Failed when trying to send return message"
-                                       " of %s<%s>: %s" % (cmd, ret_code, error))
-                finally:
-                    client_socket.close()
-                reply_flag = False
-            elif not cmp(cmd, "PauseDaily".upper()):
-                # Pause Daily Ghost
-                ret_code = self.daily_ghost(cmd_paras, 0, client_addr)
-                reply_flag = True
-            elif not cmp(cmd, "RestartDaily".upper()):
-                # Restart Daily Ghost
-                ret_code = self.daily_ghost(cmd_paras, 1, client_addr)
-                reply_flag = True
-            elif not cmp(cmd, "UpdateGhostStat".upper()):
-                # Update Ghost Status
-                ret_code = self.update_ghost_stat(cmd_paras, client_addr)
-                reply_flag = False
-            elif not cmp(cmd, "UpdateSeqStat".upper()):
-                # Update Ghost Status
-                ret_code = self.update_seq_stat(cmd_paras, client_addr)
-                reply_flag = False
-            elif not cmp(cmd, "LocalCMD".upper()):
-                # Execute a Local Command
-                ret_code = self.exe_local_cmd(cmd_paras, client_addr)
-                reply_flag = False
-            elif not cmp(cmd, "ReGrabImage".upper()):
-                # ReGrab a new image with a specific seq
-                ret_code = self.re_grab_image(cmd_paras, client_addr)
-                reply_flag = False
-            elif not cmp(cmd, "GrabNewImage".upper()):
-                # Grab a new image for target machine
-                ret_code = self.grab_new_image(cmd_paras, client_addr)
-                reply_flag = False
-            elif not cmp(cmd, "AutoUpgrade".upper()):
-                # Grab a new image for target machine
-                ret_code = self.auto_upgrade(cmd_paras, client_addr)
-                reply_flag = True
-            elif not cmp(cmd, "DeployVMImage".upper()):
-                # Deploy VMware images for the current server
-                res_str = self.deploy_vm_image(cmd_paras, client_addr)
-                LOGGER.info("Result of deploy_vm_image(%s): %s"
-                            % (str(cmd_paras), res_str))
-                try:
-                    self.request.send(res_str)
-                except Exception, error:
-                    LOGGER.warning("Failed when trying to send return message"
-                                   " of %s<%s>: %s" % (cmd, res_str, error))
-                reply_flag = False
-                ret_code = errcode.ER_SUCCESS
-            elif not cmp(cmd, "ArchiveVMImage".upper()):
-                # Archive the specific VMware image to specific destiantion
-                reply_flag = True
-                try:
-                    ret_code = self.archive_vm_image(cmd_paras, client_addr)
-                    if len(cmd_paras) == 5:
-                        self.archive_vm_image_report(cmd_paras, client_addr, ret_code)
-                except Exception, e:
-                    try:
-                        self.request.send(e)
-                    except Exception, error:
-                        LOGGER.warning("Failed when trying to send return "
-                                       "message of %s: %s" % (cmd, error))
-                    reply_flag = False
-            elif not cmp(cmd, "StartAllMachines".upper()):
-                # Start all virtual machines when server is reboot
-                res_str = self.start_all_machines(cmd_paras, client_addr)
-                LOGGER.info("Result of startup_machine(%s): %s"
-                            % (str(cmd_paras), res_str))
-                try:
-                    self.request.send(res_str)
-                except Exception, error:
-                    LOGGER.warning("Failed when trying to send return message"
-                                   " of %s<%s>: %s" % (cmd, res_str, error))
-                reply_flag = False
-                ret_code = errcode.ER_SUCCESS
-            elif not cmp(cmd, "DeleteExpiredImage".upper()):
-                # delete expired vm images on local server
-                ret_code = self.delete_expired_image(cmd_paras, client_addr)
-                reply_flag = False
-            elif not cmp(cmd, "SetLogLevel".upper()):
-                # Change the logging level run-time
-                ret_code = self.set_log_level(cmd_paras, client_addr)
-                reply_flag = True
-            elif not cmp(cmd, "ReleaseMachine".upper()):
-                # Release the machine (file lock)
-                ret_code = self.release_machine(cmd_paras, client_addr)
-                reply_flag = True
-            elif not cmp(cmd, "GetInfo".upper()):
-                ret_code, info = misc.get_info(gv.g_ga_root)
-                reply_flag = False
-                try:
-                    self.request.send(info)
-                except Exception, error:
-                    LOGGER.warning("Failed when trying to send return message"
-                                   " of %s<%s>: %s" % (cmd, ret_code, error))
-            elif not cmp(cmd, "StartVM".upper()):
-                ret_code = self.start_vm(cmd_paras)
-                reply_flag = False
-            elif not cmp(cmd, "ShutdownVM".upper()):
-                ret_code = self.shutdown_vm(cmd_paras)
-                reply_flag = False
-            elif not cmp(cmd, "RestartVM".upper()):
-                ret_code = self.restart_vm(cmd_paras)
-                reply_flag = False
-            elif not cmp(cmd, "IsVMRunning".upper()):
-                is_vm_running = self.is_vm_running(cmd_paras)
-                res_str = 'yes' if is_vm_running else 'no'
-                reply_flag = False
-                try:
-                    self.request.send(res_str)
-                except Exception, error:
-                    LOGGER.warning("Failed when trying to send return message"
-                                   " of %s<%s>: %s" % (cmd, res_str, error))
-                ret_code = errcode.ER_SUCCESS
-            elif not cmp(cmd, "TakeSnapshot".upper()):
-                ret_code = self.take_snapshot(cmd_paras)
-                reply_flag = False
-            elif not cmp(cmd, "DeleteSnapshot".upper()):
-                ret_code = self.delete_snapshot(cmd_paras)
-                reply_flag = False
-            elif not cmp(cmd, "RevertSnapshot".upper()):
-                ret_code = self.revert_snapshot(cmd_paras)
-                reply_flag = False
-            elif not cmp(cmd, "ListSnapshots".upper()):
-                res_str = self.list_snapshots(cmd_paras)
-                reply_flag = False
-                try:
-                    self.request.send(res_str)
-                except Exception, error:
-                    LOGGER.warning("Failed when trying to send return message"
-                                   " of %s<%s>: %s" % (cmd, res_str, error))
-                ret_code = errcode.ER_SUCCESS
-            elif not cmp(cmd, "ExportVM".upper()):
-                res_str = self.export_vm(cmd_paras, client_addr)
-                reply_flag = False
-                try:
-                    self.request.send(res_str)
-                except Exception, error:
-                    LOGGER.warning("Failed when trying to send return message"
-                                   " of %s<%s>: %s" % (cmd, res_str, error))
-                ret_code = errcode.ER_SUCCESS
-            else:
-                LOGGER.error('Invalid Command %s from: %s:%s'
-                             % (cmd, client_addr[0], str(client_addr[1])))
-                LOGGER.error("Commands: %s" % (data_recv))
-
-            if ret_code != errcode.ER_SUCCESS:
-                LOGGER.error('Error in handle command: "%s", ret_code: %s'
-                             % (cmd_paras, ret_code))
-            if reply_flag:
-                try:
-                    self.request.send(str(ret_code))
-                except Exception, error:
-                    LOGGER.warning("Failed when trying to send return message"
-                                   " of %s<%s>: %s" % (cmd, ret_code, error))
-            LOGGER.info('FINISH COMMAND "%s" from %s', data_recv, client_addr)
+            if wire.is_greeting(head):
+                self.handle_wire(client_addr)
+                return
+            data_recv = self.request.recv(512)
+            (ret_code, reply) = self.dispatch(data_recv, client_addr)
+            if reply is not None:
+                self.send_reply(data_recv.split()[0], reply)
         except SystemExit:
             LOGGER.warning("thread is killed")
         except Exception, error:
@@ -1045,3 +1015,120 @@ class EchoRequestHandler(StreamRequestHandler):
                 self.request.close()
         LOGGER.info("handle() exit")
         return
+
+
+def _ghost_client(handler, cmd_paras, client_addr):
+    ret_code = handler.ghost_machine(cmd_paras, client_addr)
+    handler.reply_to_peer(cmd_paras[0], ret_code)
+    return ret_code
+
+
+def _deploy_vm_image(handler, cmd_paras, client_addr):
+    res_str = handler.deploy_vm_image(cmd_paras, client_addr)
+    LOGGER.info("Result of deploy_vm_image(%s): %s" % (str(cmd_paras), res_str))
+    return (errcode.ER_SUCCESS, res_str)
+
+
+def _archive_vm_image(handler, cmd_paras, client_addr):
+    try:
+        ret_code = handler.archive_vm_image(cmd_paras, client_addr)
+        if len(cmd_paras) == 5:
+            handler.archive_vm_image_report(cmd_paras, client_addr, ret_code)
+    except Exception, error:
+        return (errcode.ER_FAILED, str(error))
+    return (ret_code, str(ret_code))
+
+
+def _start_all_machines(handler, cmd_paras, client_addr):
+    res_str = handler.start_all_machines(cmd_paras, client_addr)
+    LOGGER.info("Result of startup_machine(%s): %s" % (str(cmd_paras), res_str))
+    return (errcode.ER_SUCCESS, res_str)
+
+
+def _is_vm_running(handler, cmd_paras, client_addr):
+    is_vm_running = handler.is_vm_running(cmd_paras)
+    return (errcode.ER_SUCCESS, 'yes' if is_vm_running else 'no')
+
+
+def _get_cmd_stat(handler, cmd_paras, client_addr):
+    """
+    *Command Format:*
+        ``GetCmdStat MachineName Event``
+
+        ``GetGhostStat MachineName``
+
+    Same as commands of :class:`nicu.notify.NotifyServer`, so that status
+    could be queried in the session with GhostAgent.
+    """
+    event = cmd_paras[2] if len(cmd_paras) == 3 else 'GhostClient'
+    if gv.g_ns is None:
+        return (errcode.ER_FAILED, 'None')
+    return (errcode.ER_SUCCESS, gv.g_ns.query(cmd_paras[1].lower(), event))
+
+
+def _get_cmd_stats(handler, cmd_paras, client_addr):
+    """
+    *Command Format:*
+        ``GetCmdStats``
+
+    Reply "Command:Count:Seconds;..." ordered by handling time.
+    """
+    stats = handler.registry.get_stats().items()
+    stats.sort(key=lambda x: x[1][1], reverse=True)
+    return (errcode.ER_SUCCESS,
+            ';'.join('%s:%d:%.3f' % (name, count, elapsed)
+                     for (name, (count, elapsed)) in stats))
+
+
+def _get_cache_stats(handler, cmd_paras, client_addr):
+    """
+    *Command Format:*
+        ``GetCacheStats``
+
+    Reply "Cache:Hits:Misses:Ratio;..." of in-process caches.
+    """
+    caches = [('RefCache', ref_cache), ('VMList', running_vm_cache)]
+    stats = [(name, cache.get_stats()) for (name, cache) in caches]
+    return (errcode.ER_SUCCESS,
+            ';'.join('%s:%d:%d:%.3f' % (name, x['hits'], x['misses'],
+                                        x['ratio'])
+                     for (name, x) in stats))
+
+
+# (Command, Function, MinArgs, MaxArgs, Reply)
+# MinArgs/MaxArgs are the number of parameters including command itself.
+_COMMANDS = [
+    ('GhostClient', _ghost_client, 3, 5, REPLY_NONE),
+    ('PauseDaily', lambda h, p, a: h.daily_ghost(p, 0, a), 2, None, REPLY_CODE),
+    ('RestartDaily', lambda h, p, a: h.daily_ghost(p, 1, a), 2, None, REPLY_CODE),
+    ('UpdateGhostStat', EchoRequestHandler.update_ghost_stat, 3, 3, REPLY_NONE),
+    ('UpdateSeqStat', EchoRequestHandler.update_seq_stat, 3, 3, REPLY_NONE),
+    ('LocalCMD', EchoRequestHandler.exe_local_cmd, 2, None, REPLY_NONE),
+    ('ReGrabImage', EchoRequestHandler.re_grab_image, 3, 5, REPLY_NONE),
+    ('GrabNewImage', EchoRequestHandler.grab_new_image, 3, 3, REPLY_NONE),
+    ('AutoUpgrade', EchoRequestHandler.auto_upgrade, 1, None, REPLY_CODE),
+    ('DeployVMImage', _deploy_vm_image, 1, 2, REPLY_DATA),
+    # ArchiveVMImage replies the exception if failed.
+    ('ArchiveVMImage', _archive_vm_image, 4, 5, REPLY_DATA),
+    ('StartAllMachines', _start_all_machines, 1, None, REPLY_DATA),
+    ('DeleteExpiredImage', EchoRequestHandler.delete_expired_image, 2, 2, REPLY_NONE),
+    ('SetLogLevel', EchoRequestHandler.set_log_level, 2, 2, REPLY_CODE),
+    ('ReleaseMachine', EchoRequestHandler.release_machine, 2, None, REPLY_CODE),
+    ('GetInfo', lambda h, p, a: tuple(misc.get_info(gv.g_ga_root)), 1, None, REPLY_DATA),
+    ('StartVM', lambda h, p, a: h.start_vm(p), 2, 3, REPLY_NONE),
+    ('ShutdownVM', lambda h, p, a: h.shutdown_vm(p), 2, 3, REPLY_NONE),
+    ('RestartVM', lambda h, p, a: h.restart_vm(p), 2, 3, REPLY_NONE),
+    ('IsVMRunning', _is_vm_running, 2, 3, REPLY_DATA),
+    ('TakeSnapshot', lambda h, p, a: h.take_snapshot(p), 3, 5, REPLY_NONE),
+    ('DeleteSnapshot', lambda h, p, a: h.delete_snapshot(p), 3, 4, REPLY_NONE),
+    ('RevertSnapshot', lambda h, p, a: h.revert_snapshot(p), 3, 4, REPLY_NONE),
+    ('ListSnapshots', lambda h, p, a: (errcode.ER_SUCCESS, h.list_snapshots(p)), 2, 3, REPLY_DATA),
+    ('ExportVM', lambda h, p, a: (errcode.ER_SUCCESS, h.export_vm(p, a)), 2, 3, REPLY_DATA),
+    ('GetCmdStat', _get_cmd_stat, 3, 3, REPLY_DATA),
+    ('GetGhostStat', _get_cmd_stat, 2, 2, REPLY_DATA),
+    ('GetCmdStats', _get_cmd_stats, 1, 1, REPLY_DATA),
+    ('GetCacheStats', _get_cache_stats, 1, 1, REPLY_DATA),
+]
+
+for _command in _COMMANDS:
+    EchoRequestHandler.register_command(*_command)
@@ -25,12 +25,14 @@ from nicu.mail import Mail
 from nicu.db import SQLServerDB
 from nicu.decor import TimeoutError
 from nicu.misc import get_last_modified_time
+from nicu.kthread import KThread
 
 import globalvar as gv
 import util
 import util.dbx as dbx
 import util.conf as conf
 import util.report as report
+from util.tmplcache import template_cache
 
 
 __all__ = [
@@ -379,17 +381,25 @@ def stop_machines(machine_id):
     # And we will reset these attributes later.
     vm_object_tmp = Vmrun('NotEmpty', 'NotEmpty', 'NotEmpty')
     (vm_cmd, vm_res) = vm_object_tmp.list()
+    if not rows:
+        return
+    # Index images by path, instead of scanning all images for each
+    # running vm machine.
+    rows_by_path = dict((row[0].lower(), row) for row in reversed(rows)
+                        if row[0])
+    machine_dir = '\\%s\\' % (machine_name.lower())
     for vmx_path in vm_res[1:]:
         vmx_path = vmx_path.strip()
-        for row in rows:
-            if row[0].lower() != vmx_path.lower() and \
-                '\\%s\\' % (machine_name.lower()) not in vmx_path.lower():
+        if machine_dir in vmx_path.lower():
+            row = rows[0]
+        else:
+            row = rows_by_path.get(vmx_path.lower())
+            if row is None:
                 continue
-            vm_object_tmp.setVMX(vmx_path)
-            vm_object_tmp.setGuestInfo(row[1], row[2])
-            vm_object_tmp(is_raise=False, level='warning').stopAndWait()
-            remove_vmware_lock(os.path.dirname(vmx_path))
-            break
+        vm_object_tmp.setVMX(vmx_path)
+        vm_object_tmp.setGuestInfo(row[1], row[2])
+        vm_object_tmp(is_raise=False, level='warning').stopAndWait()
+        remove_vmware_lock(os.path.dirname(vmx_path))
     return
 
 
@@ -431,6 +441,7 @@ def ghost_machine(machine_id, os_id, seq_id, email_to,
             "VMWare doesn't support platform %s" % target_platform,
             extra={'error_level': 1})
         raise Exception(errcode.ER_GA_PF_UNSUPPORT)
+    vm_root = get_guest_paths(gvt, target_platform, image_user)[0]
 
     with VmLock(machine_id):
         stop_machines(machine_id)
@@ -442,19 +453,18 @@ def ghost_machine(machine_id, os_id, seq_id, email_to,
         vm_object.revertToSnapshot(gv.g_vm_clean_snap)
         vm_object.startAndWait()
         # Delete the working director on client
-        vm_object(is_raise=False, level='debug').deleteDirectoryInGuest(gvt.gt_vm_root)
+        vm_object(is_raise=False, level='debug').deleteDirectoryInGuest(vm_root)
         # Create the working director on client,
-        vm_object.createDirectoryInGuest(gvt.gt_vm_root)
+        vm_object.createDirectoryInGuest(vm_root)
 
-        # Generate the ini file for Ghost, and placed behind
-        # deploy_vm_image_single() to ensure adopting the updated
-        # value of gvt.gt_vm_root & gvt.gt_vm_rename_script_client
+        # Generate the ini file for Ghost, with the working directory
+        # of the image account.
         LOGGER.info("Ready to generate script.ini")
         script_ini_full = conf.gen_ghost_conf(machine_id, os_id, seq_id, email_to,
-                                              is_grab_image=False, boot_dir_home=gvt.gt_vm_root)
+                                              is_grab_image=False, boot_dir_home=vm_root)
         setupenv_script_local = os.path.join(
             os.path.dirname(script_ini_full), gvt.gt_setupenv_script)
-        setupenv_script_client = gvt.gt_vm_root + gvt.gt_sep + gvt.gt_setupenv_script
+        setupenv_script_client = vm_root + gvt.gt_sep + gvt.gt_setupenv_script
         LOGGER.info("transfer server to client: %s ==> %s"
                     % (setupenv_script_local, setupenv_script_client))
         vm_object.copyFileFromHostToGuest(setupenv_script_local, setupenv_script_client)
@@ -464,7 +474,7 @@ def ghost_machine(machine_id, os_id, seq_id, email_to,
         if target_platform == 'windows':
             vm_object.runScriptInGuest(
                 '""',
-                '\\"%s\\" \\"%s\\"' % (setupenv_script_client, gvt.gt_vm_root),
+                '\\"%s\\" \\"%s\\"' % (setupenv_script_client, vm_root),
                 nowait=True)
         else:   # linux
             # Since that linux virual machine starts much faster than before, and
@@ -511,6 +521,25 @@ def need_update(local_vmx, template_src_dir):
     return gv.g_vm_clean_snap != snapshots[0]
 
 
+def get_guest_paths(gvt, target_os_platform, image_user):
+    """
+    Get (vm root, rename script) paths in the guest for the image account.
+    On linux they are under the home directory of `image_user`, instead of
+    the default account in `gvt`.
+
+    Images of different accounts may be deployed at the same time, so the
+    paths are computed for each image, rather than saved into `gvt`.
+    """
+    vm_root = gvt.gt_vm_root
+    vm_rename_script_client = gvt.gt_vm_rename_script_client
+    if target_os_platform.lower() == 'linux':
+        span = re.match(r'/(.+?)/(.+?)/(.+)', vm_root).span(2)
+        vm_root = vm_root[:span[0]] + image_user + vm_root[span[1]:]
+        vm_rename_script_client = vm_rename_script_client[:span[0]] + image_user + \
+                                  vm_rename_script_client[span[1]:]
+    return (vm_root, vm_rename_script_client)
+
+
 def vm_reg_image(machine_id, os_id):
     """
     Register a vmware image with the vmware server or workstation,
@@ -550,12 +579,19 @@ def vm_reg_image(machine_id, os_id):
 
     clean_up_older_images(machine_id, gv.g_vm_images_max_count - 1)
 
+    (vm_root, vm_rename_script_client) = get_guest_paths(
+        gvt, target_os_platform, image_user)
+
     vm_object = Vmrun(image_full, image_user, image_pwd)
     LOGGER.info("Begin to register the VM image for (Machine %s, OS %s)" % (machine_id, os_id))
     try:
         LOGGER.info("Copying VM image from template server <%s> to local destination <%s>."
                     % (vm_image_template_src, vm_image_dir_dst))
-        shutil.copytree(vm_image_template_src, vm_image_dir_dst)
+        if gv.g_vm_template_cache_root:
+            # Only files changed in template server are copied.
+            template_cache.seed(vm_image_template_src, vm_image_dir_dst)
+        else:
+            shutil.copytree(vm_image_template_src, vm_image_dir_dst)
 
         # Lauch the VM image and rename it as the target machine name
         vm_object.startAndWait()
@@ -565,15 +601,15 @@ def vm_reg_image(machine_id, os_id):
             # if platform is linux, we should set the account as root to execute rename.
             vm_object.setGuestInfo('root', image_pwd)
         elif target_os_platform.lower() == 'windows':
-            vm_object.createDirectoryInGuest(gvt.gt_vm_root)
+            vm_object.createDirectoryInGuest(vm_root)
 
-        vm_object.copyFileFromHostToGuest(gvt.gt_vm_rename_script_local, gvt.gt_vm_rename_script_client)
+        vm_object.copyFileFromHostToGuest(gvt.gt_vm_rename_script_local, vm_rename_script_client)
         if target_os_platform.lower() == 'linux':
             # revert the account.
-            vm_object.runProgramInGuest(gvt.gt_vm_rename_script_client, False, image_user, machine_name)
+            vm_object.runProgramInGuest(vm_rename_script_client, False, image_user, machine_name)
             vm_object.setGuestInfo(image_user, image_pwd)
         elif target_os_platform.lower() == 'windows':
-            vm_object.runProgramInGuest(gvt.gt_vm_rename_script_client, False, machine_name)
+            vm_object.runProgramInGuest(vm_rename_script_client, False, machine_name)
 
         # reboot vm machine to make rename operation take effect
         vm_object.resetAndWait()
@@ -700,12 +736,7 @@ def deploy_vm_image_single(machine_id, os_id, lock=True, force=True, reset_local
             extra={'error_level': 2})
         raise Exception(errcode.ER_GA_PF_UNSUPPORT)
 
-    (image_full, image_user) = dbx.queryx_image_info(machine_id, os_id)[1:3]
-    if target_os_platform.lower() == 'linux':
-        span = re.match(r'/(.+?)/(.+?)/(.+)', gvt.gt_vm_root).span(2)
-        gvt.gt_vm_root = gvt.gt_vm_root[:span[0]] + image_user + gvt.gt_vm_root[span[1]:]
-        gvt.gt_vm_rename_script_client = gvt.gt_vm_rename_script_client[:span[0]] + image_user + \
-                                         gvt.gt_vm_rename_script_client[span[1]:]
+    image_full = dbx.queryx_image_info(machine_id, os_id)[1]
 
     if not force:
         if not need_update(image_full, vm_image_template_src):
@@ -751,7 +782,9 @@ def vm_prepare_clone_image(vm_object, opfilter, target_os_platform):
         # if platform is linux, we should set the account as root to execute rename.
         vm_object.setGuestInfo('root', vm_object.VM_GUESTPWD)
         machine_name = 'vmtest-%s' % uuid.uuid1()
-        vm_object.runProgramInGuest(gvt.gt_vm_rename_script_client, False, vm_object.VM_GUESTUSR, machine_name)
+        vm_rename_script_client = get_guest_paths(
+            gvt, target_os_platform, vm_object.VM_GUESTUSR)[1]
+        vm_object.runProgramInGuest(vm_rename_script_client, False, vm_object.VM_GUESTUSR, machine_name)
         vm_object.setGuestInfo(vm_object.VM_GUESTUSR, vm_object.VM_GUESTPWD)
 
     vm_object.stopAndWait()
@@ -768,6 +801,85 @@ def vm_prepare_clone_image(vm_object, opfilter, target_os_platform):
     return errcode.ER_SUCCESS
 
 
+def _get_volume(path):
+    """
+    Get the volume of the path, which is the drive on windows, or the mount
+    point on linux.
+    """
+    path = os.path.abspath(path)
+    drive = os.path.splitdrive(path)[0]
+    if drive:
+        return drive.upper()
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path
+
+
+class DeployScheduler(object):
+    """
+    Hand out (machine_id, os_id) pairs to deploying threads, so that at most
+    :const:`globalvar.g_vm_deploy_volume_max_count` images are copied to the
+    same volume at the same time.
+
+    :param pairs:
+        List of (machine_id, os_id, volume).
+    """
+    def __init__(self, pairs):
+        self._pending = list(pairs)
+        self._busy = {}
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """
+        Get the next pair whose volume is not busy, or None if all pairs
+        have been handed out.
+        """
+        with self._cond:
+            while self._pending:
+                for pair in self._pending:
+                    volume = pair[2]
+                    if self._busy.get(volume, 0) < gv.g_vm_deploy_volume_max_count:
+                        self._pending.remove(pair)
+                        self._busy[volume] = self._busy.get(volume, 0) + 1
+                        return pair
+                # Wait in 1 second steps, so that it could be killed.
+                self._cond.wait(1)
+        return None
+
+    def release(self, pair):
+        with self._cond:
+            self._busy[pair[2]] -= 1
+            self._cond.notifyAll()
+
+
+def _deploy_vm_image_worker(scheduler, results):
+    """
+    Deploy pairs from `scheduler` until none is left, and save
+    (result, seconds) of each pair into `results`.
+    """
+    while True:
+        pair = scheduler.acquire()
+        if pair is None:
+            return
+        (machine_id, os_id) = pair[:2]
+        LOGGER.info("Deploy Machine %s, OS %s" % (machine_id, os_id))
+        start_time = time.time()
+        try:
+            # Since that deploy_vm_image will process multiple machines in one function,
+            # so we have to reset the thread local data in deploy_vm_image_single every time.
+            deploy_vm_image_single(machine_id, os_id)
+            res = 0
+        except Exception, error:
+            LOGGER.error('Failed to deploy Machine %s, OS %s: %s' % (machine_id, os_id, error))
+            res = 1
+        finally:
+            scheduler.release(pair)
+        elapsed = time.time() - start_time
+        LOGGER.info("Deploy Machine %s, OS %s finished in %.1f seconds, result %d"
+                    % (machine_id, os_id, elapsed, res))
+        results[(machine_id, os_id)] = (res, elapsed)
+
+
 def deploy_vm_image(pair_list):
     """
     Deploy VMware Images to the server.
@@ -801,18 +913,45 @@ def deploy_vm_image(pair_list):
             'Machine_Reimage', 'MachineID, OSID',
             "ServerID = %s and IsVM = 1" % (server_id))
 
-    deploy_result_list = []
+    # Deploy images concurrently, with limited count of images copied to
+    # each volume at the same time.
+    pairs = []
     for machine_id, os_id in pair_list:
-        LOGGER.info("Deploy Machine %s, OS %s" % (machine_id, os_id))
         try:
-            # Since that deploy_vm_image will process multiple machines in one function,
-            # so we have to reset the thread local data in deploy_vm_image_single every time.
-            deploy_vm_image_single(machine_id, os_id)
-            deploy_result_list.append("%s:%s:0" % (machine_id, os_id))
+            image_full = dbx.queryx_image_info(machine_id, os_id)[1]
+            volume = _get_volume(image_full)
         except Exception, error:
-            LOGGER.error('Failed to deploy Machine %s, OS %s: %s' % (machine_id, os_id, error))
-            deploy_result_list.append("%s:%s:1" % (machine_id, os_id))
+            LOGGER.warning('Failed to get the volume of Machine %s, OS %s: %s'
+                           % (machine_id, os_id, error))
+            volume = None
+        pairs.append((machine_id, os_id, volume))
+    scheduler = DeployScheduler(pairs)
+    results = {}
+    workers = []
+    for i in range(min(gv.g_vm_deploy_max_count, len(pairs))):
+        worker = KThread(target=_deploy_vm_image_worker,
+                         args=(scheduler, results))
+        worker.setDaemon(True)
+        worker.start()
+        workers.append(worker)
+    try:
+        for worker in workers:
+            # Join in 1 second steps, so that it could be killed.
+            while worker.isAlive():
+                worker.join(1)
+    finally:
+        # Stop the deploying workers too, if this thread is killed.
+        for worker in workers:
+            worker.kill()
+
+    deploy_result_list = []
+    timing_list = []
+    for machine_id, os_id in pair_list:
+        (res, elapsed) = results.get((machine_id, os_id), (1, 0))
+        deploy_result_list.append("%s:%s:%d" % (machine_id, os_id, res))
+        timing_list.append("%s:%s:%.1fs" % (machine_id, os_id, elapsed))
     LOGGER.info("Deploy Result List is %s", deploy_result_list)
+    LOGGER.info("Deploy Timing List is %s", timing_list)
     return ';'.join(deploy_result_list)
 
 
@@ -843,11 +982,8 @@ def archive_vm_image(machine_id, os_id, archive_dst, config):
         'MachineID=%s' % machine_id, only_one=True)
 
     target_os_platform = dbx.queryx_target_os_info(os_id)[0]
-    if target_os_platform.lower() == 'linux':
-        span = re.match(r'/(.+?)/(.+?)/(.+)', gvt.gt_vm_root).span(2)
-        gvt.gt_vm_root = gvt.gt_vm_root[:span[0]] + image_user + gvt.gt_vm_root[span[1]:]
-        gvt.gt_vm_rename_script_client = gvt.gt_vm_rename_script_client[:span[0]] + image_user + \
-                                         gvt.gt_vm_rename_script_client[span[1]:]
+    (vm_root, vm_rename_script_client) = get_guest_paths(
+        gvt, target_os_platform, image_user)
 
     with VmLock(machine_id):
         vm_object = Vmrun(image_full, image_user, image_pwd)
@@ -861,7 +997,7 @@ def archive_vm_image(machine_id, os_id, archive_dst, config):
         # if image start failed, won't need to execute copy log file
         # or stop image action
         if not vm_res:
-            vm_install_log_src = gvt.gt_vm_root + gvt.gt_sep + gv.g_vm_script_log
+            vm_install_log_src = vm_root + gvt.gt_sep + gv.g_vm_script_log
             #Try to copy the install log file
             vm_object(is_raise=False, level='warning').copyFileFromGuestToHost(
                 vm_install_log_src, vm_install_log_dst)
@@ -1356,12 +1492,17 @@ def get_active_machines():
         "ServerName = '%s'" % (socket.gethostname()), only_one=True)
     vm_object = Vmrun('NotEmpty', 'NotEmpty', 'NotEmpty')
     (vm_cmd, vm_res) = vm_object.list()
+    machine_names = set([image.split('\\')[2].lower()
+                         for image in vm_res[1:]])
+    # Resolve all running images in one query.
+    rows = dbx.queryx_machine_ids(list(machine_names))
     machine_ids = set([])
-    for image in vm_res[1:]:
-        machine_name = image.split('\\')[2]
-        (machine_id,) = dbx.queryx_table('Machine_Info', 'MachineID',
-            "MachineName='%s'" % machine_name, only_one=True)
+    for (machine_name, machine_id) in rows:
+        machine_names.discard(machine_name.lower())
         machine_ids.add(machine_id)
+    if machine_names:
+        LOGGER.warning("Unknown machines of running images: %s"
+                       % (', '.join(sorted(machine_names))))
     return list(machine_ids)
 
 
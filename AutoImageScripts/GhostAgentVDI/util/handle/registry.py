@@ -0,0 +1,173 @@
+"""
+Command registry of GhostAgent, used by :class:`util.handle.EchoRequestHandler`
+to find the function of each command by its name.
+"""
+import time
+import logging
+import threading
+
+
+__all__ = [
+    "REPLY_NONE",
+    "REPLY_CODE",
+    "REPLY_DATA",
+    "Command",
+    "CommandRegistry",
+]
+
+LOGGER = logging.getLogger(__name__)
+
+REPLY_NONE = None
+"""
+Nothing is replied to client.
+"""
+
+REPLY_CODE = 'code'
+"""
+The return code is replied to client.
+"""
+
+REPLY_DATA = 'data'
+"""
+The data string returned by the command is replied to client.
+"""
+
+_REPLY_MODES = (REPLY_NONE, REPLY_CODE, REPLY_DATA)
+
+
+class Command(object):
+    """
+    A registered command.
+
+    :param name:
+        The command name, case insensitive when dispatching.
+    :param func:
+        The function to call with arguments `(handler, cmd_paras, client_addr)`.
+        It returns the return code, or a tuple `(ret_code, data)` if `reply`
+        is :const:`REPLY_DATA`.
+    :param min_args:
+        The min length of `cmd_paras`, including the command name.
+    :param max_args:
+        The max length of `cmd_paras`, None means no limitation.
+    :param reply:
+        One of :const:`REPLY_NONE`, :const:`REPLY_CODE`, :const:`REPLY_DATA`.
+    """
+    def __init__(self, name, func, min_args=1, max_args=None, reply=REPLY_NONE):
+        if not isinstance(name, basestring) or not name or ' ' in name:
+            raise ValueError('Invalid command name: %r' % (name,))
+        if not callable(func):
+            raise ValueError('Function of command "%s" is not callable' % name)
+        if not isinstance(min_args, int) or min_args < 1:
+            raise ValueError('Invalid min_args of command "%s": %r'
+                             % (name, min_args))
+        if max_args is not None and \
+                (not isinstance(max_args, int) or max_args < min_args):
+            raise ValueError('Invalid max_args of command "%s": %r'
+                             % (name, max_args))
+        if reply not in _REPLY_MODES:
+            raise ValueError('Invalid reply mode of command "%s": %r'
+                             % (name, reply))
+        self.name = name
+        self.key = name.upper()
+        self.func = func
+        self.min_args = min_args
+        self.max_args = max_args
+        self.reply = reply
+        self.count = 0
+        self.elapsed = 0.0
+
+    def is_valid(self, cmd_paras):
+        """
+        Whether the number of parameters matches this command.
+        """
+        count = len(cmd_paras)
+        return count >= self.min_args and \
+            (self.max_args is None or count <= self.max_args)
+
+
+class CommandRegistry(object):
+    """
+    A hash-keyed registry of commands, which also records the call count
+    and cumulative handling time of each command.
+    """
+    def __init__(self):
+        self._commands = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, func, min_args=1, max_args=None,
+                 reply=REPLY_NONE, replace=False):
+        """
+        Register a new command, see :class:`Command` for parameters.
+
+        :param replace:
+            Whether to replace the command with same name.
+        """
+        command = Command(name, func, min_args, max_args, reply)
+        self._lock.acquire()
+        try:
+            if command.key in self._commands and not replace:
+                raise ValueError('Command "%s" has been registered' % name)
+            self._commands[command.key] = command
+        finally:
+            self._lock.release()
+        return command
+
+    def unregister(self, name):
+        """
+        Remove the command, and return it if exists.
+        """
+        self._lock.acquire()
+        try:
+            return self._commands.pop(name.upper(), None)
+        finally:
+            self._lock.release()
+
+    def lookup(self, name):
+        """
+        Get the command by name, or None if not registered.
+        """
+        return self._commands.get(name.upper())
+
+    def names(self):
+        """
+        Get names of all registered commands.
+        """
+        return sorted(x.name for x in self._commands.values())
+
+    def call(self, command, handler, cmd_paras, client_addr):
+        """
+        Call the command, and record its count and handling time.
+        """
+        start = time.time()
+        try:
+            return command.func(handler, cmd_paras, client_addr)
+        finally:
+            elapsed = time.time() - start
+            self._lock.acquire()
+            command.count += 1
+            command.elapsed += elapsed
+            self._lock.release()
+
+    def get_stats(self):
+        """
+        Get call count and cumulative handling time (in seconds)
+        of all commands, as a dict whose key is command name.
+        """
+        self._lock.acquire()
+        try:
+            return dict((x.name, (x.count, x.elapsed))
+                        for x in self._commands.values())
+        finally:
+            self._lock.release()
+
+    def reset_stats(self):
+        """
+        Clear call counts and handling time of all commands.
+        """
+        self._lock.acquire()
+        try:
+            for command in self._commands.values():
+                command.count = 0
+                command.elapsed = 0.0
+        finally:
+            self._lock.release()
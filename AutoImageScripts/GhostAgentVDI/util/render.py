@@ -25,6 +25,12 @@ Format Support:
             If value of `condition` isn't empty,
             replace these sentenses by `true_statement`.
             otherwise, replace these sentenses by `false_statement`.
+
+Templates are compiled once into text, variables and if sentences, and then
+rendered in one pass. Compiled templates of files are cached by path and
+modified time. In rare cases where the values could change the meaning of
+the template (e.g. a value contains `$` or `%`), it falls back to render with
+regular expressions one by one, so that result is always the same.
 """
 
 from __future__ import with_statement
@@ -32,6 +38,7 @@ import sys
 import os
 import re
 import logging
+import threading
 
 
 __all__ = [
@@ -40,19 +47,150 @@ __all__ = [
 
 LOGGER = logging.getLogger(__name__)
 
+_STR_RE = re.compile("\$\{\s*['\"](.*?)['\"]\s*\}")
+_VAR_RE = re.compile("\$\{\s*(\w+)\s*\}")
+_IF_ELSE_RE = re.compile(
+    ("%\s*if\s+(\w+)\s*:\s*\n\s*(.*?)"
+     "(?:%\s*else\s*:\s*\n\s*(.*?))?"
+     "%\s*endif"),
+    re.M | re.S)
+
+# Variables are marked as "\x00name\x00" in compiled templates.
+_MARK = '\x00'
+_MARK_RE = re.compile('\\x00(\\w+)\\x00')
+# Marks which are parts of if sentences can't be compiled.
+_MARK_IN_IF_RE = re.compile('%\\s*(?:(?:if|else|endif)[^\\n]*)?\\x00')
+# Values with these characters may be rendered as part of template.
+_UNSAFE_VALUE_RE = re.compile('[$%{}\\x00]')
+
+# {file path: (modified time, size, content, compiled template)}
+_file_cache = {}
+_file_cache_lock = threading.Lock()
+
 
 class Template:
     def __init__(self, content=None, filename=None):
         self.content = ''
         self.tran4str = '-&*&*&*&*&-'
         self.tran5str = '=@!@!@!@!@='
+        self._compiled = None
+        self._cache_key = None
         if content:
             self.content = content
         elif filename:
-            with open(filename, 'rb') as fp:
-                self.content = fp.read(-1)
+            path = os.path.abspath(filename)
+            stat = os.stat(path)
+            self._cache_key = (path, stat.st_mtime, stat.st_size)
+            with _file_cache_lock:
+                cached = _file_cache.get(path)
+            if cached and cached[:2] == self._cache_key[1:]:
+                (self.content, self._compiled) = cached[2:]
+            else:
+                with open(filename, 'rb') as fp:
+                    self.content = fp.read(-1)
 
     def render(self, **kwargs):
+        compiled = self._get_compiled()
+        if compiled is False:
+            return self._render_regex(**kwargs)
+        (names, nodes, leading_marks) = compiled
+        values = []
+        for (index, var) in enumerate(names):
+            self._check_var(var, kwargs)
+            value = str(kwargs[var])
+            # The value may change the meaning of template, or the spaces
+            # at the beginning of if sentence are stripped with it.
+            if (_UNSAFE_VALUE_RE.search(value) or
+                    self.tran4str in value or self.tran5str in value or
+                    (index in leading_marks and
+                     (not value or value[0].isspace()))):
+                return self._render_regex(**kwargs)
+            values.append(value)
+
+        result = []
+        for node in nodes:
+            if isinstance(node, tuple):
+                (var, body_true, body_false) = node
+                self._check_var(var, kwargs)
+                node = body_true if kwargs[var] else body_false
+            for part in node:
+                result.append(values[part] if isinstance(part, int) else part)
+        # At last, we should convert the middle string to the last string.
+        return ''.join(result).replace(
+            self.tran4str, '$').replace(self.tran5str, '%')
+
+    def _get_compiled(self):
+        """
+        Get the compiled template, or False if it can't be compiled.
+        """
+        if self._compiled is None:
+            self._compiled = self._compile()
+            if self._cache_key:
+                (path, mtime, size) = self._cache_key
+                with _file_cache_lock:
+                    _file_cache[path] = (mtime, size, self.content,
+                                         self._compiled)
+        return self._compiled
+
+    def _compile(self):
+        """
+        Compile the template into (variable names, nodes, indexes of variables
+        at the beginning of if sentences). Each node is either a list of
+        texts and indexes of variables, or a tuple of (condition, nodes of
+        true statement, nodes of false statement).
+        """
+        # Strings don't depend on values, render them as before.
+        content = self._replace_all(self.content, _STR_RE, self._str_value, {})
+        if _MARK in content:
+            return False
+        names = []
+        indexes = {}
+
+        def _mark(match):
+            var = match.group(1)
+            if var not in indexes:
+                indexes[var] = len(names)
+                names.append(var)
+            return '%s%s%s' % (_MARK, var, _MARK)
+
+        content = _VAR_RE.sub(_mark, content)
+        if _MARK_IN_IF_RE.search(content):
+            return False
+
+        def _split(text):
+            parts = _MARK_RE.split(text)
+            return [indexes[x] if i % 2 else x
+                    for (i, x) in enumerate(parts) if x]
+
+        nodes = []
+        leading_marks = set()
+        starts = {}
+        pos = 0
+        for match in _IF_ELSE_RE.finditer(content):
+            starts.setdefault(match.group(0), set()).add(match.start())
+            nodes.append(_split(content[pos:match.start()]))
+            bodies = (_split(match.group(2)), _split(match.group(3) or ''))
+            for body in bodies:
+                if body and isinstance(body[0], int):
+                    leading_marks.add(body[0])
+            nodes.append((match.group(1),) + bodies)
+            pos = match.end()
+        nodes.append(_split(content[pos:]))
+
+        # Each if sentence is replaced everywhere in the content, so the
+        # same text elsewhere must be the same if sentence.
+        for (text, positions) in starts.items():
+            found = content.find(text)
+            while found >= 0:
+                if found not in positions:
+                    return False
+                found = content.find(text, found + 1)
+        return (names, nodes, leading_marks)
+
+    def _render_regex(self, **kwargs):
+        """
+        Render the template with regular expressions one by one.
+        """
         content = self.content
 
         # In some situations, for example:
@@ -66,19 +204,10 @@ class Template:
         # And then, render variables and if sentences.
         # At last, we need to revert the middle strings to the orginal
         # characters.
-        str_re = re.compile("\$\{\s*['\"](.*?)['\"]\s*\}")
-        content = self._replace_all(content, str_re, self._str_value, kwargs)
-
-        var_re = re.compile("\$\{\s*(\w+)\s*\}")
-        content = self._replace_all(content, var_re, self._var_value, kwargs)
-
-        if_else_re = re.compile(
-            ("%\s*if\s+(\w+)\s*:\s*\n\s*(.*?)"
-             "(?:%\s*else\s*:\s*\n\s*(.*?))?"
-             "%\s*endif"),
-            re.M | re.S)
+        content = self._replace_all(content, _STR_RE, self._str_value, kwargs)
+        content = self._replace_all(content, _VAR_RE, self._var_value, kwargs)
         content = self._replace_all(
-            content, if_else_re, self._if_else_value, kwargs)
+            content, _IF_ELSE_RE, self._if_else_value, kwargs)
 
         # At last, we should convert the middle string to the last string.
         return content.replace(self.tran4str, '$').replace(self.tran5str, '%')
@@ -0,0 +1,401 @@
+"""
+This module contains a local cache of VM image templates.
+
+Each template on the template server is mirrored into
+:const:`globalvar.g_vm_template_cache_root`, with a manifest of
+(size, modified time) of its files as the content version. When a template
+is registered again, only the files which differ from the server are
+copied, and the image is seeded from the local mirror, with copy-on-write
+clones (reflinks) where the file system supports them.
+
+NTFS has no reflinks, so on Windows the image could be a linked clone
+(``vmrun clone ... linked``) instead, see
+:const:`globalvar.g_vm_template_cache_linked`. It is cloned from a parent
+VM, which is a local copy of one version of the mirror with a base
+snapshot, and the parent is kept while any of its clones exists.
+
+The mirrors which are not used recently are removed when they expire, or
+when the total size exceeds :const:`globalvar.g_vm_template_cache_max_size`.
+
+.. doctest::
+
+    >>> from util.tmplcache import template_cache
+    >>> template_cache.seed(vm_image_template_src, vm_image_dir_dst)
+    >>> template_cache.get_stats()
+
+.. note::
+    Files in the mirror are never hard linked into images, since VMware
+    writes the disks of a running VM in place. A linked clone only writes
+    its own delta disks, and never writes the disks of its parent.
+"""
+from __future__ import with_statement
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import threading
+
+from nicu.vm import VmwareType
+from nicu.vmrun import VmrunPool
+from nicu.path import get_folder_size
+import nicu.errcode as errcode
+
+import globalvar as gv
+
+
+__all__ = [
+    "TemplateCache",
+    "template_cache",
+]
+
+LOGGER = logging.getLogger(__name__)
+
+_MANIFEST = '.manifest'
+_FILES = 'files'
+_PARENTS = 'parents'
+_CLONES = '.clones'
+_BASE_SNAP = 'TemplateCacheBase'
+# Files of the VM itself, which are created by a linked clone.
+_VM_FILE_EXTS = ('.vmx', '.vmxf', '.vmsd', '.vmdk', '.nvram', '.vmsn',
+                 '.vmss', '.vmem', '.log')
+# ioctl to clone a file on btrfs/xfs, see ioctl_ficlone(2).
+_FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    """
+    Clone `src` to `dst` sharing the same blocks, return False if it's not
+    supported on this platform or file system.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    with open(src, 'rb') as src_file:
+        with open(dst, 'wb') as dst_file:
+            try:
+                fcntl.ioctl(dst_file.fileno(), _FICLONE, src_file.fileno())
+            except IOError:
+                return False
+    shutil.copystat(src, dst)
+    return True
+
+
+def _walk(root):
+    """
+    Get (manifest, relative paths of all directories) under `root`.
+    """
+    manifest = {}
+    dirs = []
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        for dirname in dirnames:
+            dirs.append(os.path.relpath(os.path.join(dirpath, dirname), root))
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            stat = os.stat(path)
+            manifest[os.path.relpath(path, root)] = [stat.st_size,
+                                                     int(stat.st_mtime)]
+    return (manifest, dirs)
+
+
+def get_manifest(root):
+    """
+    Get {relative path: [size, modified time]} of all files under `root`.
+    """
+    return _walk(root)[0]
+
+
+def get_version(manifest):
+    """
+    Get the content version of a template from its manifest.
+    """
+    return hashlib.md5(json.dumps(sorted(manifest.items()))).hexdigest()[:12]
+
+
+def _run_vmrun(vmx, cmd, *args):
+    """
+    Run vmrun command on `vmx`, and raise exception if it fails.
+    """
+    vm_object = VmrunPool(VmwareType.VmWorkstation, vmx, 'NotEmpty',
+                          'NotEmpty', parallel=gv.g_vm_parallel_max_count)
+    (vm_cmd, vm_res) = getattr(vm_object, cmd)(*args)
+    LOGGER.info('Execute vm operation "%s"' % (vm_cmd,))
+    if vm_res:
+        LOGGER.error('%s' % (vm_res,))
+        raise Exception(errcode.ER_GA_VM_CMD_FAILED)
+    return
+
+
+class TemplateCache(object):
+    """
+    A local mirror of VM image templates.
+
+    :param root:
+        The directory to keep mirrors.
+    :param expire_days:
+        Mirrors which are not used in these days are removed.
+    :param max_size:
+        The max size of all mirrors in GB, the least recently used mirrors
+        are removed when it's exceeded. 0 means no limit.
+    :param linked:
+        Whether to seed images as linked clones of the mirror.
+    """
+    def __init__(self, root=gv.g_vm_template_cache_root,
+                 expire_days=gv.g_vm_template_cache_expire_days,
+                 max_size=gv.g_vm_template_cache_max_size,
+                 linked=gv.g_vm_template_cache_linked):
+        self.root = root
+        self.expire_days = expire_days
+        self.max_size = max_size
+        self.linked = linked
+        self.stats = {'copied': 0, 'reused': 0, 'cloned': 0, 'linked': 0}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _get_entry(self, template_src):
+        """
+        Get the mirror directory of the template.
+        """
+        digest = hashlib.md5(os.path.normcase(template_src)).hexdigest()
+        name = os.path.basename(os.path.normpath(template_src))
+        return os.path.join(self.root, '%s_%s' % (name, digest[:12]))
+
+    def _get_lock(self, entry):
+        with self._lock:
+            return self._locks.setdefault(entry, threading.Lock())
+
+    def _load_manifest(self, entry):
+        try:
+            with open(os.path.join(entry, _MANIFEST)) as manifest_file:
+                return json.load(manifest_file)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_manifest(self, entry, manifest):
+        manifest_tmp = os.path.join(entry, _MANIFEST + '.tmp')
+        with open(manifest_tmp, 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        if os.path.exists(os.path.join(entry, _MANIFEST)):
+            os.remove(os.path.join(entry, _MANIFEST))
+        os.rename(manifest_tmp, os.path.join(entry, _MANIFEST))
+
+    def sync(self, template_src):
+        """
+        Update the mirror of the template, only files which differ from the
+        template server are copied. Return the mirror directory of files.
+        """
+        entry = self._get_entry(template_src)
+        with self._get_lock(entry):
+            return self._sync(entry, template_src)[0]
+
+    def _sync(self, entry, template_src):
+        """
+        Same as :meth:`sync`, but return (mirror directory of files,
+        manifest), and the lock of `entry` should be held.
+        """
+        files_dir = os.path.join(entry, _FILES)
+        (server_manifest, server_dirs) = _walk(template_src)
+        local_manifest = self._load_manifest(entry)
+        if not os.path.isdir(files_dir):
+            os.makedirs(files_dir)
+        for (rel_path, version) in server_manifest.items():
+            local_path = os.path.join(files_dir, rel_path)
+            if (local_manifest.get(rel_path) == version
+                    and os.path.exists(local_path)):
+                self.stats['reused'] += 1
+                continue
+            LOGGER.info('Copying "%s" of template "%s" into cache'
+                        % (rel_path, template_src))
+            # Drop it from manifest first, in case of being interrupted.
+            if local_manifest.pop(rel_path, None):
+                self._save_manifest(entry, local_manifest)
+            if not os.path.isdir(os.path.dirname(local_path)):
+                os.makedirs(os.path.dirname(local_path))
+            shutil.copy2(os.path.join(template_src, rel_path), local_path)
+            local_manifest[rel_path] = version
+            self.stats['copied'] += 1
+        for rel_path in set(local_manifest) - set(server_manifest):
+            LOGGER.info('Removing "%s" of template "%s" from cache'
+                        % (rel_path, template_src))
+            del local_manifest[rel_path]
+            local_path = os.path.join(files_dir, rel_path)
+            if os.path.exists(local_path):
+                os.remove(local_path)
+        # Keep empty directories the same as the template.
+        for rel_path in server_dirs:
+            if not os.path.isdir(os.path.join(files_dir, rel_path)):
+                os.makedirs(os.path.join(files_dir, rel_path))
+        for rel_path in sorted(_walk(files_dir)[1], reverse=True):
+            if rel_path not in server_dirs:
+                try:
+                    os.rmdir(os.path.join(files_dir, rel_path))
+                except OSError:
+                    pass
+        self._save_manifest(entry, local_manifest)
+        return (files_dir, local_manifest)
+
+    def seed(self, template_src, image_dir):
+        """
+        Create `image_dir` from the template, through the local mirror.
+        It's the replacement of ``shutil.copytree(template_src, image_dir)``.
+        """
+        start_time = time.time()
+        entry = self._get_entry(template_src)
+        cloned = 0
+        # Keep the mirror unchanged until the image is seeded.
+        with self._get_lock(entry):
+            (files_dir, manifest) = self._sync(entry, template_src)
+            if not os.path.isdir(image_dir):
+                os.makedirs(image_dir)
+            for rel_path in _walk(files_dir)[1]:
+                if not os.path.isdir(os.path.join(image_dir, rel_path)):
+                    os.makedirs(os.path.join(image_dir, rel_path))
+            linked_files = set()
+            if self.linked:
+                linked_files = self._link(entry, files_dir, manifest,
+                                          image_dir)
+            for rel_path in sorted(manifest):
+                if rel_path in linked_files:
+                    continue
+                src = os.path.join(files_dir, rel_path)
+                dst = os.path.join(image_dir, rel_path)
+                if _reflink(src, dst):
+                    cloned += 1
+                else:
+                    shutil.copy2(src, dst)
+            self.stats['cloned'] += cloned
+        LOGGER.info('Seeded "%s" from template cache in %.1f seconds,'
+                    ' %d files cloned' % (image_dir, time.time() - start_time,
+                                          cloned))
+        self.evict(keep=entry)
+        return
+
+    def _link(self, entry, files_dir, manifest, image_dir):
+        """
+        Create the VM in `image_dir` as a linked clone of the mirror, and
+        return the files which are created by the clone. Return an empty set
+        if the template is not a single VM or the clone fails, so that all
+        files are copied instead. The lock of `entry` should be held.
+        """
+        vmx_files = [rel_path for rel_path in manifest
+                     if os.path.splitext(rel_path)[1].lower() == '.vmx'
+                     and os.path.dirname(rel_path) == '']
+        if len(vmx_files) != 1:
+            return set()
+        parent_dir = os.path.join(entry, _PARENTS, get_version(manifest))
+        parent_vmx = os.path.join(parent_dir, vmx_files[0])
+        clones_file = os.path.join(parent_dir, _CLONES)
+        try:
+            if not os.path.exists(clones_file):
+                LOGGER.info('Creating parent "%s" of linked clones'
+                            % (parent_dir))
+                shutil.rmtree(parent_dir, ignore_errors=True)
+                shutil.copytree(files_dir, parent_dir)
+                _run_vmrun(parent_vmx, 'snapshot', _BASE_SNAP)
+                self._save_clones(parent_dir, [])
+            _run_vmrun(parent_vmx, 'clone',
+                       '"%s"' % os.path.join(image_dir, vmx_files[0]),
+                       'linked', '-snapshot=%s' % _BASE_SNAP)
+        except Exception, error:
+            LOGGER.warning('Failed to create linked clone of "%s", copy it'
+                           ' instead: %s' % (parent_vmx, error))
+            return set()
+        self._save_clones(parent_dir,
+                          self._get_clones(parent_dir) + [image_dir])
+        self.stats['linked'] += 1
+        return set(rel_path for rel_path in manifest
+                   if os.path.splitext(rel_path)[1].lower() in _VM_FILE_EXTS)
+
+    def _get_clones(self, parent_dir):
+        """
+        Get image directories of the linked clones of parent which still
+        exist.
+        """
+        try:
+            with open(os.path.join(parent_dir, _CLONES)) as clones_file:
+                clones = json.load(clones_file)
+        except (IOError, ValueError):
+            return []
+        return [x for x in clones if os.path.isdir(x)]
+
+    def _save_clones(self, parent_dir, clones):
+        with open(os.path.join(parent_dir, _CLONES), 'w') as clones_file:
+            json.dump(clones, clones_file)
+
+    def _evict_parents(self, entry):
+        """
+        Remove parents of the mirror which have no linked clones, except
+        the one of current version. Return True if any parent is in use.
+        The lock of `entry` should be held.
+        """
+        parents_root = os.path.join(entry, _PARENTS)
+        if not os.path.isdir(parents_root):
+            return False
+        current = get_version(self._load_manifest(entry))
+        in_use = False
+        for version in os.listdir(parents_root):
+            parent_dir = os.path.join(parents_root, version)
+            if self._get_clones(parent_dir):
+                in_use = True
+            elif version != current:
+                LOGGER.info('Removing unused parent "%s" of linked clones'
+                            % (parent_dir))
+                shutil.rmtree(parent_dir, ignore_errors=True)
+        return in_use
+
+    def evict(self, keep=None):
+        """
+        Remove mirrors which are not used in `expire_days` days, and then
+        the least recently used mirrors until the total size is within
+        `max_size`. The mirror `keep`, and the mirrors whose linked clones
+        still exist, are never removed.
+        """
+        if not os.path.isdir(self.root):
+            return
+        expire_time = time.time() - self.expire_days * 86400
+        entries = []
+        for name in os.listdir(self.root):
+            entry = os.path.join(self.root, name)
+            manifest = os.path.join(entry, _MANIFEST)
+            if not os.path.exists(manifest):
+                continue
+            with self._get_lock(entry):
+                if self._evict_parents(entry) or entry == keep:
+                    continue
+                if os.path.getmtime(manifest) < expire_time:
+                    LOGGER.info('Removing expired template cache "%s"'
+                                % (entry))
+                    shutil.rmtree(entry, ignore_errors=True)
+                    continue
+            entries.append((os.path.getmtime(manifest), entry))
+        if not self.max_size:
+            return
+        max_size = self.max_size * 1024 ** 3
+        total_size = sum(max(get_folder_size(os.path.join(self.root, x)), 0)
+                         for x in os.listdir(self.root))
+        for (mtime, entry) in sorted(entries):
+            if total_size <= max_size:
+                break
+            with self._get_lock(entry):
+                size = max(get_folder_size(entry), 0)
+                LOGGER.info('Removing template cache "%s" of %d bytes, since'
+                            ' cache size exceeds %s GB'
+                            % (entry, size, self.max_size))
+                shutil.rmtree(entry, ignore_errors=True)
+            total_size -= size
+        return
+
+    def get_stats(self):
+        """
+        Get count of files copied from template server, reused in cache,
+        and cloned with copy-on-write, and count of linked clones.
+        """
+        return dict(self.stats)
+
+
+template_cache = TemplateCache()
+"""
+The shared :class:`TemplateCache` of this process.
+"""